@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+from itertools import chain
+from os import getenv, path
+
+from lib.cache import CrossrefCache
+from lib.index import BibliographicIndex
+from lib.repository import Thoth
+from lib.snapshot import CrossrefSnapshot
+from main import build_match_index, get_cache_path, get_index_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build (or update) the local bibliographic index used "
+                    "to match citations without a DOI")
+    parser.add_argument("--match-index", type=str, default=get_index_path(),
+                        help="Path of the index. Default: %(default)s")
+    parser.add_argument("--cache", type=str, default=get_cache_path(),
+                        help="Path of the Crossref cache database whose "
+                             "records are indexed. Default: %(default)s")
+    parser.add_argument("--snapshot", type=str,
+                        help="Path of a local Crossref snapshot (see "
+                             "import-snapshot.py) whose works are indexed "
+                             "too.")
+    parser.add_argument("--thoth", action='store_true',
+                        help="Also index the references with a DOI already "
+                             "stored in Thoth.")
+    args = parser.parse_args()
+
+    works = ()
+    cache = None
+    if path.exists(args.cache):
+        cache = CrossrefCache(args.cache)
+        works = cache.iter_works()
+    snapshot = None
+    if args.snapshot:
+        snapshot = CrossrefSnapshot(args.snapshot)
+        works = chain(works, snapshot.iter_works())
+
+    references = ()
+    if args.thoth:
+        rep = Thoth(getenv('THOTH_PAT'))
+        rep.init_connection()
+        references = rep.iter_references()
+
+    index = BibliographicIndex(args.match_index)
+    try:
+        n_works, n_references = build_match_index(index, works, references)
+    finally:
+        index.close()
+        if cache is not None:
+            cache.close()
+        if snapshot is not None:
+            snapshot.close()
+    print(f"Indexed {n_works} Crossref works and {n_references} Thoth "
+          f"references in {args.match_index}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+
+from progress.counter import Counter
+
+from lib.snapshot import CrossrefSnapshot
+from main import get_snapshot_path, import_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import a Crossref metadata dump into the local "
+                    "snapshot used to resolve DOIs without querying "
+                    "Crossref")
+    parser.add_argument("dump", type=str, nargs="+",
+                        help="JSON or JSON lines file (possibly gzipped), "
+                             "tar archive of such files (e.g. the Crossref "
+                             "public data file) or directory of them.")
+    parser.add_argument("--snapshot", type=str, default=get_snapshot_path(),
+                        help="Path of the snapshot. Default: %(default)s")
+    args = parser.parse_args()
+
+    snapshot = CrossrefSnapshot(args.snapshot)
+    counter = Counter("Works imported: ")
+    try:
+        count = import_snapshot(snapshot, args.dump, callback=counter.next)
+    finally:
+        counter.finish()
+        snapshot.close()
+    print(f"Imported {count} works into {args.snapshot}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
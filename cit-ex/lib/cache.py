@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class CrossrefCache:
+    """Persistent cache of Crossref works, stored as compressed JSON in a
+       SQLite database and keyed by normalised DOI (see
+       refine.normalise_doi).
+
+       Negative results (DOIs unknown to Crossref) are cached too, with a
+       shorter TTL. When the total size of the stored records exceeds
+       max_size (in bytes), the least recently used records are evicted.
+       Access times are kept in memory and written in batches (before an
+       eviction, every FLUSH_SIZE hits and on close), so that hits do not
+       write to the database."""
+    DAY = 24 * 60 * 60
+    DEFAULT_TTL = 30 * DAY
+    DEFAULT_NEGATIVE_TTL = DAY
+    DEFAULT_SIZE = 512 * 1024 * 1024
+    FLUSH_SIZE = 1000
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 max_size: int = DEFAULT_SIZE) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.accessed = {}
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS works ("
+                        "doi TEXT PRIMARY KEY, "
+                        "data BLOB, "
+                        "stored REAL NOT NULL, "
+                        "accessed REAL NOT NULL)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) "
+                                    "FROM works").fetchone()[0]
+
+    def get(self, doi: str) -> tuple:
+        """Return a (hit, work) tuple. On a negative hit, work is None."""
+        with self.lock:
+            row = self.db.execute("SELECT data, stored FROM works "
+                                  "WHERE doi = ?", (doi,)).fetchone()
+            now = time.time()
+            if row is not None:
+                data, stored = row
+                ttl = self.ttl if data is not None else self.negative_ttl
+                if now - stored <= ttl:
+                    self.accessed[doi] = now
+                    if len(self.accessed) >= self.FLUSH_SIZE:
+                        self._flush_accessed()
+                        self.db.commit()
+                    self.hits += 1
+                    return True, self._decode(data)
+            self.misses += 1
+            return False, None
+
+    def set(self, doi: str, work: dict) -> None:
+        """Store work (None for a negative result) under doi"""
+        data = self._encode(work)
+        with self.lock:
+            now = time.time()
+            self._delete(doi)
+            self.db.execute("INSERT INTO works (doi, data, stored, accessed) "
+                            "VALUES (?, ?, ?, ?)", (doi, data, now, now))
+            self.size += len(data) if data is not None else 0
+            self.accessed.pop(doi, None)
+            self._evict()
+            self.db.commit()
+
+    def iter_works(self) -> tuple:
+        """Yield the (doi, work) tuples of the positive records, expired or
+           not"""
+        with self.lock:
+            rows = self.db.execute("SELECT doi, data FROM works "
+                                   "WHERE data IS NOT NULL").fetchall()
+        for doi, data in rows:
+            yield doi, self._decode(data)
+
+    def close(self) -> None:
+        """Close the underlying database"""
+        with self.lock:
+            self._flush_accessed()
+            self.db.commit()
+            self.db.close()
+
+    def _flush_accessed(self) -> None:
+        """Write the access times of the records read since the last
+           flush"""
+        if self.accessed:
+            self.db.executemany("UPDATE works SET accessed = ? "
+                                "WHERE doi = ?",
+                                [(t, doi) for doi, t in self.accessed.items()])
+            self.accessed = {}
+
+    def _delete(self, doi: str) -> None:
+        """Delete the record of doi, keeping track of the cache size"""
+        freed = self.db.execute("SELECT LENGTH(data) FROM works "
+                                "WHERE doi = ?", (doi,)).fetchone()
+        if freed is not None:
+            self.size -= freed[0] or 0
+            self.db.execute("DELETE FROM works WHERE doi = ?", (doi,))
+
+    def _evict(self) -> None:
+        """Delete the least recently used records until the cache fits
+           max_size again"""
+        if self.size > self.max_size:
+            self._flush_accessed()
+        while self.size > self.max_size:
+            lru = self.db.execute("SELECT doi FROM works ORDER BY accessed "
+                                  "LIMIT 100").fetchall()
+            if not lru:
+                break
+            for (doi,) in lru:
+                self._delete(doi)
+                if self.size <= self.max_size:
+                    break
+
+    @staticmethod
+    def _encode(work: dict) -> bytes:
+        if work is None:
+            return None
+        return zlib.compress(json.dumps(work).encode())
+
+    @staticmethod
+    def _decode(data: bytes) -> dict:
+        if data is None:
+            return None
+        return json.loads(zlib.decompress(data))
@@ -15,16 +15,282 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import hashlib
+import posixpath
+from urllib.parse import unquote
+import zipfile
+
 from bs4 import BeautifulSoup
 from ebooklib import epub, ITEM_DOCUMENT
+from lxml import etree
 
 
-class Extractor:
-    """Class to extract unstructured citations from an EPUB file"""
+class DocumentCache:
+    """LRU cache of parsed document trees, keyed by item id and content hash.
+       The memory budget (max_size, in bytes) is checked against an estimate
+       of each tree size, as a multiple of the length of its source markup.
+       A max_size of 0 disables the cache."""
+    DEFAULT_SIZE = 128 * 1024 * 1024
+    TREE_OVERHEAD = 10
+
+    def __init__(self, max_size: int = DEFAULT_SIZE) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(doc: epub.EpubItem) -> tuple:
+        """Return the cache key of an EPUB item: its id and a hash of its
+           content"""
+        content = doc.content
+        if isinstance(content, str):
+            content = content.encode()
+        return (doc.get_id(), hashlib.sha1(content).hexdigest())
+
+    def get(self, key: tuple) -> any:
+        """Return the tree stored under key (None on a miss) and mark it as
+           the most recently used"""
+        try:
+            tree, _ = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return tree
+
+    def put(self, key: tuple, tree: any, markup_size: int) -> None:
+        """Store tree under key, evicting the least recently used entries
+           until the cache fits the memory budget again"""
+        cost = markup_size * self.TREE_OVERHEAD
+        if cost > self.max_size:
+            return
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (tree, cost)
+        self.size += cost
+        while self.size > self.max_size:
+            _, (_, evicted_cost) = self._entries.popitem(last=False)
+            self.size -= evicted_cost
+
+    def clear(self) -> None:
+        """Drop all the entries. Hit/miss counters are preserved."""
+        self._entries.clear()
+        self.size = 0
+
+
+class Bs4Backend:
+    """Extraction backend based on BeautifulSoup. Slower than LxmlBackend,
+       but the most forgiving with malformed markup."""
+    name = "bs4"
+
+    def parse(self, markup: bytes) -> BeautifulSoup:
+        """Return the document tree of markup"""
+        return BeautifulSoup(markup, "lxml")
+
+    def find(self, tree: BeautifulSoup, html_classes: list) -> list:
+        """Return the text of the elements of tree with any of the classes
+           in html_classes, in document order"""
+        return [c.get_text() for c in tree.find_all(class_=html_classes)]
+
+
+class LxmlBackend:
+    """Extraction backend using lxml directly, with compiled XPath
+       expressions. Documents lxml cannot parse are handed over to
+       Bs4Backend."""
+    name = "lxml"
+    # elements whose text BeautifulSoup's get_text() leaves out
+    SKIPPED_TAGS = frozenset(["script", "style", "template"])
+
+    def __init__(self) -> None:
+        # get_body_content() always serialises documents as UTF-8
+        self.parser = etree.HTMLParser(encoding="utf-8")
+        self.fallback = Bs4Backend()
+
+    def parse(self, markup: bytes) -> any:
+        """Return the document tree of markup, as an lxml element or, if
+           lxml fails, as a BeautifulSoup object"""
+        try:
+            tree = etree.fromstring(markup, self.parser)
+        except (etree.ParserError, etree.XMLSyntaxError, ValueError):
+            tree = None
+        if tree is None:
+            return self.fallback.parse(markup)
+        return tree
+
+    def find(self, tree: any, html_classes: list) -> list:
+        """Return the text of the elements of tree with any of the classes
+           in html_classes, in document order"""
+        if isinstance(tree, BeautifulSoup):
+            return self.fallback.find(tree, html_classes)
+        xpath = self._class_xpath(len(html_classes))
+        variables = {f"c{i}": f" {c} " for i, c in enumerate(html_classes)}
+        return [self._get_text(e) for e in xpath(tree, **variables)]
+
+    @classmethod
+    def _get_text(cls, element: any) -> str:
+        """Return the text of element and its descendants, without that of
+           comments and of SKIPPED_TAGS elements, like Bs4Backend"""
+        parts = [element.text or ""]
+        for child in element:
+            # comments and processing instructions have no string tag
+            if isinstance(child.tag, str) and \
+                    child.tag not in cls.SKIPPED_TAGS:
+                parts.append(cls._get_text(child))
+            parts.append(child.tail or "")
+        return "".join(parts)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _class_xpath(n_classes: int) -> etree.XPath:
+        """Return a compiled XPath matching elements with any of the classes
+           passed as variables $c0 ... $cN (space padded)"""
+        matches = " or ".join(
+            f"contains(concat(' ', normalize-space(@class), ' '), $c{i})"
+            for i in range(n_classes))
+        return etree.XPath(f"//*[@class and ({matches})]")
+
+
+BACKENDS = {backend.name: backend for backend in [LxmlBackend, Bs4Backend]}
+
+
+@lru_cache(maxsize=None)
+def _get_backend(name: str) -> any:
+    """Return a backend instance, shared within the (worker) process"""
+    return BACKENDS[name]()
+
+
+def _find_in_content(backend_name: str, content: bytes,
+                     html_classes: list) -> list:
+    """Worker function for parallel extraction: rebuild the document from
+       its raw content, parse its body and return the matching citations"""
+    doc = epub.EpubHtml()
+    doc.content = content
+    backend = _get_backend(backend_name)
+    return backend.find(backend.parse(doc.get_body_content()), html_classes)
+
+
+class EpubStream:
+    """Iterable over the XHTML documents of an EPUB file. Only the container
+       and the OPF package are read upfront: documents are decompressed one
+       at a time while iterating, spine first, and the other items (images,
+       fonts, media) are never loaded."""
+    NAMESPACES = {"container": "urn:oasis:names:tc:opendocument:xmlns:"
+                               "container",
+                  "opf": "http://www.idpf.org/2007/opf"}
+    XHTML_TYPE = "application/xhtml+xml"
 
     def __init__(self, epub_path: str) -> None:
-        self.book = self._get_book(epub_path)
-        self.docs = self._get_docs()
+        self.epub_path = epub_path
+        self.items = self._read_package()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __iter__(self) -> epub.EpubHtml:
+        with zipfile.ZipFile(self.epub_path) as archive:
+            for uid, file_name, path in self.items:
+                doc = epub.EpubHtml(uid=uid, file_name=file_name)
+                doc.content = archive.read(path)
+                yield doc
+
+    def _read_package(self) -> list:
+        """Return a list of (id, file name, archive path) tuples for the
+           XHTML documents listed in the OPF manifest (navigation document
+           excluded), in spine order"""
+        try:
+            with zipfile.ZipFile(self.epub_path) as archive:
+                container = etree.fromstring(
+                    archive.read("META-INF/container.xml"))
+                opf_path = container.find(".//container:rootfile",
+                                          self.NAMESPACES).get("full-path")
+                package = etree.fromstring(archive.read(opf_path))
+        except (zipfile.BadZipFile, KeyError, AttributeError,
+                etree.XMLSyntaxError) as e:
+            raise epub.EpubException(0, f"Invalid EPUB file: {e}")
+
+        opf_dir = posixpath.dirname(opf_path)
+        manifest = {}
+        for item in package.iterfind("opf:manifest/opf:item",
+                                     self.NAMESPACES):
+            if item.get("media-type") == self.XHTML_TYPE and \
+               "nav" not in item.get("properties", "").split():
+                manifest[item.get("id")] = unquote(item.get("href"))
+
+        spine = [i.get("idref") for i in
+                 package.iterfind("opf:spine/opf:itemref", self.NAMESPACES)]
+        ids = [i for i in spine if i in manifest] + \
+              [i for i in manifest if i not in spine]
+
+        return [(i, manifest[i],
+                 posixpath.normpath(posixpath.join(opf_dir, manifest[i])))
+                for i in ids]
+
+
+class Extractor:
+    """Class to extract unstructured citations from an EPUB file.
+       With stream=True the book is read lazily through EpubStream (self.book
+       is None) and parsed documents are not cached. See from_html to
+       extract citations from HTML documents.
+
+       Parsed documents are only cached with cache_size > 0 (e.g.
+       DocumentCache.DEFAULT_SIZE), for callers extracting citations from
+       the same documents more than once."""
+
+    def __init__(self, epub_path: str, cache_size: int = 0,
+                 backend: str = LxmlBackend.name,
+                 stream: bool = False) -> None:
+        self.backend = self._new_backend(backend)
+        if stream:
+            self.book = None
+            self.docs = self._get_stream(epub_path)
+            self.cache = DocumentCache(0)
+        else:
+            self.book = self._get_book(epub_path)
+            self.docs = self._get_docs()
+            self.cache = DocumentCache(cache_size)
+
+    @classmethod
+    def from_html(cls, *documents: any, cache_size: int = 0,
+                  backend: str = LxmlBackend.name) -> "Extractor":
+        """Return an Extractor over raw HTML documents instead of an EPUB
+           file. Each document can be bytes, a string or a binary file-like
+           object; self.book is None."""
+        extractor = cls.__new__(cls)
+        extractor.backend = cls._new_backend(backend)
+        extractor.book = None
+        extractor.docs = [cls._get_html_doc(document, i)
+                          for i, document in enumerate(documents)]
+        extractor.cache = DocumentCache(cache_size)
+        return extractor
+
+    @staticmethod
+    def _new_backend(backend: str) -> any:
+        """Return an instance of the extraction backend named backend"""
+        try:
+            return BACKENDS[backend]()
+        except KeyError:
+            raise ValueError(f"Unknown extraction backend '{backend}'. "
+                             f"Expected one of: {', '.join(BACKENDS)}")
+
+    @staticmethod
+    def _get_html_doc(document: any, index: int) -> epub.EpubHtml:
+        """Return an EpubHtml item wrapping the raw HTML document"""
+        if hasattr(document, "read"):
+            document = document.read()
+        if isinstance(document, str):
+            document = document.encode()
+        doc = epub.EpubHtml(uid=f"html{index}", file_name=f"{index}.xhtml")
+        doc.content = document
+        return doc
 
     def _get_book(self, epub_path: str) -> epub.EpubBook:
         """Return an EpubBook object of the input file (path) epub_path"""
@@ -39,19 +305,81 @@ class Extractor:
 
         return book
 
+    def _get_stream(self, epub_path: str) -> EpubStream:
+        """Return an EpubStream of the input file (path) epub_path"""
+        try:
+            stream = EpubStream(epub_path)
+        except FileNotFoundError as e:
+            print(f"The filepath '{epub_path}' is invalid. \n\nSee: \n{e}")
+            raise
+        except epub.EpubException as e:
+            print(f"Invalid input file '{epub_path}'. \n\nSee: \n{e}")
+            raise
+
+        return stream
+
     def _get_docs(self) -> list:
-        """Return a list of the book ITEM_DOCUMENT items (i.e. chapters)"""
-        return list(self.book.get_items_of_type(ITEM_DOCUMENT))
+        """Return a list of the book ITEM_DOCUMENT items (i.e. chapters) in
+           spine order, followed by the documents missing from the spine in
+           manifest order. Like EpubStream, the navigation document is left
+           out: the reference ordinals must not depend on the way the book
+           is read."""
+        spine = [entry[0] if isinstance(entry, tuple) else entry
+                 for entry in self.book.spine]
+        position = {idref: n for n, idref in enumerate(spine)}
+        docs = [doc for doc in self.book.get_items_of_type(ITEM_DOCUMENT)
+                if not isinstance(doc, epub.EpubNav)]
+        return sorted(docs,
+                      key=lambda doc: position.get(doc.get_id(), len(spine)))
 
-    def exctract_cit(self, html_class: str = None) -> list:
-        """Parse book documents and look for paragraphs with class html_class.
-           The results is a list of unstructured citations."""
-        book_cit = []
-        if html_class:
+    def _parse(self, doc: epub.EpubItem) -> any:
+        """Return the parsed body of doc, from self.cache when possible"""
+        key = self.cache.key(doc)
+        tree = self.cache.get(key)
+        if tree is None:
+            body = doc.get_body_content()
+            tree = self.backend.parse(body)
+            self.cache.put(key, tree, len(body))
+        return tree
+
+    def iter_citations(self, html_classes: list, jobs: int = 1) -> str:
+        """Generator version of extract_citations: documents are parsed and
+           citations yielded one document at a time."""
+        html_classes = [c for c in html_classes if c]
+        if not html_classes:
+            return
+        if jobs > 1:
+            yield from self._iter_citations_parallel(html_classes, jobs)
+        else:
+            for doc in self.docs:
+                tree = self._parse(doc)
+                yield from self.backend.find(tree, html_classes)
+
+    def _iter_citations_parallel(self, html_classes: list, jobs: int) -> str:
+        """Parse documents in a pool of jobs processes and yield their
+           citations in document order. At most 2 * jobs documents are in
+           flight at any time, which keeps EpubStream lazy. self.cache is
+           not used, as parsed trees cannot be shared across processes."""
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            pending = deque()
             for doc in self.docs:
-                soup = BeautifulSoup(doc.get_body_content(), "lxml")
-                doc_cit = [c.get_text() for c in
-                           soup.find_all(class_=html_class)]
-                book_cit.extend(doc_cit)
+                pending.append(pool.submit(_find_in_content,
+                                           self.backend.name, doc.content,
+                                           html_classes))
+                if len(pending) >= 2 * jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
 
-        return book_cit
+    def extract_citations(self, html_classes: list, jobs: int = 1) -> list:
+        """Parse each book document once and look for elements with any of
+           the classes in html_classes. The result is a list of unstructured
+           citations, in document order. With jobs > 1, documents are
+           parsed in parallel by a pool of processes."""
+        return list(self.iter_citations(html_classes, jobs))
+
+    def exctract_cit(self, html_class: str = None) -> list:
+        """Parse book documents and look for paragraphs with class html_class.
+           The results is a list of unstructured citations.
+           Kept for backwards compatibility, see extract_citations."""
+        return self.extract_citations([html_class])
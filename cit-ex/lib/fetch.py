@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import threading
+import time
+
+import backoff
+import requests
+
+try:
+    from .retry import is_permanent_error
+except ImportError:  # imported as a top-level module, e.g. by the tests
+    from retry import is_permanent_error
+
+
+class HtmlMirror:
+    """Local copy of downloaded pages, stored under directory with the
+       layout expected by obp-loader --html-path: the page
+       https://doi.org/<prefix>/<doi>/<file> is saved as <doi>/<file>.
+
+       The validators (ETag, Last-Modified) and download time of each page
+       are kept in a <file>.json sidecar."""
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def path(self, url: str) -> str:
+        """Return the local path of the page url"""
+        split_url = url.rstrip('/').split('/')
+        return os.path.join(self.directory, split_url[-2], split_url[-1])
+
+    def get(self, url: str) -> dict:
+        """Return the stored page of url, or None if there is none"""
+        page_path = self.path(url)
+        try:
+            with open(page_path, 'rb') as page_file:
+                content = page_file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            with open(page_path + ".json") as meta_file:
+                page = json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            # e.g. a file copied by hand: always revalidate it
+            page = {"etag": None, "last_modified": None, "fetched": 0}
+        page["content"] = content
+        return page
+
+    def put(self, url: str, page: dict) -> None:
+        """Store page under the local path of url. Files are replaced
+           atomically, so that concurrent readers never see partial pages."""
+        page_path = self.path(url)
+        os.makedirs(os.path.dirname(page_path), exist_ok=True)
+        meta = {k: v for k, v in page.items() if k != "content"}
+        self._replace(page_path, page["content"])
+        self._replace(page_path + ".json", json.dumps(meta).encode())
+
+    @staticmethod
+    def _replace(file_path: str, data: bytes) -> None:
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, file_path)
+
+
+class HtmlFetcher:
+    """Downloads HTML pages through a single pooled session, with retries
+       on transient errors.
+
+       When an HtmlMirror is given, the validators (ETag, Last-Modified)
+       and content of each page are kept in it, so that pages fetched again
+       (e.g. by a later run) are requested conditionally and a 304 Not
+       Modified reuses the stored content. Pages downloaded less than
+       max_age seconds ago are not requested at all. With offline=True only
+       stored pages are used. Pages are not kept in memory."""
+    def __init__(self, max_workers: int = 8, timeout: float = 30,
+                 mirror: HtmlMirror = None, max_age: float = 0,
+                 offline: bool = False) -> None:
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.mirror = mirror
+        self.max_age = max_age
+        self.offline = offline
+        self.slots = threading.Semaphore(max_workers)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def fetch(self, url: str) -> bytes:
+        """Return the content of url. Raise requests.exceptions.HTTPError
+           if the page could not be fetched, or FileNotFoundError if it is
+           not stored and self.offline is set."""
+        page = self.mirror.get(url) if self.mirror is not None else None
+
+        if page is not None and (self.offline or
+                                 time.time() - page["fetched"] < self.max_age):
+            return page["content"]
+        if self.offline:
+            raise FileNotFoundError(f"{url} is not in the local mirror")
+
+        headers = {}
+        if page is not None:
+            if page.get("etag"):
+                headers["If-None-Match"] = page["etag"]
+            if page.get("last_modified"):
+                headers["If-Modified-Since"] = page["last_modified"]
+
+        # bound the requests in flight across concurrent fetch_all calls
+        with self.slots:
+            r = self._get(url, headers)
+        if r.status_code == 304 and page is not None:
+            page = dict(page, fetched=time.time())
+        else:
+            page = {"etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "fetched": time.time(),
+                    "content": r.content}
+
+        if self.mirror is not None:
+            self.mirror.put(url, page)
+        return page["content"]
+
+    def fetch_all(self, urls: list, optional: list = ()) -> tuple:
+        """Fetch urls concurrently, with at most self.max_workers requests
+           in flight (across all the threads sharing the fetcher), and
+           yield (url, content) tuples as the downloads complete. Pages in
+           optional that cannot be fetched (or are missing from the mirror,
+           offline) are yielded with None content; for the other pages the
+           error is raised."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.fetch, url): url for url in urls}
+            try:
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try:
+                        yield url, future.result()
+                    except (requests.exceptions.HTTPError,
+                            FileNotFoundError):
+                        if url not in optional:
+                            raise
+                        yield url, None
+            finally:
+                # do not wait for the pending downloads on errors
+                for future in futures:
+                    future.cancel()
+
+    def close(self) -> None:
+        """Release the pooled connections"""
+        self.session.close()
+
+    @backoff.on_exception(backoff.expo,
+                          requests.exceptions.RequestException,
+                          max_time=60, max_tries=3,
+                          giveup=is_permanent_error)
+    def _get(self, url: str, headers: dict) -> requests.Response:
+        """GET url, raising an HTTPError on error statuses"""
+        r = self.session.get(url, headers=headers, timeout=self.timeout)
+        r.raise_for_status()
+        return r
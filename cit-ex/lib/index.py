@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import sqlite3
+import threading
+
+# records with fewer words than this match short citations too easily
+MIN_WORDS = 5
+
+
+def tokenize(text: str) -> set:
+    """Return the set of lowercase words (of two characters or more) of
+       text"""
+    return {w for w in re.findall(r"\w+", text.lower()) if len(w) > 1}
+
+
+def confidence(citation: str, text: str) -> float:
+    """Return the confidence (from 0 to 1) that the unstructured citation
+       refers to the record described by text: the share of the words of
+       the record found in the citation, lowered for records shorter than
+       MIN_WORDS words"""
+    words = tokenize(text)
+    if not words:
+        return 0.0
+    share = len(words & tokenize(citation)) / len(words)
+    return share * min(1.0, len(words) / MIN_WORDS)
+
+
+def work_text(work: dict) -> str:
+    """Return the text a Crossref work is indexed by: its title, container
+       title, author family names and year"""
+    parts = work.get("title", []) + work.get("subtitle", []) \
+        + work.get("container-title", [])
+    parts += [a.get("family", "") for a in work.get("author", [])]
+    try:
+        parts.append(str(work["issued"]["date-parts"][0][0] or ""))
+    except (KeyError, IndexError, TypeError):
+        pass
+    return " ".join(p for p in parts if p)
+
+
+def reference_text(reference: dict) -> str:
+    """Return the text a Thoth reference is indexed by: its structured
+       fields when it has a title, its unstructured citation otherwise"""
+    if reference.get("articleTitle") or reference.get("volumeTitle"):
+        fields = ["author", "articleTitle", "volumeTitle", "journalTitle",
+                  "publicationDate"]
+        return " ".join(str(reference[f])[:4] if f == "publicationDate"
+                        else str(reference[f])
+                        for f in fields if reference.get(f))
+    return reference.get("unstructuredCitation") or ""
+
+
+class BibliographicIndex:
+    """Local full-text index of bibliographic records (e.g. cached Crossref
+       works and references already in Thoth), to find the DOI of
+       unstructured citations that do not quote one.
+
+       Records are stored in a SQLite database with an FTS5 index: the
+       candidates of a citation are ranked with BM25, then scored with
+       confidence (see the function of the same name)."""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "id INTEGER PRIMARY KEY, "
+            "doi TEXT UNIQUE NOT NULL, "
+            "text TEXT NOT NULL);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5("
+            "text, content='records', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2');"
+            "CREATE TRIGGER IF NOT EXISTS records_ai AFTER INSERT ON records "
+            "BEGIN INSERT INTO records_fts (rowid, text) "
+            "VALUES (new.id, new.text); END;"
+            "CREATE TRIGGER IF NOT EXISTS records_ad AFTER DELETE ON records "
+            "BEGIN INSERT INTO records_fts (records_fts, rowid, text) "
+            "VALUES ('delete', old.id, old.text); END;")
+        self.db.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM records") \
+                .fetchone()[0]
+
+    def add(self, doi: str, text: str) -> None:
+        """Index the record of (normalised) doi under text, replacing any
+           previous record of doi"""
+        if not doi or not tokenize(text):
+            return
+        with self.lock:
+            self.db.execute("DELETE FROM records WHERE doi = ?", (doi,))
+            self.db.execute("INSERT INTO records (doi, text) VALUES (?, ?)",
+                            (doi, text))
+
+    def commit(self) -> None:
+        """Commit the records added so far"""
+        with self.lock:
+            self.db.commit()
+
+    def search(self, citation: str, limit: int = 10) -> list:
+        """Return the (doi, confidence) tuples of the records that best
+           match the unstructured citation, most confident first"""
+        words = tokenize(citation)
+        if not words:
+            return []
+        query = " OR ".join(f'"{w}"' for w in sorted(words))
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT records.doi, records.text FROM records_fts "
+                "JOIN records ON records.id = records_fts.rowid "
+                "WHERE records_fts MATCH ? ORDER BY bm25(records_fts) "
+                "LIMIT ?", (query, limit)).fetchall()
+        matches = [(doi, confidence(citation, text)) for doi, text in rows]
+        return sorted(matches, key=lambda m: m[1], reverse=True)
+
+    def match(self, citation: str, threshold: float = 0.8) -> tuple:
+        """Return the (doi, confidence) tuple of the best match of the
+           unstructured citation, or None if no record reaches threshold"""
+        matches = self.search(citation)
+        if matches and matches[0][1] >= threshold:
+            return matches[0]
+        return None
+
+    def close(self) -> None:
+        """Commit and close the underlying database"""
+        with self.lock:
+            self.db.commit()
+            self.db.close()
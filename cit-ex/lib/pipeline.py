@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+
+_DONE = object()
+
+
+class StreamingPipeline:
+    """Runs the extraction, lookup and write stages of cit-ex concurrently,
+       connected by bounded queues, so that the first references are
+       written while later citations are still being extracted and looked
+       up. The queues provide backpressure: at most queue_size items wait
+       between two stages, whatever the size of the input.
+
+       The stages are plain (blocking) callables, run in worker threads:
+        - find(item) returns the lookup key of an extracted item (e.g. its
+          normalised DOI), or None;
+        - resolve(key) looks the key up. Each unique key is resolved once,
+          concurrent requests for the same key share the lookup;
+        - build(item, value) returns the record to write (value is None
+          for items without a key or whose lookup failed);
+        - write(records) writes a dictionary of ordinal -> record and
+          returns a dictionary of ordinal -> error message for the records
+          that could not be written.
+
+       Ordinals are assigned in extraction order, starting from 1, so they
+       do not depend on the order lookups complete in."""
+    def __init__(self, find: callable, resolve: callable, build: callable,
+                 write: callable, lookup_workers: int = 5,
+                 write_workers: int = 1, batch_size: int = 50,
+                 queue_size: int = None, callback: callable = None) -> None:
+        self.find = find
+        self.resolve = resolve
+        self.build = build
+        self.write = write
+        self.lookup_workers = lookup_workers
+        self.write_workers = write_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size or 2 * batch_size * write_workers
+        self.callback = callback
+        self.extracted = 0
+        self.requested = 0
+        self.resolved = 0
+        self.written = 0
+
+    def run(self, items: iter) -> dict:
+        """Stream items (e.g. a generator of unstructured citations)
+           through the pipeline. Return a dictionary of ordinal -> error
+           message for the records that could not be written. An exception
+           raised by a stage (other than resolve) stops the pipeline and is
+           raised again."""
+        return asyncio.run(self._run(items))
+
+    async def _run(self, items: iter) -> dict:
+        extracted = asyncio.Queue(maxsize=self.queue_size)
+        built = asyncio.Queue(maxsize=self.queue_size)
+        lookups = {}
+        failures = {}
+
+        lookup_tasks = [asyncio.create_task(
+                            self._lookup(extracted, built, lookups))
+                        for _ in range(self.lookup_workers)]
+        tasks = [asyncio.create_task(self._extract(items, extracted)),
+                 *lookup_tasks,
+                 asyncio.create_task(self._close(lookup_tasks, built)),
+                 *[asyncio.create_task(self._write(built, failures))
+                   for _ in range(self.write_workers)]]
+        try:
+            # a failed stage stops draining its queue: stop at the first
+            # error rather than waiting for stages blocked on it
+            done, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+        return failures
+
+    async def _extract(self, items: iter, extracted: asyncio.Queue) -> None:
+        """Pull items from the (blocking) iterator in a worker thread and
+           queue them with their ordinal, then signal the end of the items
+           to each lookup worker"""
+        iterator = iter(items)
+        while (item := await asyncio.to_thread(next, iterator, _DONE)) \
+                is not _DONE:
+            self.extracted += 1
+            await extracted.put((self.extracted, item))
+        for _ in range(self.lookup_workers):
+            await extracted.put(_DONE)
+
+    async def _close(self, lookup_tasks: list, built: asyncio.Queue) -> None:
+        """Signal the end of the records to each write worker once all the
+           lookups are done"""
+        await asyncio.gather(*lookup_tasks)
+        for _ in range(self.write_workers):
+            await built.put(_DONE)
+
+    async def _lookup(self, extracted: asyncio.Queue, built: asyncio.Queue,
+                      lookups: dict) -> None:
+        while (entry := await extracted.get()) is not _DONE:
+            ordinal, item = entry
+            key = await asyncio.to_thread(self.find, item)
+            value = None
+            if key is not None:
+                self.requested += 1
+                if key not in lookups:
+                    self.resolved += 1
+                    lookups[key] = asyncio.create_task(
+                        self._resolve(key))
+                value = await lookups[key]
+            record = await asyncio.to_thread(self.build, item, value)
+            await built.put((ordinal, record))
+
+    async def _resolve(self, key: any) -> any:
+        try:
+            return await asyncio.to_thread(self.resolve, key)
+        except Exception:
+            # a failed lookup leaves the record unenriched
+            return None
+
+    async def _write(self, built: asyncio.Queue, failures: dict) -> None:
+        batch = {}
+        while (entry := await built.get()) is not _DONE:
+            ordinal, record = entry
+            batch[ordinal] = record
+            if len(batch) >= self.batch_size:
+                await self._write_batch(batch, failures)
+                batch = {}
+        if batch:
+            await self._write_batch(batch, failures)
+
+    async def _write_batch(self, batch: dict, failures: dict) -> None:
+        failures.update(await asyncio.to_thread(self.write, batch))
+        self.written += len(batch)
+        if self.callback is not None:
+            self.callback(len(batch))
@@ -2,11 +2,19 @@ from dataclasses import dataclass
 import datetime
 import re
 import requests
-from urllib.parse import urljoin
+import threading
+import time
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from urllib.parse import quote, urljoin
 
 import backoff
 from crossref.restful import Works, Etiquette
 
+try:
+    from .retry import is_permanent_error
+except ImportError:  # imported as a top-level module, e.g. by the tests
+    from retry import is_permanent_error
+
 
 @dataclass
 class Citation:
@@ -42,19 +50,366 @@ class Citation:
             self.doi_url = urljoin("https://doi.org/", doi)
 
 
+class RateLimiter():
+    """Thread-safe limiter to space out requests to at most max_rate per
+       second, e.g. to stay within Crossref polite pool limits while
+       querying it from several threads. A max_rate of 0 disables it."""
+    def __init__(self, max_rate: float) -> None:
+        self.interval = 1 / max_rate if max_rate else 0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until the caller is allowed to send the next request"""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def normalise_doi(doi: str) -> str:
+    """Return doi in a canonical form, suitable as a lookup key:
+       lowercase, without resolver prefix and trailing punctuation"""
+    doi = doi.strip().lower()
+    doi = re.sub(r"^(?:https?://(?:dx\.)?doi\.org/|doi:)", "", doi)
+    return doi.rstrip(".,;:")
+
+
+# fields of a Crossref work read by Refine.process_crossref_data
+WORK_FIELDS = ["DOI", "ISSN", "ISBN", "isbn-type", "author", "title",
+               "subtitle", "container-title", "page", "volume", "issue",
+               "issued", "type", "resource", "edition-number"]
+
+
+def project_work(work: dict) -> dict:
+    """Return a copy of the Crossref work reduced to WORK_FIELDS, dropping
+       e.g. its reference list, funders, licences and links. Authors are
+       reduced to their names."""
+    if not isinstance(work, dict):
+        return work
+    work = {field: work[field] for field in WORK_FIELDS if field in work}
+    if "author" in work:
+        work["author"] = [{k: v for k, v in author.items()
+                           if k in ("given", "family")}
+                          for author in work["author"]]
+    if "resource" in work:
+        work["resource"] = {"primary": {"URL": work["resource"].get(
+            "primary", {}).get("URL")}}
+    return work
+
+
+def citation_from_reference(reference: dict) -> Citation:
+    """Return a Citation object built from an item of the reference list
+       deposited with Crossref for a work. When the reference has no
+       unstructured text, one is composed from its fields."""
+    def first(*fields: str) -> str:
+        for field in fields:
+            if reference.get(field):
+                return str(reference[field])
+        return None
+
+    year = first("year")
+    year = year[:4] if year and year[:4].isdigit() else None
+    edition = first("edition")
+
+    cit = Citation(
+        unstructured_citation=first("unstructured"),
+        issn=first("ISSN", "issn"),
+        isbn=first("ISBN", "isbn"),
+        journal_title=first("journal-title"),
+        article_title=first("article-title"),
+        series_title=first("series-title"),
+        volume_title=first("volume-title"),
+        edition=int(edition) if edition and edition.isdigit() else None,
+        author=first("author"),
+        volume=first("volume"),
+        issue=first("issue"),
+        first_page=first("first-page"),
+        standard_designator=first("standard-designator"),
+        standards_body_name=first("standards-body"),
+        publication_date=f"{year}-01-01" if year else None)
+    cit.process_doi(first("DOI", "doi"))
+
+    if cit.unstructured_citation is None:
+        title = cit.article_title or cit.volume_title
+        container = cit.journal_title if cit.article_title else None
+        if container and cit.volume:
+            container += f" {cit.volume}"
+            if cit.issue:
+                container += f"({cit.issue})"
+        parts = [cit.author, f"({year})" if year else None, title,
+                 container, cit.first_page, cit.doi_url]
+        cit.unstructured_citation = ". ".join(p for p in parts if p)
+    return cit
+
+
+class CrossrefClient():
+    """Crossref client to be shared by all the lookups of a run.
+       Requests go through a single HTTP session, so connections are pooled
+       and reused, and are spaced out by an optional RateLimiter.
+       Works are read from (and stored to) an optional persistent cache, see
+       CrossrefCache; in offline mode cache misses return None.
+       Works in an optional CrossrefSnapshot are used before both.
+       With batch_size > 1, get_works resolves DOIs batch_size at a time
+       with filtered /works queries, only selecting the fields in SELECT.
+       Crossref does not accept resource and edition-number in select, so
+       works resolved that way (or searched) have no landing page URL nor
+       edition number."""
+    WORKS_URL = "https://api.crossref.org/works/"
+    # the elements of WORK_FIELDS documented as accepted by select
+    # (isbn-type is covered by ISBN)
+    SELECT = ["DOI", "ISSN", "ISBN", "author", "title", "subtitle",
+              "container-title", "page", "volume", "issue", "issued", "type"]
+
+    def __init__(self, email: str = "no-email@offered.org",
+                 limiter: RateLimiter = None, cache: any = None,
+                 offline: bool = False, pool_size: int = 10,
+                 timeout: float = 30, batch_size: int = 1,
+                 snapshot: any = None) -> None:
+        self.etiquette = Etiquette('cit-ex', '0.1.1', 'https://github.com/'
+                                   'OpenBookPublishers/cit-ex', email)
+        self.limiter = limiter
+        self.cache = cache
+        self.snapshot = snapshot
+        self.offline = offline
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.select = self.SELECT
+        self.requested = 0
+        self.resolved = 0
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = str(self.etiquette)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+    def get_work(self, doi: str) -> dict:
+        """Return the Crossref work of doi (None if Crossref does not know
+           it), from self.cache when possible"""
+        key = normalise_doi(doi)
+        if self.snapshot is not None:
+            work = self.snapshot.get(key)
+            if work is not None:
+                return project_work(work)
+        if self.cache is not None:
+            hit, work = self.cache.get(key)
+            if hit:
+                return project_work(work)
+        if self.offline:
+            return None
+
+        return self._store(key, self._fetch_work(key))
+
+    def _store(self, doi: str, work: dict) -> dict:
+        """Store the projection of work (None if not found) in self.cache
+           and return it"""
+        work = project_work(work)
+        if self.cache is not None:
+            self.cache.set(doi, work)
+        return work
+
+    def get_references(self, doi: str) -> list:
+        """Return the reference list deposited with Crossref for the work of
+           doi, or None if the work is unknown, has no deposited references
+           or could not be fetched. Reference lists are not cached, and
+           never fetched in offline mode."""
+        if self.offline:
+            return None
+        try:
+            work = self._fetch_work(normalise_doi(doi))
+        except requests.exceptions.RequestException:
+            return None
+        return (work or {}).get("reference") or None
+
+    def search_work(self, citation: str) -> dict:
+        """Return the work that best matches the unstructured citation
+           according to a Crossref bibliographic query (None if there is
+           none, or in offline mode). The work is stored in self.cache."""
+        if self.offline:
+            return None
+        try:
+            work = self._fetch_bibliographic(citation, self.select)
+        except requests.exceptions.RequestException:
+            return None
+        if work is None:
+            return None
+        return self._store(normalise_doi(work["DOI"]), work)
+
+    def get_works(self, dois: list, max_workers: int = 1,
+                  callback: callable = None) -> dict:
+        """Resolve a list of DOIs, looking up each unique (normalised) DOI
+           only once, with up to max_workers concurrent lookups. Return a
+           dictionary of normalised DOI -> work (None when not found or on
+           request errors, once retries are exhausted). callback, if given,
+           is called after each lookup. The number of DOIs requested and
+           actually resolved is tracked in self.requested and
+           self.resolved.
+
+           DOIs in self.snapshot are resolved from it. With
+           self.batch_size > 1, the others missing from the cache are first
+           looked up in batches; those not returned by a batch (including
+           DOIs unknown to Crossref) are then looked up one at a time."""
+        dois = [normalise_doi(doi) for doi in dois]
+        unique_dois = list(dict.fromkeys(dois))
+        with self.lock:
+            self.requested += len(dois)
+            self.resolved += len(unique_dois)
+
+        works = {}
+        if self.snapshot is not None:
+            for doi in unique_dois:
+                work = self.snapshot.get(doi)
+                if work is not None:
+                    works[doi] = project_work(work)
+                    if callback is not None:
+                        callback()
+        missing = [doi for doi in unique_dois if doi not in works]
+        if self.batch_size > 1 and not self.offline:
+            candidates, missing = missing, []
+            for doi in candidates:
+                hit, work = self.cache.get(doi) if self.cache is not None \
+                    else (False, None)
+                if hit:
+                    works[doi] = project_work(work)
+                    if callback is not None:
+                        callback()
+                else:
+                    missing.append(doi)
+            # commas would split the filter value
+            batchable = [doi for doi in missing if "," not in doi]
+            batches = [batchable[i:i + self.batch_size]
+                       for i in range(0, len(batchable), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for future in as_completed(pool.submit(self._fetch_batch,
+                                                       batch)
+                                           for batch in batches):
+                    try:
+                        found = future.result()
+                    except requests.exceptions.RequestException:
+                        found = {}
+                    for doi, work in found.items():
+                        works[doi] = self._store(doi, work)
+                        if callback is not None:
+                            callback()
+            missing = [doi for doi in missing if doi not in works]
+            lookup = self._get_uncached_work
+        else:
+            lookup = self.get_work
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(lookup, doi): doi for doi in missing}
+            for future in as_completed(futures):
+                try:
+                    works[futures[future]] = future.result()
+                except requests.exceptions.RequestException:
+                    works[futures[future]] = None
+                if callback is not None:
+                    callback()
+        return works
+
+    def _get_uncached_work(self, doi: str) -> dict:
+        """Query Crossref for the work of doi, a cache miss"""
+        return self._store(doi, self._fetch_work(doi))
+
+    def _fetch_batch(self, dois: list) -> dict:
+        """Query Crossref for the works of dois with a filtered query.
+           Return a dictionary of normalised DOI -> work for the works
+           found. If Crossref rejects the selected fields, the query is
+           sent again (and later batches are sent) without select."""
+        try:
+            return self._fetch_filtered(dois, self.select)
+        except requests.exceptions.HTTPError as e:
+            if self.select is None or e.response is None or \
+               e.response.status_code != 400:
+                raise
+            self.select = None
+            return self._fetch_filtered(dois, None)
+
+    @backoff.on_exception(backoff.expo,
+                          requests.exceptions.RequestException,
+                          max_time=60, max_tries=3,
+                          giveup=is_permanent_error)
+    def _fetch_filtered(self, dois: list, select: list = None) -> dict:
+        """Query Crossref for the works of dois with a filtered /works
+           query, returning a dictionary of normalised DOI -> work"""
+        if self.limiter is not None:
+            self.limiter.wait()
+        params = {"filter": ",".join(f"doi:{doi}" for doi in dois),
+                  "rows": len(dois)}
+        if select:
+            params["select"] = ",".join(select)
+        r = self.session.get(self.WORKS_URL.rstrip("/"), params=params,
+                             timeout=self.timeout)
+        r.raise_for_status()
+        items = r.json()["message"]["items"]
+        return {normalise_doi(item["DOI"]): item for item in items
+                if normalise_doi(item["DOI"]) in dois}
+
+    @backoff.on_exception(backoff.expo,
+                          requests.exceptions.RequestException,
+                          max_time=60, max_tries=3,
+                          giveup=is_permanent_error)
+    def _fetch_bibliographic(self, citation: str, select: list = None) \
+            -> dict:
+        """Query Crossref for the best match of citation with a
+           query.bibliographic /works query"""
+        if self.limiter is not None:
+            self.limiter.wait()
+        params = {"query.bibliographic": citation, "rows": 1}
+        if select:
+            params["select"] = ",".join(select)
+        r = self.session.get(self.WORKS_URL.rstrip("/"), params=params,
+                             timeout=self.timeout)
+        r.raise_for_status()
+        items = r.json()["message"]["items"]
+        return items[0] if items else None
+
+    @backoff.on_exception(backoff.expo,
+                          requests.exceptions.RequestException,
+                          max_time=60, max_tries=3,
+                          giveup=is_permanent_error)
+    def _fetch_work(self, doi: str) -> dict:
+        """Query Crossref for the work of doi"""
+        if self.limiter is not None:
+            self.limiter.wait()
+        r = self.session.get(self.WORKS_URL + quote(doi, safe="/"),
+                             timeout=self.timeout)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return r.json()["message"]
+
+    def close(self) -> None:
+        """Release the pooled connections"""
+        self.session.close()
+
+
 class Refine():
     """Class to process unstructured citations.
        The method get_citation returns a Citation object to (hopefully) ease
-       further processing via dependency injection."""
+       further processing via dependency injection.
+
+       The Crossref work of the citation can be injected with work (e.g.
+       prefetched with a CrossrefClient), or looked up from doi, through
+       client if given. Only the fields in WORK_FIELDS are kept."""
     def __init__(self, unstructured_citation: str, doi: str = None,
-                 email: str = "no-email@offered.org") -> None:
+                 email: str = "no-email@offered.org",
+                 client: CrossrefClient = None, work: dict = None) -> None:
         self.cit = Citation(unstructured_citation=unstructured_citation)
 
-        self.work = None
-        if doi is not None:
+        self.work = project_work(work)
+        if work is None and doi is not None:
             try:
-                self.work = self._get_work_by_doi(doi, email)
-            except requests.exceptions.HTTPError:
+                if client is not None:
+                    self.work = client.get_work(doi)
+                else:
+                    self.work = project_work(
+                        self._get_work_by_doi(doi, email))
+            except requests.exceptions.RequestException:
                 pass
 
     @staticmethod
@@ -103,9 +458,13 @@ class Refine():
     def get_isbn(self) -> str:
         """Get ISBN from self.work"""
         isbn = None
-        for entry in self.work.get("isbn-type", []):
-            if len(entry.get("value")) > 10:
-                isbn = entry.get("value")
+        # works fetched with select only have the untyped ISBN list
+        values = [entry.get("value")
+                  for entry in self.work.get("isbn-type", [])] \
+            or self.work.get("ISBN", [])
+        for value in values:
+            if len(value) > 10:
+                isbn = value
 
                 # if isbn comes without hypens
                 if len(isbn) == 13 and "-" not in isbn:
@@ -15,10 +15,22 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+from concurrent.futures import ThreadPoolExecutor
+import difflib
+import hashlib
+import json
 import re
 from urllib.parse import urljoin
 
+import backoff
+import requests
 from thothlibrary import ThothClient
+from thothlibrary.mutation import ThothMutation
+
+try:
+    from .retry import is_permanent_error
+except ImportError:  # imported as a top-level module, e.g. by the tests
+    from retry import is_permanent_error
 
 
 class Repository():
@@ -27,7 +39,20 @@ class Repository():
     def __init__(self, token: str = None) -> None:
         self.token = token
         self.client = None
+        self.session = None
         self.identifier = None
+        self.work_ids = {}
+
+    def clone(self) -> "Repository":
+        """Return a client of the same repository with its own work
+           identifier, so that several works can be written concurrently
+           (e.g. one per thread). The connection (client and pooled
+           session) and the cache of DOI -> work UUID are shared."""
+        rep = type(self)(self.token)
+        rep.client = self.client
+        rep.session = self.session
+        rep.work_ids = self.work_ids
+        return rep
 
     def init_connection(self) -> None:
         """Init repository object"""
@@ -40,9 +65,27 @@ class Repository():
 
 class Thoth(Repository):
     """Class to interface with Thoth repository"""
+    POOL_SIZE = 16
+    PAGE_SIZE = 100
+    # seconds to wait for Thoth before the request is retried
+    TIMEOUT = 30
+    REFERENCE_FIELDS = [
+        "referenceOrdinal", "doi", "unstructuredCitation", "issn", "isbn",
+        "journalTitle", "articleTitle", "seriesTitle", "volumeTitle",
+        "edition", "author", "volume", "issue", "firstPage",
+        "componentNumber", "standardDesignator", "standardsBodyName",
+        "standardsBodyAcronym", "url", "publicationDate", "retrievalDate"
+    ]
+
     def init_connection(self) -> None:
         self.client = ThothClient()
         self.client.set_token(self.token)
+        self.session = requests.Session()
+        if self.token:
+            # reading public data (e.g. iter_references) needs no token
+            self.session.headers["Authorization"] = f"Bearer {self.token}"
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.POOL_SIZE)
+        self.session.mount("https://", adapter)
 
     def resolve_identifier(self, identifier: str) -> None:
         """User would input either a DOI or a UUID from the CLI. This method
@@ -61,21 +104,66 @@ class Thoth(Repository):
 
         if doi_regex.search(identifier):
             doi = doi_regex.search(identifier).group()
-            work = self.client.work_by_doi(
-                doi=urljoin("https://doi.org/", doi)
-            )
-            self.identifier = work.workId
+            if doi.lower() not in self.work_ids:
+                work = self.client.work_by_doi(
+                    doi=urljoin("https://doi.org/", doi)
+                )
+                self.work_ids[doi.lower()] = work.workId
+            self.identifier = self.work_ids[doi.lower()]
         elif uuid_regex.search(identifier):
             self.identifier = uuid_regex.search(identifier).group()
         else:
             raise ValueError(f"Identifier not well formatted: '{identifier}'. "
                              "Expected a DOI or UUID")
 
-    def write_record(self, citation: any, ordinal: int) -> None:
-        """Create the reference object and write it to the repository"""
+    def resolve_dois(self, dois: list, batch_size: int = 50) -> dict:
+        """Return a dictionary of DOI -> work UUID for the given DOIs (in any
+           of the formats accepted by resolve_identifier). DOIs are resolved
+           with one aliased workByDoi query per batch_size DOIs and cached
+           in self.work_ids, which resolve_identifier uses too. DOIs unknown
+           to Thoth are left out."""
+        doi_regex = re.compile(r"(10\.\d{3,6}\/\S*)")
+        keys = {}
+        for doi in dois:
+            match = doi_regex.search(doi)
+            if match:
+                keys[doi] = match.group().lower()
+
+        missing = list(dict.fromkeys(key for key in keys.values()
+                                     if key not in self.work_ids))
+        for i in range(0, len(missing), batch_size):
+            self._query_work_ids(missing[i:i + batch_size])
+
+        return {doi: self.work_ids[key] for doi, key in keys.items()
+                if key in self.work_ids}
+
+    def _query_work_ids(self, dois: list) -> None:
+        """Look up the work UUIDs of dois in one aliased query and store
+           them in self.work_ids"""
+        query = "{\n%s\n}" % "\n".join(
+            "w%d: workByDoi(doi: %s) { workId }"
+            % (n, json.dumps(urljoin("https://doi.org/", doi)))
+            for n, doi in enumerate(dois))
+        data = self._execute(query).get("data") or {}
+
+        if not data and len(dois) > 1:
+            # an unknown DOI invalidates the whole query: look them up
+            # one at a time
+            for doi in dois:
+                self._query_work_ids([doi])
+            return
+
+        for n, doi in enumerate(dois):
+            work = data.get(f"w{n}")
+            if work is not None:
+                self.work_ids[doi] = work["workId"]
+
+    @staticmethod
+    def _get_reference(citation: any, ordinal: int, work_id: str) -> dict:
+        """Return the Thoth reference object of a citation"""
         try:
             reference = {
-                "workId":               self.identifier,
+                "workId":               work_id,
                 "referenceOrdinal":     ordinal,
                 "doi":                  citation.doi_url,
                 "unstructuredCitation": citation.unstructured_citation,
@@ -101,5 +189,234 @@ class Thoth(Repository):
         except AttributeError as e:
             raise TypeError(f"Please, provide a valid Citation object, "
                             f"see:\n\n{e}")
+        return reference
+
+    def write_record(self, citation: any, ordinal: int) -> None:
+        """Create the reference object and write it to the repository"""
+        reference = self._get_reference(citation, ordinal, self.identifier)
+        self.client.create_reference(reference)
+
+    def write_records(self, citations: list, batch_size: int = 50,
+                      max_in_flight: int = 1,
+                      callback: callable = None) -> dict:
+        """Create the reference objects of citations (numbered from 1) and
+           write them to the repository, sending up to batch_size
+           createReference mutations per request, as aliased fields of a
+           single GraphQL document, and up to max_in_flight concurrent
+           requests. Ordinals are assigned before sending, so they do not
+           depend on the order requests complete in.
+           callback, if given, is called with the number of references sent
+           after each request.
+           Return a dictionary of ordinal -> error message for the
+           references that could not be written."""
+        references = [self._get_reference(citation, ordinal, self.identifier)
+                      for ordinal, citation in enumerate(citations, start=1)]
+        batches = [{f"ref{r['referenceOrdinal']}": ("createReference", r)
+                    for r in references[i:i + batch_size]}
+                   for i in range(0, len(references), batch_size)]
+
+        failures = {}
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            for batch, errors in zip(batches,
+                                     pool.map(self._run_mutations, batches)):
+                failures.update({int(alias[3:]): error
+                                 for alias, error in errors.items()})
+                if callback is not None:
+                    callback(len(batch))
+        return failures
+
+    def write_batch(self, citations: dict) -> dict:
+        """Write the reference objects of citations, a dictionary of
+           ordinal -> citation, in a single request. Return a dictionary of
+           ordinal -> error message for the references that could not be
+           written."""
+        operations = {
+            f"ref{ordinal}": ("createReference", self._get_reference(
+                citation, ordinal, self.identifier))
+            for ordinal, citation in citations.items()}
+        return {int(alias[3:]): error for alias, error
+                in self._run_mutations(operations).items()}
+
+    def get_records(self) -> list:
+        """Return the references already attached to the work in the
+           repository, sorted by ordinal"""
+        references = []
+        offset = 0
+        while True:
+            query = '{ work(workId: "%s") { references(limit: %d, ' \
+                    'offset: %d) { referenceId %s } } }' % (
+                        self.identifier, self.PAGE_SIZE, offset,
+                        " ".join(self.REFERENCE_FIELDS))
+            response = self._execute(query)
+            if response.get("errors"):
+                raise ValueError(f"Could not fetch references: "
+                                 f"{response['errors']}")
+            page = response["data"]["work"]["references"]
+            references.extend(page)
+            if len(page) < self.PAGE_SIZE:
+                break
+            offset += self.PAGE_SIZE
+        return sorted(references, key=lambda r: r["referenceOrdinal"])
+
+    def iter_references(self) -> dict:
+        """Yield every reference stored in the repository, whatever the
+           work it is attached to"""
+        offset = 0
+        while True:
+            query = '{ references(limit: %d, offset: %d) { %s } }' % (
+                self.PAGE_SIZE, offset, " ".join(self.REFERENCE_FIELDS))
+            response = self._execute(query)
+            if response.get("errors"):
+                raise ValueError(f"Could not fetch references: "
+                                 f"{response['errors']}")
+            page = response["data"]["references"]
+            yield from page
+            if len(page) < self.PAGE_SIZE:
+                break
+            offset += self.PAGE_SIZE
+
+    def sync_records(self, citations: list, batch_size: int = 50,
+                     callback: callable = None) -> tuple:
+        """Incremental alternative to write_records: fetch the references
+           already in the repository and only send the creates, updates
+           and deletes needed to match citations (numbered from 1).
+
+           Existing and new references are aligned on their identity (see
+           _reference_key), so inserting or removing a citation does not
+           recreate the following ones. Mutations are sent in an order that
+           never assigns an ordinal still in use: deletes, then updates
+           moving references down, then updates moving them up, then
+           creates. As ordering matters, requests are sent one at a time.
+
+           Return a (failures, delete_failures, stats) tuple: failures is a
+           dictionary of (new) ordinal -> error message, delete_failures a
+           dictionary of referenceId -> error message for the existing
+           references that could not be deleted, and stats counts the
+           created, updated, deleted and unchanged references."""
+        references = [self._get_reference(citation, ordinal, self.identifier)
+                      for ordinal, citation in enumerate(citations, start=1)]
+        existing = self.get_records()
+
+        creates, updates, deletes = [], [], []
+        unchanged = 0
+        matcher = difflib.SequenceMatcher(
+            None, [self._reference_key(r) for r in existing],
+            [self._reference_key(r) for r in references], autojunk=False)
+        for _, i1, i2, j1, j2 in matcher.get_opcodes():
+            old, new = existing[i1:i2], references[j1:j2]
+            for old_ref, new_ref in zip(old, new):
+                if self._is_same_reference(old_ref, new_ref):
+                    unchanged += 1
+                else:
+                    updates.append(dict(
+                        new_ref, referenceId=old_ref["referenceId"],
+                        oldOrdinal=old_ref["referenceOrdinal"]))
+            deletes.extend(old[len(new):])
+            creates.extend(new[len(old):])
+
+        down = sorted((u for u in updates
+                       if u["referenceOrdinal"] <= u["oldOrdinal"]),
+                      key=lambda u: u["referenceOrdinal"])
+        up = sorted((u for u in updates
+                     if u["referenceOrdinal"] > u["oldOrdinal"]),
+                    key=lambda u: u["referenceOrdinal"], reverse=True)
+        operations = \
+            [(f"del{n}", "deleteReference",
+              {"referenceId": r["referenceId"]})
+             for n, r in enumerate(deletes)] + \
+            [(f"upd{u['referenceOrdinal']}", "updateReference", u)
+             for u in down + up] + \
+            [(f"ref{r['referenceOrdinal']}", "createReference", r)
+             for r in creates]
+
+        failures, delete_failures = {}, {}
+        for i in range(0, len(operations), batch_size):
+            batch = {alias: (name, data)
+                     for alias, name, data in operations[i:i + batch_size]}
+            for alias, error in self._run_mutations(batch).items():
+                if alias.startswith("del"):
+                    reference_id = deletes[int(alias[3:])]["referenceId"]
+                    delete_failures[reference_id] = error
+                else:
+                    failures[int(alias[3:])] = error
+            if callback is not None:
+                callback(len(batch))
+
+        stats = {"created": len(creates), "updated": len(updates),
+                 "deleted": len(deletes), "unchanged": unchanged}
+        return failures, delete_failures, stats
+
+    @staticmethod
+    def _reference_key(reference: dict) -> str:
+        """Return the identity of a reference: its DOI or, failing that, a
+           hash of its unstructured citation (case and whitespace
+           insensitive)"""
+        if reference.get("doi"):
+            return reference["doi"].lower()
+        text = " ".join((reference.get("unstructuredCitation") or "")
+                        .lower().split())
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    @classmethod
+    def _is_same_reference(cls, old: dict, new: dict) -> bool:
+        """Test whether two references have the same field values"""
+        def value(reference, field):
+            v = reference.get(field)
+            return None if v is None or v == "" else str(v)
+        return all(value(old, field) == value(new, field)
+                   for field in cls.REFERENCE_FIELDS)
+
+    def _run_mutations(self, operations: dict) -> dict:
+        """Send several mutations in one GraphQL document. operations is a
+           dictionary of alias -> (mutation name, data). Return a dictionary
+           of alias -> error message for the mutations that failed."""
+        document = "mutation {\n%s\n}" % "\n".join(
+            self._aliased_mutation(alias, name, data)
+            for alias, (name, data) in operations.items())
+        try:
+            response = self._execute(document)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return {alias: str(e) for alias in operations}
+
+        errors = {}
+        for error in response.get("errors", []):
+            path = error.get("path") or []
+            message = error.get("message", str(error))
+            if path and path[0] in operations:
+                errors[path[0]] = message
+            else:
+                # errors not bound to a field invalidate the whole document
+                return {alias: message for alias in operations}
+        data = response.get("data") or {}
+        for alias in operations:
+            if alias not in errors and data.get(alias) is None:
+                errors[alias] = "No data returned"
+        return errors
+
+    @staticmethod
+    def _aliased_mutation(alias: str, mutation_name: str, data: dict) -> str:
+        """Return a thothlibrary mutation as an aliased GraphQL field"""
+        mutation = ThothMutation(mutation_name, data)
+        spec = mutation.spec
+        if "data_fields" in spec:
+            arguments = "data: {%s}" % mutation.generate_values(
+                spec["data_fields"], data).replace("\n", ", ")
         else:
-            self.client.create_reference(reference)
+            arguments = mutation.generate_values(
+                spec["flat_fields"], data).replace("\n", ", ")
+        return f"{alias}: {mutation_name}({arguments}) " \
+               f"{{ {spec['return_value']} }}"
+
+    @backoff.on_exception(backoff.expo,
+                          requests.exceptions.RequestException,
+                          max_time=120, max_tries=5,
+                          giveup=is_permanent_error)
+    def _execute(self, query: str) -> dict:
+        """Send a GraphQL document to Thoth and return the decoded
+           response. Transient errors (connection errors, 429 and 5xx
+           responses) are retried with exponential backoff; others are
+           raised as requests.exceptions.RequestException."""
+        r = self.session.post(self.client.graphql_endpoint,
+                              json={"query": query}, timeout=self.TIMEOUT)
+        r.raise_for_status()
+        return r.json()
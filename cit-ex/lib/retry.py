@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import requests
+
+
+def is_permanent_error(e: requests.exceptions.RequestException) -> bool:
+    """Giveup predicate of the backoff decorators of cit-ex requests: only
+       connection errors, timeouts, 429 Too Many Requests and server errors
+       are worth retrying"""
+    if isinstance(e, requests.exceptions.HTTPError):
+        status = e.response.status_code if e.response is not None else None
+        return status is None or (status < 500 and status != 429)
+    return not isinstance(e, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tarfile
+import threading
+import zlib
+
+DUMP_SUFFIXES = (".json", ".jsonl", ".json.gz", ".jsonl.gz")
+
+
+def _unwrap(record: dict) -> dict:
+    """Yield the works of a dump record: a work, an API response
+       ({"message": ...}) or a list of works ({"items": [...]})"""
+    record = record.get("message", record)
+    if "items" in record:
+        yield from record["items"]
+    elif record.get("DOI"):
+        yield record
+
+
+def _read_stream(name: str, stream: io.BufferedIOBase) -> dict:
+    """Yield the works of a (possibly gzipped) dump file. JSON lines files
+       are read one line at a time; other files hold a single JSON
+       document (e.g. a file of the Crossref public data file)."""
+    if name.endswith(".gz"):
+        stream = gzip.GzipFile(fileobj=stream)
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    if name.endswith((".jsonl", ".jsonl.gz")):
+        for line in text:
+            if line.strip():
+                yield from _unwrap(json.loads(line))
+    else:
+        yield from _unwrap(json.load(text))
+
+
+def read_dump(path: str) -> dict:
+    """Yield the works of a Crossref metadata dump: a JSON or JSON lines
+       file (possibly gzipped), a tar archive of such files (e.g. the
+       Crossref public data file) or a directory of them. Files are
+       streamed, so memory use does not depend on the size of the dump."""
+    if os.path.isdir(path):
+        for directory, _, files in sorted(os.walk(path)):
+            for name in sorted(files):
+                if name.endswith(DUMP_SUFFIXES):
+                    yield from read_dump(os.path.join(directory, name))
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path, "r|*") as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(DUMP_SUFFIXES):
+                    yield from _read_stream(member.name,
+                                            tar.extractfile(member))
+    else:
+        with open(path, "rb") as stream:
+            yield from _read_stream(path, stream)
+
+
+class CrossrefSnapshot:
+    """Local store of Crossref works imported from a metadata dump (see
+       read_dump), to resolve DOIs without querying Crossref.
+
+       Works are stored as compressed JSON in a SQLite table keyed by
+       normalised DOI (see refine.normalise_doi), so that each lookup is a
+       single primary key search."""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS works ("
+                        "doi TEXT PRIMARY KEY, "
+                        "data BLOB NOT NULL) WITHOUT ROWID")
+        self.db.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM works").fetchone()[0]
+
+    def get(self, doi: str) -> dict:
+        """Return the work of (normalised) doi, or None if it is not in the
+           snapshot"""
+        with self.lock:
+            row = self.db.execute("SELECT data FROM works WHERE doi = ?",
+                                  (doi,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def add_works(self, works: iter, batch_size: int = 1000,
+                  callback: callable = None) -> int:
+        """Store the (doi, work) tuples of works, replacing the works
+           already stored, batch_size at a time. callback, if given, is
+           called with the size of each batch. Return the number of works
+           stored."""
+        count = 0
+        batch = []
+        for doi, work in works:
+            batch.append((doi, zlib.compress(json.dumps(work).encode())))
+            if len(batch) >= batch_size:
+                count += self._insert(batch, callback)
+                batch = []
+        if batch:
+            count += self._insert(batch, callback)
+        return count
+
+    def iter_works(self) -> tuple:
+        """Yield the (doi, work) tuples of the stored works"""
+        with self.lock:
+            cursor = self.db.cursor()
+        for doi, data in cursor.execute("SELECT doi, data FROM works"):
+            yield doi, json.loads(zlib.decompress(data))
+
+    def close(self) -> None:
+        """Close the underlying database"""
+        with self.lock:
+            self.db.close()
+
+    def _insert(self, batch: list, callback: callable = None) -> int:
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO works (doi, data) "
+                                "VALUES (?, ?)", batch)
+            self.db.commit()
+        if callback is not None:
+            callback(len(batch))
+        return len(batch)
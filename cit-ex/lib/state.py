@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+class StateStore:
+    """Persistent record of the input documents already processed, stored
+       in a SQLite database.
+
+       Each document is recorded under a key (e.g. the work identifier)
+       with a hash of its content and the outcome of the run: the number
+       of citations extracted and the number of references that could not
+       be written. A document is unchanged when its hash matches that of
+       the last run and that run wrote every reference."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents ("
+                        "key TEXT PRIMARY KEY, "
+                        "hash TEXT NOT NULL, "
+                        "citations INTEGER NOT NULL, "
+                        "failures INTEGER NOT NULL, "
+                        "updated REAL NOT NULL)")
+        self.db.commit()
+
+    @staticmethod
+    def digest(content: bytes, *params: str) -> str:
+        """Return the hash of content and of the parameters that affect
+           its processing (e.g. the citation classes)"""
+        sha = hashlib.sha256(content)
+        for param in params:
+            sha.update(b"\0" + str(param).encode())
+        return sha.hexdigest()
+
+    def get(self, key: str) -> dict:
+        """Return the record of key, or None if it was never processed"""
+        with self.lock:
+            row = self.db.execute("SELECT hash, citations, failures, updated "
+                                  "FROM documents WHERE key = ?",
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("hash", "citations", "failures", "updated"), row))
+
+    def is_unchanged(self, key: str, digest: str) -> bool:
+        """Return True if the document of key was last processed with the
+           same digest and all its references were written"""
+        record = self.get(key)
+        return record is not None and record["hash"] == digest \
+            and record["failures"] == 0
+
+    def record(self, key: str, digest: str, citations: int,
+               failures: int = 0) -> None:
+        """Store the outcome of processing the document of key"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO documents "
+                            "(key, hash, citations, failures, updated) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (key, digest, citations, failures, time.time()))
+            self.db.commit()
+
+    def close(self) -> None:
+        """Close the underlying database"""
+        with self.lock:
+            self.db.close()
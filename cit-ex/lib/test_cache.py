@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import pytest
+
+from cache import CrossrefCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = CrossrefCache(str(tmp_path / "cache" / "crossref.sqlite3"))
+    yield cache
+    cache.close()
+
+
+def test_cache_miss(cache):
+    assert cache.get("10.123/abc") == (False, None)
+    assert cache.misses == 1
+
+
+def test_cache_hit(cache):
+    cache.set("10.123/abc", {"DOI": "10.123/abc", "title": ["Foo"]})
+    assert cache.get("10.123/abc") == \
+        (True, {"DOI": "10.123/abc", "title": ["Foo"]})
+    assert cache.hits == 1
+
+
+def test_cache_negative_hit(cache):
+    cache.set("10.123/abc", None)
+    assert cache.get("10.123/abc") == (True, None)
+
+
+def test_cache_is_persistent(tmp_path):
+    path = str(tmp_path / "crossref.sqlite3")
+    cache = CrossrefCache(path)
+    cache.set("10.123/abc", {"DOI": "10.123/abc"})
+    cache.close()
+
+    cache = CrossrefCache(path)
+    assert cache.get("10.123/abc") == (True, {"DOI": "10.123/abc"})
+    assert cache.size > 0
+    cache.close()
+
+
+@pytest.mark.parametrize("work, age, expected_result",
+                         [[{"DOI": "10.123/abc"}, 29, True],
+                          [{"DOI": "10.123/abc"}, 31, False],
+                          [None, 0.5, True],
+                          [None, 2, False]])
+def test_cache_expiry(cache, mocker, work, age, expected_result):
+    now = 1_000_000_000.0
+    clock = mocker.patch("cache.time.time", return_value=now)
+    cache.set("10.123/abc", work)
+    clock.return_value = now + age * CrossrefCache.DAY
+    assert cache.get("10.123/abc")[0] is expected_result
+
+
+def test_cache_overwrite_keeps_size(cache):
+    cache.set("10.123/abc", {"DOI": "10.123/abc"})
+    size = cache.size
+    cache.set("10.123/abc", {"DOI": "10.123/abc"})
+    assert cache.size == size
+
+
+def test_cache_lru_eviction(cache, mocker):
+    clock = mocker.patch("cache.time.time", return_value=1.0)
+    work = {"title": ["Foo Bar " * 10]}
+    cache.set("a", work)
+    cache.max_size = 2 * cache.size
+    clock.return_value = 2.0
+    cache.set("b", work)
+    clock.return_value = 3.0
+    cache.get("a")
+    clock.return_value = 4.0
+    cache.set("c", work)
+
+    assert cache.get("b") == (False, None)
+    assert cache.get("a")[0] is True
+    assert cache.get("c")[0] is True
+    assert cache.size <= cache.max_size
+
+
+def test_cache_iter_works(cache):
+    cache.set("10.123/abc", {"DOI": "10.123/abc"})
+    cache.set("10.123/def", None)
+    assert list(cache.iter_works()) == [("10.123/abc", {"DOI": "10.123/abc"})]
+
+
+def test_cache_hits_do_not_write(cache):
+    cache.set("10.123/abc", {"DOI": "10.123/abc"})
+    changes = cache.db.total_changes
+    for _ in range(10):
+        assert cache.get("10.123/abc")[0] is True
+    assert cache.db.total_changes == changes
+
+
+def test_cache_flushes_access_times(tmp_path, mocker):
+    clock = mocker.patch("cache.time.time", return_value=1.0)
+    cache_path = str(tmp_path / "crossref.sqlite3")
+    cache = CrossrefCache(cache_path)
+    cache.FLUSH_SIZE = 2
+    for doi in ["a", "b", "c"]:
+        cache.set(doi, {"DOI": doi})
+    clock.return_value = 2.0
+    cache.get("a")
+    cache.get("b")
+    # every FLUSH_SIZE hits
+    assert cache.accessed == {}
+    clock.return_value = 3.0
+    cache.get("c")
+    # and on close
+    cache.close()
+
+    cache = CrossrefCache(cache_path)
+    assert dict(cache.db.execute("SELECT doi, accessed FROM works")) == \
+        {"a": 2.0, "b": 2.0, "c": 3.0}
+    cache.close()
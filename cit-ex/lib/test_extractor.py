@@ -15,10 +15,14 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import io
+import zipfile
+
 from ebooklib import epub
 import pytest
 
-from extractor import Extractor
+from extractor import BACKENDS, Bs4Backend, DocumentCache, EpubStream, \
+    Extractor, LxmlBackend
 
 
 @pytest.fixture
@@ -66,6 +70,32 @@ def test_get_book_raise_EpubException(dummy_epub):
         _ = Extractor(open(dummy_epub))
 
 
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_extractor_backend(dummy_epub, backend):
+    ex = Extractor(dummy_epub, backend=backend)
+    assert ex.backend.name == backend
+    assert ex.extract_citations(["citation"]) == ["This citation"]
+
+
+def test_extractor_unknown_backend(dummy_epub):
+    with pytest.raises(ValueError):
+        _ = Extractor(dummy_epub, backend="FooBar")
+
+
+def test_extractor_cache_size(dummy_epub):
+    ex = Extractor(dummy_epub, cache_size=1024)
+    assert ex.cache.max_size == 1024
+
+
+def test_extractor_cache_is_opt_in(dummy_epub):
+    # a single extraction never hits the cache: trees are not kept
+    ex = Extractor(dummy_epub)
+    list(ex.iter_citations(["biblio"]))
+    assert ex.cache.max_size == 0
+    assert len(ex.cache) == 0
+    assert Extractor.from_html(b"<p>Foo</p>").cache.max_size == 0
+
+
 def test_get_docs(dummy_epub):
     book = Extractor(dummy_epub)
     chapters = Extractor._get_docs(book)
@@ -83,9 +113,12 @@ def dummy_chapter():
     yield ch1
 
 
-class MockExtractor:
-    def __init__(self, *dummy_chapter):
+class MockExtractor(Extractor):
+    def __init__(self, *dummy_chapter, cache_size=DocumentCache.DEFAULT_SIZE,
+                 backend="lxml"):
         self.docs = list(dummy_chapter)
+        self.cache = DocumentCache(cache_size)
+        self.backend = BACKENDS[backend]()
 
 
 def test_exctract_cit_w_good_input(dummy_chapter):
@@ -97,3 +130,265 @@ def test_exctract_cit_w_good_input(dummy_chapter):
 def test_exctract_cit_w_bad_input(dummy_chapter, input):
     book = MockExtractor(dummy_chapter)
     assert Extractor.exctract_cit(book, input) == []
+
+
+@pytest.fixture
+def dummy_chapters():
+    book = epub.EpubBook()
+
+    ch1 = epub.EpubHtml(title="Ch1", file_name="ch1.xhtml", lang="en-gb")
+    ch1.content = "<p class='first'>A</p><p class='other'>B</p>" + \
+                  "<p class='first'>C</p>"
+    ch2 = epub.EpubHtml(title="Ch2", file_name="ch2.xhtml", lang="en-gb")
+    ch2.content = "<p class='other'>D</p><p class='first other'>E</p>"
+    book.add_item(ch1)
+    book.add_item(ch2)
+    yield ch1, ch2
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_extract_citations_document_order(dummy_chapters, backend):
+    book = MockExtractor(*dummy_chapters, backend=backend)
+    assert book.extract_citations(["first", "other"]) == \
+        ["A", "B", "C", "D", "E"]
+
+
+def test_extract_citations_single_class(dummy_chapters):
+    book = MockExtractor(*dummy_chapters)
+    assert book.extract_citations(["other"]) == ["B", "D", "E"]
+
+
+@pytest.mark.parametrize("input", [[], [""], "", ["FooBar"]])
+def test_extract_citations_w_bad_input(dummy_chapters, input):
+    book = MockExtractor(*dummy_chapters)
+    assert book.extract_citations(input) == []
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_extract_citations_parses_each_doc_once(dummy_chapters, backend,
+                                                mocker):
+    book = MockExtractor(*dummy_chapters, backend=backend)
+    spy = mocker.spy(book.backend, "parse")
+    book.extract_citations(["first", "other", "FooBar"])
+    assert spy.call_count == len(dummy_chapters)
+
+
+def test_extract_citations_reuses_cached_trees(dummy_chapters, mocker):
+    book = MockExtractor(*dummy_chapters)
+    spy = mocker.spy(book.backend, "parse")
+    first = book.extract_citations(["first"])
+    second = book.extract_citations(["first", "other"])
+    assert first == ["A", "C", "E"]
+    assert second == ["A", "B", "C", "D", "E"]
+    assert spy.call_count == len(dummy_chapters)
+    assert book.cache.hits == 2
+    assert book.cache.misses == 2
+
+
+def test_extract_citations_w_disabled_cache(dummy_chapters, mocker):
+    book = MockExtractor(*dummy_chapters, cache_size=0)
+    spy = mocker.spy(book.backend, "parse")
+    book.extract_citations(["first"])
+    book.extract_citations(["first"])
+    assert spy.call_count == 2 * len(dummy_chapters)
+    assert len(book.cache) == 0
+
+
+def test_document_cache_key_changes_w_content(dummy_chapter):
+    key = DocumentCache.key(dummy_chapter)
+    assert key[0] == dummy_chapter.get_id()
+    dummy_chapter.content = "<p class='citation'>Other citation</p>"
+    assert DocumentCache.key(dummy_chapter) != key
+
+
+def test_document_cache_lru_eviction():
+    cache = DocumentCache(max_size=20 * DocumentCache.TREE_OVERHEAD)
+    cache.put("a", "tree a", 10)
+    cache.put("b", "tree b", 10)
+    assert cache.get("a") == "tree a"
+    cache.put("c", "tree c", 10)
+    assert cache.get("b") is None
+    assert cache.get("a") == "tree a"
+    assert cache.get("c") == "tree c"
+    assert cache.size == 20 * DocumentCache.TREE_OVERHEAD
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_document_cache_skips_oversized_trees():
+    cache = DocumentCache(max_size=DocumentCache.TREE_OVERHEAD)
+    cache.put("a", "tree a", 2)
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_document_cache_clear():
+    cache = DocumentCache()
+    cache.put("a", "tree a", 10)
+    cache.get("a")
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.size == 0
+    assert cache.hits == 1
+
+
+@pytest.fixture
+def messy_chapter():
+    book = epub.EpubBook()
+
+    ch1 = epub.EpubHtml(title="Ch1", file_name="ch1.xhtml", lang="en-gb")
+    ch1.content = "<div><p class='bib\tfoo'>Caf\u00e9 <i>Bar</i> &amp; " + \
+                  "<!-- comment -->Baz<style>.a{}</style>" + \
+                  "<script>var a;</script><p class='bib'>Nested " + \
+                  "<span class='bib'>span</span></p></p>" + \
+                  "<p class='bibliography'>Not this one</p></div>"
+    book.add_item(ch1)
+    yield ch1
+
+
+def test_backends_return_the_same_text(messy_chapter):
+    results = [MockExtractor(messy_chapter, backend=backend)
+               .extract_citations(["bib"]) for backend in BACKENDS]
+    assert results[0] == results[1]
+    assert results[0][0] == "Caf\u00e9 Bar & Baz"
+
+
+def test_lxml_backend_falls_back_to_bs4():
+    backend = LxmlBackend()
+    tree = backend.parse(b"")
+    assert tree.__class__.__name__ == "BeautifulSoup"
+    assert backend.find(tree, ["citation"]) == []
+
+
+def test_lxml_backend_compiles_xpath_once():
+    LxmlBackend._class_xpath.cache_clear()
+    backend = LxmlBackend()
+    for markup in [b"<p class='a'>A</p>", b"<p class='b'>B</p>"]:
+        backend.find(backend.parse(markup), ["a", "b"])
+    assert LxmlBackend._class_xpath.cache_info().misses == 1
+
+
+def test_bs4_backend_find():
+    backend = Bs4Backend()
+    tree = backend.parse(b"<p class='a'>A</p><p class='b'>B</p>")
+    assert backend.find(tree, ["b"]) == ["B"]
+
+
+@pytest.fixture
+def dummy_epub_w_spine(tmp_path):
+    book = epub.EpubBook()
+
+    ch1 = epub.EpubHtml(title="Ch1", file_name="text/ch 1.xhtml",
+                        lang="en-gb")
+    ch1.content = "<p class='citation'>First</p>"
+    ch2 = epub.EpubHtml(title="Ch2", file_name="text/ch2.xhtml",
+                        lang="en-gb")
+    ch2.content = "<p class='citation'>Second</p>"
+    img = epub.EpubItem(uid="img", file_name="img/cover.jpg",
+                        media_type="image/jpeg", content=b"\xff\xd8")
+    for item in [ch1, ch2, img]:
+        book.add_item(item)
+
+    book.toc = (ch1, ch2)
+    book.spine = ["nav", ch2, ch1]
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+
+    file_path = tmp_path / "spine.epub"
+    epub.write_epub(file_path, book, {})
+
+    yield file_path
+
+
+def test_epub_stream_reads_xhtml_docs_in_spine_order(dummy_epub_w_spine):
+    stream = EpubStream(dummy_epub_w_spine)
+    assert len(stream) == 2
+    assert [doc.get_name() for doc in stream] == \
+        ["text/ch2.xhtml", "text/ch 1.xhtml"]
+
+
+def test_epub_stream_is_lazy(dummy_epub_w_spine, mocker):
+    spy = mocker.spy(zipfile.ZipFile, "read")
+    docs = iter(EpubStream(dummy_epub_w_spine))
+    read_upfront = spy.call_count
+    next(docs)
+    assert spy.call_count == read_upfront + 1
+    read_paths = [c.args[1] for c in spy.call_args_list]
+    assert "EPUB/img/cover.jpg" not in read_paths
+
+
+def test_epub_stream_w_manifest_only(dummy_epub):
+    assert [doc.get_name() for doc in EpubStream(dummy_epub)] == \
+        ["ch1.xhtml"]
+
+
+def test_epub_stream_raise_EpubException(tmp_path):
+    not_an_epub = tmp_path / "file.epub"
+    not_an_epub.write_text("Foo Bar")
+    with pytest.raises(epub.EpubException):
+        _ = EpubStream(not_an_epub)
+
+
+@pytest.mark.parametrize("input", ["", "/foo/bar.epub"])
+def test_extractor_stream_raise_FileNotFoundError(input):
+    with pytest.raises(FileNotFoundError):
+        _ = Extractor(input, stream=True)
+
+
+def test_extractor_stream(dummy_epub_w_spine):
+    ex = Extractor(dummy_epub_w_spine, stream=True)
+    assert ex.book is None
+    citations = ex.iter_citations(["citation"])
+    assert next(citations) == "Second"
+    assert list(citations) == ["First"]
+    assert ex.extract_citations(["citation"]) == ["Second", "First"]
+
+
+@pytest.mark.parametrize("stream, jobs", [(False, 1), (False, 2),
+                                          (True, 1), (True, 2)])
+def test_extractor_follows_spine_order(dummy_epub_w_spine, stream, jobs):
+    # the manifest lists ch1 first, the spine ch2
+    ex = Extractor(dummy_epub_w_spine, stream=stream)
+    assert ex.extract_citations(["citation"], jobs=jobs) == \
+        ["Second", "First"]
+
+
+def test_get_docs_appends_docs_missing_from_spine(dummy_epub_w_spine):
+    ex = Extractor(dummy_epub_w_spine)
+    assert [doc.get_id() for doc in ex._get_docs()] == \
+        ["chapter_1", "chapter_0"]
+    ex.book.spine = [("nav", "yes"), ("chapter_0", "yes")]
+    assert [doc.get_id() for doc in ex._get_docs()] == \
+        ["chapter_0", "chapter_1"]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_extract_citations_parallel(dummy_chapters, backend):
+    book = MockExtractor(*dummy_chapters, backend=backend)
+    assert book.extract_citations(["first", "other"], jobs=2) == \
+        book.extract_citations(["first", "other"])
+
+
+def test_extract_citations_parallel_w_stream(dummy_epub_w_spine):
+    ex = Extractor(dummy_epub_w_spine, stream=True)
+    assert ex.extract_citations(["citation"], jobs=3) == ["Second", "First"]
+
+
+def test_extract_citations_parallel_w_bad_input(dummy_chapters):
+    book = MockExtractor(*dummy_chapters)
+    assert book.extract_citations([""], jobs=2) == []
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_extractor_from_html(backend):
+    html = b"<html><body><p class='first'>A</p>" \
+           b"<p class='other'>B \xc3\xa9</p></body></html>"
+    book = Extractor.from_html(html, io.BytesIO(html),
+                               "<p class='first'>C</p>", backend=backend)
+    assert book.book is None
+    assert book.extract_citations(["first", "other"]) == \
+        ["A", "B é", "A", "B é", "C"]
+
+
+def test_extractor_from_html_w_bad_backend():
+    with pytest.raises(ValueError):
+        Extractor.from_html(b"<p>A</p>", backend="FooBar")
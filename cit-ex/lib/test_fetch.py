@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import threading
+import time
+
+import pytest
+import requests
+
+from fetch import HtmlFetcher, HtmlMirror
+
+
+class MockResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = HtmlFetcher(max_workers=4)
+    yield fetcher
+    fetcher.close()
+
+
+def test_fetch(fetcher, mocker):
+    get = mocker.patch.object(fetcher.session, "get",
+                              return_value=MockResponse(200, b"<p>A</p>"))
+    assert fetcher.fetch("https://example.org/ch1.xhtml") == b"<p>A</p>"
+    assert get.call_args.kwargs["headers"] == {}
+
+
+def test_fetch_conditional_request(mirror, mocker):
+    fetcher = HtmlFetcher(mirror=mirror)
+    get = mocker.patch.object(fetcher.session, "get", side_effect=[
+        MockResponse(200, b"<p>A</p>",
+                     {"ETag": '"abc"',
+                      "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT"}),
+        MockResponse(304)])
+    url = "https://example.org/10.123/ch1.xhtml"
+    assert fetcher.fetch(url) == b"<p>A</p>"
+    assert fetcher.fetch(url) == b"<p>A</p>"
+    assert get.call_args.kwargs["headers"] == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Wed, 01 Jan 2025 00:00:00 GMT"}
+    fetcher.close()
+
+
+def test_fetch_keeps_no_pages_in_memory(fetcher, mocker):
+    get = mocker.patch.object(
+        fetcher.session, "get",
+        return_value=MockResponse(200, b"<p>A</p>", {"ETag": '"abc"'}))
+    url = "https://example.org/ch1.xhtml"
+    assert fetcher.fetch(url) == b"<p>A</p>"
+    assert fetcher.fetch(url) == b"<p>A</p>"
+    # without a mirror, nothing is kept to revalidate
+    assert get.call_args.kwargs["headers"] == {}
+
+
+def test_fetch_retries_server_errors(fetcher, mocker):
+    mocker.patch("time.sleep")
+    get = mocker.patch.object(fetcher.session, "get", side_effect=[
+        requests.exceptions.ConnectionError(), MockResponse(503),
+        MockResponse(200, b"<p>A</p>")])
+    assert fetcher.fetch("https://example.org/ch1.xhtml") == b"<p>A</p>"
+    assert get.call_count == 3
+
+
+def test_fetch_gives_up_on_client_errors(fetcher, mocker):
+    get = mocker.patch.object(fetcher.session, "get",
+                              return_value=MockResponse(404))
+    with pytest.raises(requests.exceptions.HTTPError):
+        fetcher.fetch("https://example.org/ch1.xhtml")
+    assert get.call_count == 1
+
+
+def test_fetch_all_yields_as_completed(fetcher, mocker):
+    def get(url, **kwargs):
+        # finish later pages first
+        time.sleep((4 - int(url[-1])) / 100)
+        return MockResponse(200, url.encode())
+
+    mocker.patch.object(fetcher.session, "get", side_effect=get)
+    urls = [f"https://example.org/ch{i}" for i in range(1, 4)]
+    assert list(fetcher.fetch_all(urls)) == \
+        [(url, url.encode()) for url in reversed(urls)]
+
+
+def test_fetch_all_limits_concurrency(fetcher, mocker):
+    in_flight = []
+    lock = threading.Lock()
+    active = 0
+
+    def get(url, **kwargs):
+        nonlocal active
+        with lock:
+            active += 1
+            in_flight.append(active)
+        time.sleep(0.01)
+        with lock:
+            active -= 1
+        return MockResponse(200, b"")
+
+    mocker.patch.object(fetcher.session, "get", side_effect=get)
+    urls = [f"https://example.org/ch{i}" for i in range(12)]
+    assert len(list(fetcher.fetch_all(urls))) == 12
+    assert max(in_flight) <= 4
+
+
+def test_fetch_all_w_optional_pages(fetcher, mocker):
+    def get(url, **kwargs):
+        if "bibliography" in url:
+            return MockResponse(404)
+        return MockResponse(200, b"<p>A</p>")
+
+    mocker.patch.object(fetcher.session, "get", side_effect=get)
+    urls = ["https://example.org/ch1.xhtml",
+            "https://example.org/bibliography.xhtml"]
+    assert dict(fetcher.fetch_all(urls, optional=urls[1:])) == \
+        {urls[0]: b"<p>A</p>", urls[1]: None}
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        list(fetcher.fetch_all(urls))
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    return HtmlMirror(str(tmp_path / "html"))
+
+
+def test_mirror_layout(mirror, tmp_path):
+    url = "https://doi.org/10.11647/obp.0085/ch1.xhtml"
+    assert mirror.path(url) == \
+        str(tmp_path / "html" / "obp.0085" / "ch1.xhtml")
+    assert mirror.get(url) is None
+
+    mirror.put(url, {"etag": '"abc"', "last_modified": None, "fetched": 1,
+                     "content": b"<p>A</p>"})
+    assert (tmp_path / "html" / "obp.0085" / "ch1.xhtml").read_bytes() == \
+        b"<p>A</p>"
+    assert mirror.get(url) == {"etag": '"abc"', "last_modified": None,
+                               "fetched": 1, "content": b"<p>A</p>"}
+
+
+def test_mirror_w_copied_page(mirror, tmp_path):
+    (tmp_path / "html" / "obp.0085").mkdir(parents=True)
+    (tmp_path / "html" / "obp.0085" / "ch1.xhtml").write_bytes(b"<p>A</p>")
+    page = mirror.get("https://doi.org/10.11647/obp.0085/ch1.xhtml")
+    assert page["content"] == b"<p>A</p>"
+    assert page["fetched"] == 0
+
+
+def test_fetch_stores_pages_in_mirror(mirror, mocker):
+    url = "https://doi.org/10.11647/obp.0085/ch1.xhtml"
+    fetcher = HtmlFetcher(mirror=mirror)
+    get = mocker.patch.object(fetcher.session, "get", side_effect=[
+        MockResponse(200, b"<p>A</p>", {"ETag": '"abc"'}),
+        MockResponse(304)])
+    assert fetcher.fetch(url) == b"<p>A</p>"
+    fetcher.close()
+
+    # a later run revalidates the mirrored page
+    fetcher = HtmlFetcher(mirror=mirror)
+    mocker.patch.object(fetcher.session, "get", get)
+    assert fetcher.fetch(url) == b"<p>A</p>"
+    assert get.call_args.kwargs["headers"] == {"If-None-Match": '"abc"'}
+    fetcher.close()
+
+
+def test_fetch_skips_fresh_pages(mirror, mocker):
+    url = "https://doi.org/10.11647/obp.0085/ch1.xhtml"
+    mirror.put(url, {"etag": None, "last_modified": None,
+                     "fetched": time.time() - 60, "content": b"<p>A</p>"})
+    fetcher = HtmlFetcher(mirror=mirror, max_age=3600)
+    get = mocker.patch.object(fetcher.session, "get",
+                              return_value=MockResponse(200, b"<p>B</p>"))
+    assert fetcher.fetch(url) == b"<p>A</p>"
+    get.assert_not_called()
+
+    fetcher.max_age = 30
+    assert fetcher.fetch(url) == b"<p>B</p>"
+    assert mirror.get(url)["content"] == b"<p>B</p>"
+    fetcher.close()
+
+
+def test_fetch_offline(mirror, mocker):
+    url = "https://doi.org/10.11647/obp.0085/ch1.xhtml"
+    mirror.put(url, {"etag": None, "last_modified": None, "fetched": 0,
+                     "content": b"<p>A</p>"})
+    fetcher = HtmlFetcher(mirror=mirror, offline=True)
+    get = mocker.patch.object(fetcher.session, "get")
+    missing = "https://doi.org/10.11647/obp.0085/bibliography.xhtml"
+    assert dict(fetcher.fetch_all([url, missing], optional=[missing])) == \
+        {url: b"<p>A</p>", missing: None}
+    with pytest.raises(FileNotFoundError):
+        fetcher.fetch(missing)
+    get.assert_not_called()
+    fetcher.close()
+
+
+def test_fetch_all_limits_concurrency_across_threads(fetcher, mocker):
+    in_flight = []
+    lock = threading.Lock()
+    active = 0
+
+    def get(url, **kwargs):
+        nonlocal active
+        with lock:
+            active += 1
+            in_flight.append(active)
+        time.sleep(0.01)
+        with lock:
+            active -= 1
+        return MockResponse(200, b"")
+
+    mocker.patch.object(fetcher.session, "get", side_effect=get)
+
+    def fetch_book(book):
+        urls = [f"https://example.org/{book}/ch{i}" for i in range(8)]
+        assert len(list(fetcher.fetch_all(urls))) == 8
+
+    threads = [threading.Thread(target=fetch_book, args=(book,))
+               for book in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(in_flight) == 24
+    assert max(in_flight) <= 4
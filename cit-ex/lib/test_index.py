@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import pytest
+
+from index import BibliographicIndex, confidence, reference_text, work_text
+
+WORK = {"DOI": "10.123/abc",
+        "title": ["The Making of the English Working Class"],
+        "author": [{"given": "E. P.", "family": "Thompson"}],
+        "container-title": [],
+        "issued": {"date-parts": [[1963, 1, 1]]}}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = BibliographicIndex(str(tmp_path / "cache" / "index.sqlite3"))
+    yield index
+    index.close()
+
+
+def test_work_text():
+    assert work_text(WORK) == \
+        "The Making of the English Working Class Thompson 1963"
+    assert work_text({"title": ["Foo"], "issued": {"date-parts": [[None]]}}) \
+        == "Foo"
+
+
+def test_reference_text():
+    assert reference_text({"unstructuredCitation": "Foo, Bar (2001)",
+                           "articleTitle": None}) == "Foo, Bar (2001)"
+    assert reference_text({"unstructuredCitation": "Foo, Bar (2001)",
+                           "author": "Foo", "articleTitle": "Bar",
+                           "journalTitle": "Baz",
+                           "publicationDate": "2001-01-01"}) == \
+        "Foo Bar Baz 2001"
+
+
+@pytest.mark.parametrize("citation, expected_result", [
+    ("Thompson, E. P. (1963). The Making of the English Working Class. "
+     "London: Gollancz.", 1.0),
+    ("Thompson, E. P. (1968). The Making of the English Working Class.",
+     7 / 8),
+    ("Smith, A. (1776). The Wealth of Nations.", 2 / 8),
+])
+def test_confidence(citation, expected_result):
+    assert confidence(citation, work_text(WORK)) == \
+        pytest.approx(expected_result)
+
+
+def test_confidence_short_records():
+    # a one-word title is not enough to identify a work
+    assert confidence("Introduction. In: Foo (ed.)", "Introduction") == 0.2
+    assert confidence("Foo", "") == 0.0
+
+
+def test_index_search(index):
+    index.add("10.123/abc", work_text(WORK))
+    index.add("10.123/def", "The Making of Modern Britain Marr 2009")
+    index.add("10.123/ghi", "")
+    assert len(index) == 2
+
+    matches = index.search("Thompson, E. P. (1963). The Making of the "
+                           "English Working Class. London: Gollancz.")
+    assert [doi for doi, _ in matches] == ["10.123/abc", "10.123/def"]
+    assert matches[0][1] == 1.0
+    assert index.search("") == []
+
+
+def test_index_match(index):
+    index.add("10.123/abc", work_text(WORK))
+    assert index.match("Thompson (1963) The making of the English working "
+                       "class") == ("10.123/abc", 1.0)
+    assert index.match("Thompson, The Poverty of Theory (1978)") is None
+    assert index.match("Thompson, The Poverty of Theory (1978)",
+                       threshold=0.1) == ("10.123/abc", pytest.approx(3 / 8))
+
+
+def test_index_add_replaces(index):
+    index.add("10.123/abc", "Foo Bar Baz Qux Quux")
+    index.add("10.123/abc", work_text(WORK))
+    assert len(index) == 1
+    assert index.search("Foo Bar Baz Qux Quux") == []
+
+
+def test_index_is_persistent(tmp_path):
+    index_path = str(tmp_path / "index.sqlite3")
+    index = BibliographicIndex(index_path)
+    index.add("10.123/abc", work_text(WORK))
+    index.close()
+
+    index = BibliographicIndex(index_path)
+    assert index.match("Thompson (1963) The Making of the English Working "
+                       "Class")[0] == "10.123/abc"
+    index.close()
@@ -1,29 +1,62 @@
+import json
 import sys
+import time
 from pathlib import Path
 
+import pytest
+
 ROOT = Path(__file__).resolve().parents[1]
 sys.path.insert(0, str(ROOT))
 
 import main as main_module
 
 
+@pytest.fixture(autouse=True)
+def state_home(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+
+
 def test_main_uses_crossref_email(monkeypatch, tmp_path):
     epub_path = tmp_path / "dummy.epub"
     epub_path.write_text("dummy epub")
     captured = {}
 
     class DummyExtractor:
-        def __init__(self, epub):
+        def __init__(self, epub, backend=None, stream=False):
             self.epub = epub
+            captured["backend"] = backend
+            captured["stream"] = stream
+
+        def iter_citations(self, _class_names, jobs=1):
+            captured["jobs"] = jobs
+            yield "Citation text"
+
+    class DummyClient:
+        def __init__(self, email=None, limiter=None, cache=None,
+                     offline=False, pool_size=None, batch_size=1,
+                     snapshot=None):
+            captured["email"] = email
+            captured["batch_size"] = batch_size
+            captured["limiter"] = limiter
+            captured["cache"] = cache
+            captured["offline"] = offline
+
+            self.requested = 0
+            self.resolved = 0
 
-        def exctract_cit(self, _class_name):
-            return ["Citation text"]
+        def get_works(self, dois, max_workers=1, callback=None):
+            captured["dois"] = dois
+            captured["max_workers"] = max_workers
+            self.requested = self.resolved = len(dois)
+            return {}
+
+        def close(self):
+            return None
 
     class DummyRefine:
-        def __init__(self, unstructured_citation, doi=None, email=None):
+        def __init__(self, unstructured_citation, work=None):
             captured["unstructured_citation"] = unstructured_citation
-            captured["doi"] = doi
-            captured["email"] = email
+            captured["work"] = work
 
         @staticmethod
         def find_doi_match(_citation):
@@ -50,8 +83,10 @@ def test_main_uses_crossref_email(monkeypatch, tmp_path):
             return None
 
     monkeypatch.setenv("CROSSREF_EMAIL", "citations@example.com")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
     monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
     monkeypatch.setattr(main_module, "Refine", DummyRefine)
+    monkeypatch.setattr(main_module, "CrossrefClient", DummyClient)
     monkeypatch.setattr(main_module, "Bar", DummyBar)
     monkeypatch.setattr(
         sys,
@@ -62,5 +97,573 @@ def test_main_uses_crossref_email(monkeypatch, tmp_path):
     main_module.main()
 
     assert captured["unstructured_citation"] == "Citation text"
-    assert captured["doi"] == "10.1234/example"
+    assert captured["dois"] == ["10.1234/example"]
+    assert captured["max_workers"] == 5
+    assert captured["work"] is None
     assert captured["email"] == "citations@example.com"
+    assert captured["backend"] == "lxml"
+    assert captured["stream"] is False
+    assert captured["jobs"] == 1
+    assert captured["limiter"].interval == 0.1
+    assert captured["cache"].path == \
+        str(tmp_path / "cache" / "cit-ex" / "crossref.sqlite3")
+    assert captured["offline"] is False
+    assert captured["batch_size"] == 50
+
+
+def test_main_keeps_citation_order(monkeypatch, tmp_path, capsys):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    unstr_citations = [f"Citation {i % 7} https://doi.org/10.123/{i % 7}"
+                       for i in range(20)]
+    fetched = []
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def iter_citations(self, *args, **kwargs):
+            yield from unstr_citations
+
+    def dummy_fetch_work(self, doi):
+        fetched.append(doi)
+        # finish later lookups first
+        time.sleep((7 - int(doi.split("/")[1])) / 1000)
+        return {"DOI": doi}
+
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module.CrossrefClient, "_fetch_work",
+                        dummy_fetch_work)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["main.py", str(epub_path), "-c", "biblio", "--dry-run",
+         "--concurrency", "8", "--no-cache", "--crossref-batch-size", "1"],
+    )
+
+    main_module.main()
+
+    printed = capsys.readouterr().out.splitlines()
+    assert [line for line in printed if line.startswith("Citation(")] == \
+        [str(main_module.refine_citation(c, {"DOI": f"10.123/{i % 7}"}))
+         for i, c in enumerate(unstr_citations)]
+    assert sorted(fetched) == [f"10.123/{i}" for i in range(7)]
+    assert "7 unique DOIs looked up (13 requests saved)" in "\n".join(printed)
+
+
+def test_main_writes_in_batches(monkeypatch, tmp_path, capsys):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    captured = {}
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def iter_citations(self, *args, **kwargs):
+            yield from ["Citation 1", "Citation 2", "Citation 3"]
+
+    class DummyThoth:
+        def __init__(self, token):
+            captured["token"] = token
+
+        def init_connection(self):
+            return None
+
+        def resolve_identifier(self, identifier):
+            captured["identifier"] = identifier
+
+        def write_records(self, citations, batch_size=50, max_in_flight=1,
+                          callback=None):
+            captured["citations"] = citations
+            captured["batch_size"] = batch_size
+            captured["max_in_flight"] = max_in_flight
+            return {2: "Duplicate ordinal"}
+
+    monkeypatch.setenv("THOTH_PAT", "foo")
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module, "Thoth", DummyThoth)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["main.py", str(epub_path), "-c", "biblio", "--no-cache",
+         "-i", "10.11647/obp.0288", "--batch-size", "2",
+         "--write-concurrency", "3"],
+    )
+
+    main_module.main()
+
+    assert captured["token"] == "foo"
+    assert captured["identifier"] == "10.11647/obp.0288"
+    assert captured["batch_size"] == 2
+    assert captured["max_in_flight"] == 3
+    assert [c.unstructured_citation for c in captured["citations"]] == \
+        ["Citation 1", "Citation 2", "Citation 3"]
+    assert "#2: Duplicate ordinal" in capsys.readouterr().out
+
+
+def test_main_incremental(monkeypatch, tmp_path, capsys):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def iter_citations(self, *args, **kwargs):
+            yield from ["Citation 1", "Citation 2"]
+
+    class DummyThoth:
+        def __init__(self, token):
+            pass
+
+        def init_connection(self):
+            return None
+
+        def resolve_identifier(self, identifier):
+            return None
+
+        def write_records(self, *args, **kwargs):
+            raise AssertionError("write_records should not be called")
+
+        def sync_records(self, citations, batch_size=50, callback=None):
+            return {}, {}, {"created": 1, "updated": 0, "deleted": 0,
+                            "unchanged": 1}
+
+    monkeypatch.setenv("THOTH_PAT", "foo")
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module, "Thoth", DummyThoth)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["main.py", str(epub_path), "-c", "biblio", "--no-cache",
+         "-i", "10.11647/obp.0288", "--incremental"],
+    )
+
+    main_module.main()
+
+    assert "1 created, 0 updated, 0 deleted, 1 unchanged" in \
+        capsys.readouterr().out
+
+
+def test_main_skips_unchanged_epub(monkeypatch, tmp_path, capsys):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    runs = []
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            runs.append("extract")
+
+        def iter_citations(self, *args, **kwargs):
+            yield from citations
+
+    class DummyThoth:
+        def __init__(self, token):
+            pass
+
+        def init_connection(self):
+            return None
+
+        def resolve_identifier(self, identifier):
+            return None
+
+        def write_records(self, *args, **kwargs):
+            runs.append("write")
+            return failures
+
+    monkeypatch.setenv("THOTH_PAT", "foo")
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module, "Thoth", DummyThoth)
+    argv = ["main.py", str(epub_path), "-c", "biblio", "--no-cache",
+            "-i", "10.11647/obp.0288"]
+
+    def run(*extra_args):
+        monkeypatch.setattr(sys, "argv", argv + list(extra_args))
+        runs.clear()
+        main_module.main()
+        return list(runs)
+
+    # a run with failures is repeated
+    citations = ["Citation 1", "Citation 2"]
+    failures = {1: "Error"}
+    assert run() == ["extract", "write"]
+    failures = {}
+    assert run() == ["extract", "write"]
+
+    # unchanged input is skipped, unless forced
+    assert run() == []
+    assert "has not changed since the last run" in capsys.readouterr().out
+    assert run("--force") == ["extract", "write"]
+
+    # different classes or content are processed again
+    assert run("-c", "other") == ["extract", "write"]
+    epub_path.write_text("changed epub")
+    assert run() == ["extract", "write"]
+    assert run() == []
+
+    # DOI identifiers are normalised
+    assert run("-i", "https://doi.org/10.11647/OBP.0288") == []
+
+    # options changing what is written are processed again
+    assert run("--backend", "bs4") == ["extract", "write"]
+    index_path = tmp_path / "index.sqlite3"
+    main_module.BibliographicIndex(str(index_path)).close()
+    assert run("--match-index", str(index_path)) == ["extract", "write"]
+    assert run("--match-index", str(index_path)) == []
+    assert run("--match-index", str(index_path),
+               "--match-threshold", "0.9") == ["extract", "write"]
+
+    # runs without Crossref data are processed again
+    assert run("--offline") == ["extract", "write"]
+    assert run("--offline") == []
+    snapshot_path = tmp_path / "snapshot.sqlite3"
+    main_module.CrossrefSnapshot(str(snapshot_path)).close()
+    assert run("--snapshot", str(snapshot_path)) == ["extract", "write"]
+    assert run("--snapshot", str(snapshot_path)) == []
+    monkeypatch.setattr(main_module.CrossrefClient, "_fetch_work",
+                        lambda self, doi: None)
+    citations = ["Citation https://doi.org/10.123/unknown"]
+    assert run() == ["extract", "write"]
+    assert run() == ["extract", "write"]
+    assert "1 citations with a DOI not found on Crossref" in \
+        capsys.readouterr().out
+
+
+def test_run_shares_client_and_repository(monkeypatch, tmp_path, capsys):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    written = {}
+
+    class DummyExtractor:
+        def __init__(self, epub_path, *args, **kwargs):
+            pass
+
+        def iter_citations(self, *args, **kwargs):
+            yield from ["Citation https://doi.org/10.123/1",
+                        "Citation https://doi.org/10.123/2"]
+
+    class DummyThoth:
+        def __init__(self):
+            self.identifier = None
+
+        def resolve_identifier(self, identifier):
+            self.identifier = identifier
+
+        def write_records(self, citations, batch_size=50, max_in_flight=1,
+                          callback=None):
+            written[self.identifier] = citations
+            return {}
+
+    fetched = []
+
+    def dummy_fetch_work(self, doi):
+        fetched.append(doi)
+        return {"DOI": doi}
+
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module.CrossrefClient, "_fetch_work",
+                        dummy_fetch_work)
+    args = main_module.get_parser().parse_args(
+        [str(epub_path), "-c", "biblio", "--crossref-batch-size", "1",
+         "--cache", str(tmp_path / "crossref.sqlite3")])
+    cache = main_module.get_crossref_cache(args)
+    client = main_module.get_crossref_client(args, cache)
+    rep = DummyThoth()
+    state = main_module.StateStore(str(tmp_path / "state.sqlite3"))
+
+    for identifier in ["10.123/ch1", "10.123/ch2"]:
+        ex = DummyExtractor(str(epub_path))
+        citations, failures, unresolved = main_module.run(
+            args, ex, identifier, client, rep)
+        assert unresolved == 0
+        state.record(identifier, identifier, len(citations), len(failures))
+    client.close()
+    cache.close()
+
+    assert list(written) == ["10.123/ch1", "10.123/ch2"]
+    assert fetched == ["10.123/1", "10.123/2"]
+    out = capsys.readouterr().out
+    assert "2 citations, 2 with a DOI: 2 unique DOIs looked up" in out
+    assert state.is_unchanged("10.123/ch1", "10.123/ch1")
+    assert state.get("10.123/ch2")["citations"] == 2
+    state.close()
+
+
+def test_main_streaming(monkeypatch, tmp_path, capsys):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    unstr_citations = [f"Citation {i} https://doi.org/10.123/{i % 3}"
+                       for i in range(7)]
+    written = {}
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def iter_citations(self, *args, **kwargs):
+            yield from unstr_citations
+
+    class DummyThoth:
+        def __init__(self, token):
+            pass
+
+        def init_connection(self):
+            return None
+
+        def resolve_identifier(self, identifier):
+            return None
+
+        def write_batch(self, citations):
+            written.update(citations)
+            return {7: "Duplicate ordinal"} if 7 in citations else {}
+
+    def dummy_fetch_work(self, doi):
+        return {"DOI": doi}
+
+    monkeypatch.setenv("THOTH_PAT", "foo")
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module, "Thoth", DummyThoth)
+    monkeypatch.setattr(main_module.CrossrefClient, "_fetch_work",
+                        dummy_fetch_work)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["main.py", str(epub_path), "-c", "biblio", "--no-cache",
+         "-i", "10.11647/obp.0288", "--streaming", "--batch-size", "2"],
+    )
+
+    main_module.main()
+
+    assert written == {
+        i + 1: main_module.refine_citation(c, {"DOI": f"10.123/{i % 3}"})
+        for i, c in enumerate(unstr_citations)}
+    out = capsys.readouterr().out
+    assert "7 citations, 7 with a DOI: 3 unique DOIs looked up" in out
+    assert "#7: Duplicate ordinal" in out
+
+
+def test_main_streaming_w_incremental(monkeypatch, tmp_path):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["main.py", str(epub_path), "--streaming", "--incremental"],
+    )
+
+    with pytest.raises(SystemExit):
+        main_module.main()
+
+
+@pytest.mark.parametrize("references", [
+    [{"key": "ref1", "unstructured": "First https://doi.org/10.123/1"},
+     {"key": "ref2", "article-title": "Second", "DOI": "10.123/2"}],
+    None])
+def test_main_deposited(monkeypatch, tmp_path, capsys, references):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    extracted = []
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            extracted.append(True)
+
+        def iter_citations(self, *args, **kwargs):
+            yield from ["Extracted https://doi.org/10.123/3"]
+
+    def dummy_get_references(self, doi):
+        assert doi == "10.11647/obp.0288"
+        return references
+
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module.CrossrefClient, "get_references",
+                        dummy_get_references)
+    monkeypatch.setattr(main_module.CrossrefClient, "_fetch_work",
+                        lambda self, doi: None)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["main.py", str(epub_path), "--no-cache", "--dry-run",
+         "-i", "10.11647/obp.0288", "--deposited",
+         "--crossref-batch-size", "1"],
+    )
+
+    main_module.main()
+
+    out = capsys.readouterr().out
+    if references:
+        assert not extracted
+        assert "Using the 2 references deposited with Crossref" in out
+        assert "First https://doi.org/10.123/1" in out
+        assert "Second. https://doi.org/10.123/2" in out
+    else:
+        assert extracted
+        assert "No references deposited with Crossref" in out
+        assert "Extracted https://doi.org/10.123/3" in out
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_main_matches_citations_without_doi(monkeypatch, tmp_path, capsys,
+                                            streaming):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    index_path = tmp_path / "index.sqlite3"
+    index = main_module.BibliographicIndex(str(index_path))
+    assert main_module.build_match_index(
+        index,
+        works=[("10.123/LOCAL", {"title": ["A Local Book Title"],
+                                 "author": [{"family": "Smith"}],
+                                 "issued": {"date-parts": [[2001]]}})],
+        references=[{"doi": "https://doi.org/10.123/ref",
+                     "unstructuredCitation": "Jones, Some Earlier "
+                                             "Reference (1999)"},
+                    {"doi": None, "unstructuredCitation": "No DOI"}]) == \
+        (1, 1)
+    index.close()
+
+    unstr_citations = [
+        "Cited https://doi.org/10.123/1",
+        "Smith, J. (2001) A local book title. London.",
+        "Jones, A. Some earlier reference. 1999.",
+        "Brown, Searched Online Article (2010)",
+        "Unknown, A citation nobody knows (1900)",
+    ]
+    fetched = []
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def iter_citations(self, *args, **kwargs):
+            yield from unstr_citations
+
+    def dummy_fetch_work(self, doi):
+        fetched.append(doi)
+        return {"DOI": doi}
+
+    def dummy_search_work(self, citation):
+        if "Searched" in citation:
+            return {"DOI": "10.123/Searched",
+                    "title": ["Searched Online Article"],
+                    "author": [{"family": "Brown"}]}
+        return {"DOI": "10.123/wrong", "title": ["Something Else Entirely"]}
+
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(main_module.CrossrefClient, "_fetch_work",
+                        dummy_fetch_work)
+    monkeypatch.setattr(main_module.CrossrefClient, "search_work",
+                        dummy_search_work)
+    argv = ["main.py", str(epub_path), "--no-cache", "--dry-run",
+            "--crossref-batch-size", "1", "--match-index", str(index_path),
+            "--search"]
+    monkeypatch.setattr(sys, "argv",
+                        argv + (["--streaming"] if streaming else []))
+
+    main_module.main()
+
+    assert sorted(fetched) == ["10.123/1", "10.123/local", "10.123/ref"]
+    out = capsys.readouterr().out
+    for doi in ["10.123/1", "10.123/local", "10.123/ref", "10.123/Searched"]:
+        assert f"doi='{doi}'" in out
+    assert "10.123/wrong" not in out
+    if not streaming:
+        assert "4 citations without a DOI: 2 matched locally, 1 by " \
+            "searching Crossref" in out
+
+
+def test_get_match_index(tmp_path):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    index_path = str(tmp_path / "index.sqlite3")
+    args = main_module.get_parser().parse_args(
+        [str(epub_path), "--match-index", index_path])
+    args.epub.close()
+    # the index is only used once built
+    assert main_module.get_match_index(args) is None
+    main_module.BibliographicIndex(index_path).close()
+    index = main_module.get_match_index(args)
+    assert index is not None
+    index.close()
+    args.no_match_index = True
+    assert main_module.get_match_index(args) is None
+
+
+def test_main_resolves_from_snapshot(monkeypatch, tmp_path, capsys):
+    epub_path = tmp_path / "dummy.epub"
+    epub_path.write_text("dummy epub")
+    dump_path = tmp_path / "dump.jsonl"
+    dump_path.write_text("\n".join(json.dumps(
+        {"DOI": f"10.123/X{i}", "title": [f"Title {i}"], "score": 1,
+         "reference": [{"key": "ref1"}]}) for i in range(3)))
+    snapshot_path = tmp_path / "snapshot.sqlite3"
+    snapshot = main_module.CrossrefSnapshot(str(snapshot_path))
+    assert main_module.import_snapshot(snapshot, [str(dump_path)]) == 3
+    # works are stored projected, keyed by normalised DOI
+    assert snapshot.get("10.123/x1") == {"DOI": "10.123/X1",
+                                         "title": ["Title 1"]}
+    snapshot.close()
+
+    class DummyExtractor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def iter_citations(self, *args, **kwargs):
+            yield from ["Cited https://doi.org/10.123/x1",
+                        "Cited https://doi.org/10.123/unknown"]
+
+    monkeypatch.setattr(main_module, "Extractor", DummyExtractor)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["main.py", str(epub_path), "--no-cache", "--dry-run", "--offline",
+         "--snapshot", str(snapshot_path)],
+    )
+
+    main_module.main()
+
+    out = capsys.readouterr().out
+    assert "doi='10.123/X1'" in out
+    assert "2 citations, 2 with a DOI: 2 unique DOIs looked up" in out
+
+
+def test_process_citations_counts_its_own_lookups(monkeypatch, capsys):
+    client = main_module.CrossrefClient(batch_size=1)
+    # lookups of other runs sharing the client
+    client.requested, client.resolved = 100, 50
+    monkeypatch.setattr(main_module.CrossrefClient, "_fetch_work",
+                        lambda self, doi: {"DOI": doi})
+
+    main_module.process_citations(
+        ["A https://doi.org/10.123/1", "B https://doi.org/10.123/1",
+         "C without a DOI"], client, progress=False)
+    client.close()
+
+    out = capsys.readouterr().out
+    assert "3 citations, 2 with a DOI: 1 unique DOIs looked up " \
+        "(1 requests saved)" in out
+    assert (client.requested, client.resolved) == (102, 51)
+
+
+def test_get_progress_disabled(capsys):
+    bar = main_module.get_progress(main_module.Bar, "Quiet", False, max=2)
+    bar.next()
+    bar.finish()
+    assert capsys.readouterr() == ("", "")
+
+
+def test_write_citations_reports_delete_failures(capsys):
+    class DummyThoth:
+        def sync_records(self, citations, batch_size=50, callback=None):
+            return {2: "Boom"}, {"id-A": "Gone"}, \
+                {"created": 1, "updated": 0, "deleted": 1, "unchanged": 1}
+
+    args = main_module.argparse.Namespace(incremental=True, batch_size=50,
+                                          no_progress=True)
+    failures = main_module.write_citations(["A", "B"], DummyThoth(), args)
+
+    assert failures == {2: "Boom", "id-A": "Gone"}
+    out = capsys.readouterr().out
+    assert "1 references could not be written:\n  #2: Boom" in out
+    assert "1 existing references could not be deleted:\n  id-A: Gone" \
+        in out
@@ -0,0 +1,226 @@
+import importlib.util
+import io
+import sys
+from argparse import Namespace
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+spec = importlib.util.spec_from_file_location("obp_loader",
+                                              ROOT / "obp-loader.py")
+obp_loader = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(obp_loader)
+
+from state import StateStore  # noqa: E402
+
+
+def book(doi, chapters):
+    return {"workId": f"work-{doi}", "relations": [
+        {"relatedWork": {"workId": f"work-{ch}", "doi": ch,
+                         "publications": [{"locations": [
+                             {"fullTextUrl": f"https://doi.org/{ch}/c.xhtml"}
+                         ]}]}}
+        for ch in chapters]}
+
+
+class DummyFetcher:
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def fetch_all(self, urls, optional=()):
+        self.requested.append((list(urls), list(optional)))
+        for url in urls:
+            yield url, self.pages.get(url)
+
+
+class DummyRepository:
+    def __init__(self):
+        self.clones = []
+
+    def clone(self):
+        self.clones.append(DummyRepository())
+        return self.clones[-1]
+
+
+@pytest.fixture
+def args():
+    return Namespace(repository="thoth", classes=obp_loader.CLASSES,
+                     force=False, backend="lxml", html_path=None,
+                     deposited=False, no_match_index=True, offline=False,
+                     no_snapshot=True)
+
+
+@pytest.fixture(autouse=True)
+def cache_home(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+
+
+def test_get_dois():
+    doi_file = io.StringIO("10.1/b\n# a comment\n10.1/c  # note\n\n")
+    assert obp_loader.get_dois(["10.1/a", "10.1/b"], doi_file) == \
+        ["10.1/a", "10.1/b", "10.1/c"]
+    assert obp_loader.get_dois(["10.1/a", "10.1/a"]) == ["10.1/a"]
+
+
+def test_query_thoth_books(monkeypatch):
+    queries = []
+
+    def post_thoth_query(query):
+        queries.append(query["query"])
+        if len(queries) == 1:
+            return {"data": {"b0": book("10.1/a", []),
+                             "b1": book("10.1/b", [])}}
+        if len(queries) == 2:
+            # an unknown DOI fails the whole batch
+            return {"data": None, "errors": [{"message": "Not found"}]}
+        return {"data": {"workByDoi": book("10.1/c", [])}}
+
+    monkeypatch.setattr(obp_loader, "post_thoth_query", post_thoth_query)
+
+    books = obp_loader.query_thoth_books(["10.1/a", "10.1/b", "10.1/c"],
+                                         batch_size=2)
+
+    assert books == {doi: {"data": {"workByDoi": book(doi, [])}}
+                     for doi in ["10.1/a", "10.1/b", "10.1/c"]}
+    assert len(queries) == 3
+    assert 'b1: workByDoi (doi: "https://doi.org/10.1/b")' in queries[0]
+    assert 'workByDoi (doi: "https://doi.org/10.1/c")' in queries[2]
+
+
+def test_process_book(monkeypatch, args):
+    thoth_data = {"data": {"workByDoi": book("10.1/a",
+                                             ["10.1/a.1", "10.1/a.2"])}}
+    fetcher = DummyFetcher({"https://doi.org/10.1/a.1/c.xhtml": b"<p>1</p>",
+                            "https://doi.org/10.1/a.2/c.xhtml": b"<p>2</p>"})
+    rep = DummyRepository()
+    processed = []
+
+    def process(args, get_extractor, identifier, client, rep, doi=None,
+                index=None):
+        processed.append((identifier, doi, rep))
+        return 2, {1: "Error"} if doi == "10.1/a.2" else {}, 0
+
+    monkeypatch.setattr(obp_loader, "process", process)
+
+    summary = obp_loader.process_book("10.1/a", thoth_data, args, fetcher,
+                                      None, rep, None)
+
+    assert summary == {"chapters": 2, "unchanged": 0, "citations": 4,
+                       "failures": 1}
+    # the bibliography page is optional
+    bib_url = "https://doi.org/10.1/a.1/bibliography.xhtml"
+    assert fetcher.requested[0][1] == [bib_url]
+    assert bib_url in fetcher.requested[0][0]
+    # chapters are written to their work UUID, through the book's own client
+    assert [p[:2] for p in processed] == [("work-10.1/a.1", "10.1/a.1"),
+                                          ("work-10.1/a.2", "10.1/a.2")]
+    assert all(p[2] is rep.clones[0] for p in processed)
+
+
+def test_process_book_skips_unchanged_chapters(monkeypatch, tmp_path, args):
+    thoth_data = {"data": {"workByDoi": book("10.1/a", ["10.1/a.1"])}}
+    fetcher = DummyFetcher({"https://doi.org/10.1/a.1/c.xhtml": b"<p>1</p>"})
+    monkeypatch.setattr(obp_loader, "process", lambda *a, **kw: (1, {}, 0))
+    state = StateStore(str(tmp_path / "state.sqlite3"))
+
+    first = obp_loader.process_book("10.1/a", thoth_data, args, fetcher,
+                                    None, None, state)
+    second = obp_loader.process_book("10.1/a", thoth_data, args, fetcher,
+                                     None, None, state)
+    state.close()
+
+    assert (first["unchanged"], second["unchanged"]) == (0, 1)
+
+
+def test_process_chapter_state(monkeypatch, tmp_path, args):
+    monkeypatch.setattr(obp_loader, "process", lambda *a, **kw: (1, {}, 0))
+    state = StateStore(str(tmp_path / "state.sqlite3"))
+    chapter = {"doi": "https://doi.org/10.11647/OBP.0288.01",
+               "work_id": "work-a.1"}
+
+    assert obp_loader.process_chapter(chapter, b"<p>1</p>", args, None,
+                                      None, state) == (1, {})
+    # chapters are recorded under their normalised DOI, like main.py does
+    assert state.get("10.11647/obp.0288.01")["citations"] == 1
+    assert obp_loader.process_chapter(chapter, b"<p>1</p>", args, None,
+                                      None, state) is None
+    # options changing what is written invalidate the record
+    args.deposited = True
+    assert obp_loader.process_chapter(chapter, b"<p>1</p>", args, None,
+                                      None, state) == (1, {})
+    state.close()
+
+
+def test_process_book_without_chapters(args):
+    with pytest.raises(KeyError):
+        obp_loader.process_book("10.1/a", {"data": {"workByDoi":
+                                                    book("10.1/a", [])}},
+                                args, DummyFetcher({}), None, None, None)
+
+
+def test_main_reports_failed_books(monkeypatch, capsys):
+    seen = []
+
+    def process_book(doi, thoth_data, args, fetcher, client, rep, state,
+                     index=None):
+        seen.append((doi, args.no_progress))
+        if doi == "10.1/b":
+            raise KeyError(f"No chapters found in work metadata for {doi}")
+        return {"chapters": 3, "unchanged": 1, "citations": 10,
+                "failures": 0}
+
+    monkeypatch.setattr(obp_loader, "query_thoth_books",
+                        lambda dois: {doi: None for doi in dois})
+    monkeypatch.setattr(obp_loader, "process_book", process_book)
+    monkeypatch.setattr(sys, "argv", ["obp-loader.py", "10.1/a", "10.1/b",
+                                      "--dry-run", "--no-cache",
+                                      "--no-state"])
+
+    with pytest.raises(SystemExit) as e:
+        obp_loader.main()
+
+    assert str(e.value) == "1 of 2 books could not be processed"
+    # concurrent books do not draw progress bars
+    assert sorted(seen) == [("10.1/a", True), ("10.1/b", True)]
+    out = capsys.readouterr().out
+    assert "10.1/a: 3 chapters (1 unchanged), 10 citations, 0 failures" \
+        in out
+    assert "10.1/b: error: KeyError" in out
+
+
+@pytest.mark.parametrize("argv, no_progress",
+                         [[["10.1/a"], False],
+                          [["10.1/a", "10.1/b", "--book-concurrency", "1"],
+                           False],
+                          [["10.1/a", "10.1/b"], True]])
+def test_main_progress_bars(monkeypatch, argv, no_progress):
+    seen = set()
+
+    def process_book(doi, thoth_data, args, fetcher, client, rep, state,
+                     index=None):
+        seen.add(args.no_progress)
+        return {"chapters": 1, "unchanged": 0, "citations": 1,
+                "failures": 0}
+
+    monkeypatch.setattr(obp_loader, "query_thoth_books",
+                        lambda dois: {doi: None for doi in dois})
+    monkeypatch.setattr(obp_loader, "process_book", process_book)
+    monkeypatch.setattr(sys, "argv", ["obp-loader.py"] + argv +
+                        ["--dry-run", "--no-cache", "--no-state"])
+
+    obp_loader.main()
+
+    # only books processed at the same time lose their progress bars
+    assert seen == {no_progress}
+
+
+def test_main_without_dois(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["obp-loader.py"])
+    with pytest.raises(SystemExit) as e:
+        obp_loader.main()
+    assert e.value.code == 2
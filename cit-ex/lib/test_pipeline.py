@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import threading
+import time
+
+import pytest
+
+from pipeline import StreamingPipeline
+
+
+def find(item):
+    return item.split()[-1] if "doi:" in item else None
+
+
+def build(item, value):
+    return (item, value)
+
+
+class Writer:
+    def __init__(self, errors=()):
+        self.batches = []
+        self.errors = errors
+        self.lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self.lock:
+            self.batches.append(dict(batch))
+        return {ordinal: "Error" for ordinal in batch
+                if ordinal in self.errors}
+
+    @property
+    def records(self):
+        return {ordinal: record for batch in self.batches
+                for ordinal, record in batch.items()}
+
+
+def test_pipeline_assigns_ordinals_in_extraction_order():
+    items = [f"Citation {i} doi: 10.123/{i % 3}" for i in range(10)] + \
+            ["Citation without DOI"]
+
+    def resolve(key):
+        # finish later lookups first
+        time.sleep((3 - int(key[-1])) / 100)
+        return {"DOI": key}
+
+    writer = Writer()
+    pipeline = StreamingPipeline(find, resolve, build, writer,
+                                 batch_size=4)
+    assert pipeline.run(items) == {}
+    assert writer.records == {
+        i + 1: (item, {"DOI": find(item)} if find(item) else None)
+        for i, item in enumerate(items)}
+    assert [len(batch) for batch in writer.batches] == [4, 4, 3]
+    assert (pipeline.extracted, pipeline.requested, pipeline.resolved,
+            pipeline.written) == (11, 10, 3, 11)
+
+
+def test_pipeline_resolves_each_key_once():
+    calls = []
+
+    def resolve(key):
+        calls.append(key)
+        time.sleep(0.01)
+        return key
+
+    pipeline = StreamingPipeline(find, resolve, build, Writer(),
+                                 lookup_workers=8)
+    pipeline.run([f"Citation doi: 10.123/{i % 2}" for i in range(20)])
+    assert sorted(calls) == ["10.123/0", "10.123/1"]
+
+
+def test_pipeline_w_failed_lookups_and_writes():
+    def resolve(key):
+        raise ValueError("Lookup failed")
+
+    writer = Writer(errors=[2])
+    pipeline = StreamingPipeline(find, resolve, build, writer, batch_size=2)
+    assert pipeline.run(["A doi: 10.123/a", "B", "C"]) == {2: "Error"}
+    assert writer.records == {1: ("A doi: 10.123/a", None),
+                              2: ("B", None), 3: ("C", None)}
+
+
+def test_pipeline_overlaps_stages():
+    events = []
+
+    def items():
+        for i in range(6):
+            events.append(f"extract {i}")
+            time.sleep(0.01)
+            yield f"Citation {i}"
+
+    def write(batch):
+        events.append(f"write {min(batch)}")
+        return {}
+
+    StreamingPipeline(find, None, build, write, batch_size=2).run(items())
+    # the first batch is written before extraction is over
+    assert events.index("write 1") < events.index("extract 5")
+
+
+def test_pipeline_backpressure():
+    extracted = []
+    written = []
+
+    def items():
+        for i in range(40):
+            extracted.append(i)
+            yield f"Citation {i}"
+
+    def write(batch):
+        # extraction cannot run ahead of the writes by more than the
+        # queues and the batch being filled
+        assert len(extracted) - len(written) <= 2 * 4 + 2 + 2 + 1
+        time.sleep(0.005)
+        written.extend(batch)
+        return {}
+
+    pipeline = StreamingPipeline(find, None, build, write, lookup_workers=2,
+                                 batch_size=2, queue_size=4)
+    assert pipeline.run(items()) == {}
+    assert len(written) == 40
+
+
+def test_pipeline_propagates_extraction_errors():
+    def items():
+        yield "Citation"
+        raise RuntimeError("Invalid EPUB")
+
+    with pytest.raises(RuntimeError):
+        StreamingPipeline(find, None, build, Writer()).run(items())
+
+
+def test_pipeline_propagates_write_errors():
+    def write(batch):
+        raise ValueError("Invalid reference")
+
+    pipeline = StreamingPipeline(find, None, build, write, batch_size=1,
+                                 queue_size=1)
+    with pytest.raises(ValueError):
+        pipeline.run(f"Citation {i}" for i in range(20))
+
+
+def test_pipeline_propagates_build_errors():
+    def failing_build(item, value):
+        if item.endswith("3"):
+            raise ValueError("Invalid date-parts")
+        return build(item, value)
+
+    pipeline = StreamingPipeline(find, None, failing_build, Writer(),
+                                 lookup_workers=2, batch_size=2, queue_size=2)
+    with pytest.raises(ValueError):
+        pipeline.run(f"Citation {i}" for i in range(70))
+
+
+def test_pipeline_propagates_find_errors():
+    def failing_find(item):
+        raise KeyError(item)
+
+    with pytest.raises(KeyError):
+        StreamingPipeline(failing_find, None, build, Writer(),
+                          queue_size=1).run(f"Citation {i}" for i in range(20))
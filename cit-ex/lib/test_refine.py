@@ -1,6 +1,10 @@
+import json
+
 import pytest
+import requests
 
-from refine import Citation, Refine
+from refine import Citation, citation_from_reference, CrossrefClient, \
+    normalise_doi, project_work, RateLimiter, Refine, WORK_FIELDS
 
 
 def test_refine_no_argument():
@@ -36,6 +40,216 @@ def test_get_work_by_doi(mocker):
     assert p.work is not None
 
 
+def test_refine_w_injected_work(mocker):
+    get_work = mocker.patch("refine.Refine._get_work_by_doi")
+    p = Refine("FooBar", "10.123/abc", work={"DOI": "10.123/abc"})
+    assert p.work == {"DOI": "10.123/abc"}
+    get_work.assert_not_called()
+
+
+def test_refine_w_client(mocker):
+    get_work = mocker.patch("refine.Refine._get_work_by_doi")
+
+    class MockClient:
+        def get_work(self, doi):
+            return {"DOI": doi}
+
+    p = Refine("FooBar", "10.123/abc", client=MockClient())
+    assert p.work == {"DOI": "10.123/abc"}
+    get_work.assert_not_called()
+
+
+def test_refine_w_client_HTTP_error():
+    class MockClient:
+        def get_work(self, doi):
+            raise requests.exceptions.HTTPError()
+
+    p = Refine("FooBar", "10.123/abc", client=MockClient())
+    assert p.work is None
+
+
+class MockCache:
+    def __init__(self, records=None):
+        self.records = records or {}
+
+    def get(self, doi):
+        if doi in self.records:
+            return True, self.records[doi]
+        return False, None
+
+    def set(self, doi, work):
+        self.records[doi] = work
+
+
+class MockResponse:
+    def __init__(self, status_code, json_data=None):
+        self.status_code = status_code
+        self.json_data = json_data
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+@pytest.fixture
+def crossref_client():
+    client = CrossrefClient(email="citations@example.com")
+    yield client
+    client.close()
+
+
+def test_crossref_client_shares_session(crossref_client, mocker):
+    get = mocker.patch.object(
+        crossref_client.session, "get",
+        return_value=MockResponse(200, {"message": {"DOI": "10.123/abc"}}))
+    assert crossref_client.get_work("https://doi.org/10.123/ABC") == \
+        {"DOI": "10.123/abc"}
+    assert crossref_client.get_work("10.123/def") == {"DOI": "10.123/abc"}
+    assert get.call_args_list[0].args[0] == \
+        "https://api.crossref.org/works/10.123/abc"
+    assert "citations@example.com" in \
+        crossref_client.session.headers["User-Agent"]
+
+
+def test_crossref_client_not_found(crossref_client, mocker):
+    mocker.patch.object(crossref_client.session, "get",
+                        return_value=MockResponse(404))
+    assert crossref_client.get_work("10.123/abc") is None
+
+
+def test_crossref_client_retries_server_errors(crossref_client, mocker):
+    mocker.patch("time.sleep")
+    get = mocker.patch.object(
+        crossref_client.session, "get",
+        side_effect=[MockResponse(503),
+                     MockResponse(200, {"message": {"DOI": "10.123/abc"}})])
+    assert crossref_client.get_work("10.123/abc") == {"DOI": "10.123/abc"}
+    assert get.call_count == 2
+
+
+def test_crossref_client_gives_up_on_client_errors(crossref_client, mocker):
+    get = mocker.patch.object(crossref_client.session, "get",
+                              return_value=MockResponse(400))
+    with pytest.raises(requests.exceptions.HTTPError):
+        crossref_client.get_work("10.123/abc")
+    assert get.call_count == 1
+
+
+def test_crossref_client_w_limiter(crossref_client, mocker):
+    mocker.patch.object(crossref_client.session, "get",
+                        return_value=MockResponse(404))
+    crossref_client.limiter = RateLimiter(0)
+    wait = mocker.spy(crossref_client.limiter, "wait")
+    crossref_client.get_work("10.123/abc")
+    wait.assert_called_once()
+
+
+def test_crossref_client_w_cache_hit(crossref_client, mocker):
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work")
+    crossref_client.cache = MockCache({"10.123/abc": {"DOI": "10.123/abc"},
+                                       "10.123/def": None})
+    assert crossref_client.get_work("https://doi.org/10.123/ABC") == \
+        {"DOI": "10.123/abc"}
+    assert crossref_client.get_work("10.123/def") is None
+    fetch.assert_not_called()
+
+
+@pytest.mark.parametrize("work", [{"DOI": "10.123/abc"}, None])
+def test_crossref_client_w_cache_miss(crossref_client, work, mocker):
+    mocker.patch("refine.CrossrefClient._fetch_work", return_value=work)
+    crossref_client.cache = MockCache()
+    assert crossref_client.get_work("10.123/ABC") == work
+    assert crossref_client.cache.records == {"10.123/abc": work}
+
+
+@pytest.mark.parametrize("cache", [None, MockCache()])
+def test_crossref_client_offline(crossref_client, cache, mocker):
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work")
+    crossref_client.cache = cache
+    crossref_client.offline = True
+    assert crossref_client.get_work("10.123/abc") is None
+    fetch.assert_not_called()
+
+
+def test_crossref_client_get_works_deduplicates(crossref_client, mocker):
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work",
+                         side_effect=lambda doi: {"DOI": doi})
+    callback = mocker.Mock()
+    works = crossref_client.get_works(
+        ["10.123/ABC", "https://doi.org/10.123/abc.", "10.123/def",
+         "10.123/abc"], max_workers=2, callback=callback)
+    assert works == {"10.123/abc": {"DOI": "10.123/abc"},
+                     "10.123/def": {"DOI": "10.123/def"}}
+    assert fetch.call_count == 2
+    assert callback.call_count == 2
+    assert (crossref_client.requested, crossref_client.resolved) == (4, 2)
+
+
+def test_crossref_client_get_works_HTTP_error(crossref_client, mocker):
+    mocker.patch("refine.CrossrefClient.get_work",
+                 side_effect=requests.exceptions.HTTPError())
+    assert crossref_client.get_works(["10.123/abc"]) == {"10.123/abc": None}
+
+
+@pytest.mark.parametrize("batch_size", [1, 50])
+def test_crossref_client_get_works_connection_error(crossref_client,
+                                                    batch_size, mocker):
+    mocker.patch("time.sleep")
+    crossref_client.batch_size = batch_size
+    get = mocker.patch.object(
+        crossref_client.session, "get",
+        side_effect=requests.exceptions.ConnectionError())
+    assert crossref_client.get_works(["10.123/abc"]) == {"10.123/abc": None}
+    # the batch, then the single lookup, are each tried three times
+    assert get.call_count == (6 if batch_size > 1 else 3)
+
+
+def test_crossref_client_retries_timeouts(crossref_client, mocker):
+    mocker.patch("time.sleep")
+    get = mocker.patch.object(
+        crossref_client.session, "get",
+        side_effect=[requests.exceptions.Timeout(),
+                     MockResponse(200, {"message": {"DOI": "10.123/abc"}})])
+    assert crossref_client.get_work("10.123/abc") == {"DOI": "10.123/abc"}
+    assert get.call_count == 2
+
+
+@pytest.mark.parametrize("doi, expected_result",
+                         [["10.11647/OBP.0288", "10.11647/obp.0288"],
+                          ["https://doi.org/10.11647/OBP.0288",
+                           "10.11647/obp.0288"],
+                          ["http://dx.doi.org/10.11647/obp.0288",
+                           "10.11647/obp.0288"],
+                          ["doi:10.11647/obp.0288", "10.11647/obp.0288"],
+                          [" 10.11647/obp.0288\n", "10.11647/obp.0288"],
+                          ["10.11647/obp.0288.", "10.11647/obp.0288"],
+                          ["10.11647/obp.0288;", "10.11647/obp.0288"],
+                          ["10.2990/1471-5457(2005)24[2:tmpwac]2.0.co;2",
+                           "10.2990/1471-5457(2005)24[2:tmpwac]2.0.co;2"]])
+def test_normalise_doi(doi, expected_result):
+    assert normalise_doi(doi) == expected_result
+
+
+def test_rate_limiter_spaces_calls(mocker):
+    sleep = mocker.patch("refine.time.sleep")
+    mocker.patch("refine.time.monotonic", return_value=100.0)
+    limiter = RateLimiter(4)
+    for _ in range(3):
+        limiter.wait()
+    assert [c.args[0] for c in sleep.call_args_list] == [0.25, 0.5]
+
+
+def test_rate_limiter_disabled(mocker):
+    sleep = mocker.patch("refine.time.sleep")
+    limiter = RateLimiter(0)
+    for _ in range(3):
+        limiter.wait()
+    sleep.assert_not_called()
+
+
 def test_refine_no_doi():
     p = Refine("FooBar")
     assert p.work is None
@@ -166,6 +380,7 @@ def test_get_series_title(input_data, expected_result):
                            "123-1-231-23123-1"],
                           [{"isbn-type": []}, None],
                           [{"isbn-type": [{"value": "123-1"}]}, None],
+                          [{"ISBN": ["1231231231231"]}, "123-1-231-23123-1"],
                           [{}, None]])
 def test_get_isbn(input_data, expected_result, mocker):
     mocker.patch("refine.re.sub", return_value=expected_result)
@@ -467,3 +682,238 @@ def test_citation_process_doi_no_input():
     with pytest.raises(TypeError):
         c = Citation()
         c.process_doi()
+
+
+def test_crossref_client_get_works_in_batches(crossref_client, mocker):
+    def get(url, params=None, timeout=None):
+        dois = [f[4:] for f in params["filter"].split(",")]
+        # Crossref does not know 10.123/d
+        items = [{"DOI": doi.upper()} for doi in dois if doi != "10.123/d"]
+        return MockResponse(200, {"message": {"items": items}})
+
+    session_get = mocker.patch.object(crossref_client.session, "get",
+                                      side_effect=get)
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work",
+                         return_value=None)
+    callback = mocker.Mock()
+    crossref_client.batch_size = 2
+    crossref_client.cache = MockCache({"10.123/a": {"DOI": "10.123/a"}})
+
+    works = crossref_client.get_works(
+        ["10.123/a", "10.123/b", "10.123/c", "10.123/d", "10.123/e,f",
+         "10.123/B"], callback=callback)
+    assert works == {"10.123/a": {"DOI": "10.123/a"},
+                     "10.123/b": {"DOI": "10.123/B"},
+                     "10.123/c": {"DOI": "10.123/C"},
+                     "10.123/d": None, "10.123/e,f": None}
+    assert sorted(c.kwargs["params"]["filter"]
+                  for c in session_get.call_args_list) == \
+        ["doi:10.123/b,doi:10.123/c", "doi:10.123/d"]
+    params = session_get.call_args_list[0].kwargs["params"]
+    assert params["rows"] == len(params["filter"].split(","))
+    assert params["select"].split(",") == CrossrefClient.SELECT
+    # DOIs not returned by a batch are looked up one at a time
+    assert sorted(c.args[0] for c in fetch.call_args_list) == \
+        ["10.123/d", "10.123/e,f"]
+    assert callback.call_count == 5
+    assert crossref_client.cache.records["10.123/b"] == {"DOI": "10.123/B"}
+    assert crossref_client.cache.records["10.123/d"] is None
+
+
+def test_crossref_client_select():
+    # elements documented as accepted by the select parameter of /works
+    assert ",".join(CrossrefClient.SELECT) == \
+        "DOI,ISSN,ISBN,author,title,subtitle,container-title,page,volume," \
+        "issue,issued,type"
+    assert set(CrossrefClient.SELECT) <= set(WORK_FIELDS)
+
+
+def test_crossref_client_batch_without_select(crossref_client, mocker):
+    session_get = mocker.patch.object(
+        crossref_client.session, "get",
+        side_effect=[MockResponse(400),
+                     MockResponse(200, {"message": {"items": [
+                         {"DOI": "10.123/a"}, {"DOI": "10.123/b"}]}}),
+                     MockResponse(200, {"message": {"items": [
+                         {"DOI": "10.123/c"}]}})])
+    crossref_client.batch_size = 2
+    works = crossref_client.get_works(["10.123/a", "10.123/b", "10.123/c"])
+    assert works == {"10.123/a": {"DOI": "10.123/a"},
+                     "10.123/b": {"DOI": "10.123/b"},
+                     "10.123/c": {"DOI": "10.123/c"}}
+    assert "select" in session_get.call_args_list[0].kwargs["params"]
+    assert "select" not in session_get.call_args_list[1].kwargs["params"]
+    assert "select" not in session_get.call_args_list[2].kwargs["params"]
+    assert crossref_client.select is None
+
+
+FULL_WORK = {
+    "DOI": "10.123/abc", "type": "book-chapter", "ISSN": ["1234-5678"],
+    "ISBN": ["9781234567897"],
+    "isbn-type": [{"value": "9781234567897", "type": "print"}],
+    "author": [{"given": "Jane", "family": "Doe", "sequence": "first",
+                "affiliation": [{"name": "University"}],
+                "ORCID": "https://orcid.org/0000-0000-0000-0000"}],
+    "title": ["Title"], "subtitle": ["Subtitle"],
+    "container-title": ["Series", "Book"], "page": "10-20",
+    "volume": "3", "issue": "2", "edition-number": "2",
+    "issued": {"date-parts": [[2020, 5, 1]]},
+    "resource": {"primary": {"URL": "https://example.org/abc"},
+                 "secondary": [{"URL": "https://mirror.example.org/abc"}]},
+    "reference": [{"key": f"ref{i}", "unstructured": "Citation " * 20}
+                  for i in range(100)],
+    "funder": [{"name": "Funder", "award": ["123"]}],
+    "license": [{"URL": "https://creativecommons.org/licenses/by/4.0/"}],
+    "link": [{"URL": "https://example.org/abc.pdf"}],
+}
+
+
+def test_project_work():
+    work = project_work(FULL_WORK)
+    assert set(work) == set(WORK_FIELDS)
+    assert work["author"] == [{"given": "Jane", "family": "Doe"}]
+    assert work["resource"] == {"primary": {"URL": "https://example.org/abc"}}
+    assert len(json.dumps(work)) * 10 < len(json.dumps(FULL_WORK))
+    assert project_work(None) is None
+
+
+def test_project_work_keeps_citation_data():
+    full = Refine("Foo", work=FULL_WORK)
+    full.work = FULL_WORK
+    full.process_crossref_data()
+    projected = Refine("Foo", work=FULL_WORK)
+    projected.process_crossref_data()
+    assert projected.work != FULL_WORK
+    assert projected.get_citation() == full.get_citation()
+
+
+def test_crossref_client_stores_projected_works(crossref_client, mocker):
+    mocker.patch.object(crossref_client.session, "get",
+                        return_value=MockResponse(200, {"message": FULL_WORK}))
+    crossref_client.cache = MockCache()
+    assert crossref_client.get_work("10.123/abc") == project_work(FULL_WORK)
+    assert crossref_client.cache.records["10.123/abc"] == \
+        project_work(FULL_WORK)
+
+
+def test_citation_from_reference():
+    cit = citation_from_reference({
+        "key": "ref1", "unstructured": "Smith, J. (2020). A Title.",
+        "DOI": "10.123/ABC", "author": "Smith", "year": "2020a",
+        "journal-title": "Journal", "volume": "3", "first-page": "7"})
+    assert cit.unstructured_citation == "Smith, J. (2020). A Title."
+    assert cit.doi == "10.123/ABC"
+    assert cit.doi_url == "https://doi.org/10.123/ABC"
+    assert cit.publication_date == "2020-01-01"
+    assert (cit.author, cit.journal_title, cit.volume, cit.first_page) == \
+        ("Smith", "Journal", "3", "7")
+
+
+def test_citation_from_reference_no_unstructured():
+    cit = citation_from_reference({
+        "author": "Smith", "year": "2020", "article-title": "A Title",
+        "journal-title": "Journal", "volume": "3", "issue": "2",
+        "first-page": "7", "DOI": "10.123/abc"})
+    assert cit.unstructured_citation == \
+        "Smith. (2020). A Title. Journal 3(2). 7. https://doi.org/10.123/abc"
+    cit = citation_from_reference({"volume-title": "A Book"})
+    assert cit.unstructured_citation == "A Book"
+    assert cit.doi is None and cit.publication_date is None
+
+
+def test_crossref_client_get_references(crossref_client, mocker):
+    references = [{"key": "ref1", "unstructured": "A reference"}]
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work",
+                         return_value={"DOI": "10.123/abc",
+                                       "reference": references})
+    crossref_client.cache = MockCache()
+    assert crossref_client.get_references("https://doi.org/10.123/ABC") == \
+        references
+    fetch.assert_called_once_with("10.123/abc")
+    # reference lists are not projected into the cache
+    assert crossref_client.cache.records == {}
+
+
+@pytest.mark.parametrize("response", [
+    MockResponse(404), MockResponse(200, {"message": {"DOI": "10.123/abc"}})])
+def test_crossref_client_get_references_none(crossref_client, response,
+                                             mocker):
+    mocker.patch.object(crossref_client.session, "get", return_value=response)
+    assert crossref_client.get_references("10.123/abc") is None
+
+
+def test_crossref_client_get_references_offline(crossref_client, mocker):
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work")
+    crossref_client.offline = True
+    assert crossref_client.get_references("10.123/abc") is None
+    fetch.assert_not_called()
+
+
+def test_crossref_client_search_work(crossref_client, mocker):
+    get = mocker.patch.object(
+        crossref_client.session, "get",
+        return_value=MockResponse(200, {"message": {"items": [
+            {"DOI": "10.123/ABC", "title": ["Foo"], "score": 42}]}}))
+    crossref_client.cache = MockCache()
+    assert crossref_client.search_work("Foo (2001)") == \
+        {"DOI": "10.123/ABC", "title": ["Foo"]}
+    assert get.call_args.kwargs["params"]["query.bibliographic"] == \
+        "Foo (2001)"
+    assert get.call_args.kwargs["params"]["rows"] == 1
+    assert crossref_client.cache.records == \
+        {"10.123/abc": {"DOI": "10.123/ABC", "title": ["Foo"]}}
+
+
+@pytest.mark.parametrize("response", [
+    MockResponse(200, {"message": {"items": []}}), MockResponse(400)])
+def test_crossref_client_search_work_none(crossref_client, response, mocker):
+    mocker.patch.object(crossref_client.session, "get", return_value=response)
+    assert crossref_client.search_work("Foo (2001)") is None
+
+
+def test_crossref_client_search_work_offline(crossref_client, mocker):
+    get = mocker.patch.object(crossref_client.session, "get")
+    crossref_client.offline = True
+    assert crossref_client.search_work("Foo (2001)") is None
+    get.assert_not_called()
+
+
+class MockSnapshot:
+    def __init__(self, works):
+        self.works = works
+
+    def get(self, doi):
+        return self.works.get(doi)
+
+
+def test_crossref_client_w_snapshot(crossref_client, mocker):
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work",
+                         return_value={"DOI": "10.123/def"})
+    crossref_client.snapshot = MockSnapshot(
+        {"10.123/abc": {"DOI": "10.123/abc", "score": 1}})
+    crossref_client.cache = MockCache()
+    assert crossref_client.get_work("https://doi.org/10.123/ABC") == \
+        {"DOI": "10.123/abc"}
+    fetch.assert_not_called()
+    assert crossref_client.get_work("10.123/def") == {"DOI": "10.123/def"}
+    # snapshot hits are not copied to the cache
+    assert crossref_client.cache.records == \
+        {"10.123/def": {"DOI": "10.123/def"}}
+
+
+@pytest.mark.parametrize("batch_size", [1, 50])
+def test_crossref_client_get_works_w_snapshot(crossref_client, batch_size,
+                                              mocker):
+    fetch = mocker.patch("refine.CrossrefClient._fetch_work")
+    fetch_batch = mocker.patch("refine.CrossrefClient._fetch_batch")
+    crossref_client.snapshot = MockSnapshot(
+        {"10.123/abc": {"DOI": "10.123/abc"}})
+    crossref_client.batch_size = batch_size
+    crossref_client.offline = True
+    callback = mocker.Mock()
+    assert crossref_client.get_works(["10.123/ABC", "10.123/abc",
+                                      "10.123/def"], callback=callback) == \
+        {"10.123/abc": {"DOI": "10.123/abc"}, "10.123/def": None}
+    assert callback.call_count == 2
+    fetch.assert_not_called()
+    fetch_batch.assert_not_called()
@@ -15,8 +15,13 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import re
+import threading
+import time
+
 from munch import Munch
 import pytest
+import requests
 from urllib.parse import urljoin
 
 from refine import Citation
@@ -36,6 +41,13 @@ def test_thoth_init_connection(mocker):
     set_token.assert_called_once_with(None)
 
 
+def test_thoth_init_connection_session():
+    rep = Thoth("foo")
+    rep.init_connection()
+
+    assert rep.session.headers["Authorization"] == "Bearer foo"
+
+
 def test_resolve_identifier_w_valid_doi():
     class MockClient():
         def work_by_doi(self, *args, **kwargs):
@@ -168,3 +180,397 @@ def test_write_record_type_error(work_id, reference_ordinal, citation):
         rep.identifier = work_id
         rep.client = MockClient()
         rep.write_record(citation, reference_ordinal)
+
+
+class MockResponse:
+    def __init__(self, json_data, status_code=200):
+        self.json_data = json_data
+        self.status_code = status_code
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+class MockSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.queries = []
+
+    def post(self, url, json, timeout=None):
+        self.queries.append(json["query"])
+        self.timeout = timeout
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def thoth():
+    rep = Thoth("foo")
+    rep.init_connection()
+    rep.identifier = "1234"
+    yield rep
+
+
+def test_aliased_mutation():
+    field = Thoth._aliased_mutation(
+        "ref1", "createReference",
+        {"workId": "1234", "referenceOrdinal": 1, "doi": None,
+         "unstructuredCitation": 'Foo "Bar"\nBaz'})
+    assert field == 'ref1: createReference(data: {workId: "1234", ' \
+                    'referenceOrdinal: 1, unstructuredCitation: ' \
+                    '"Foo \\"Bar\\"\\nBaz"}) { referenceId }'
+
+
+def test_write_records_batches(thoth):
+    citations = [Citation(unstructured_citation=f"Citation {i}")
+                 for i in range(5)]
+    thoth.session = MockSession(
+        MockResponse({"data": {"ref1": {"referenceId": "a"},
+                               "ref2": {"referenceId": "b"}}}),
+        MockResponse({"data": {"ref3": {"referenceId": "c"},
+                               "ref4": {"referenceId": "d"}}}),
+        MockResponse({"data": {"ref5": {"referenceId": "e"}}}))
+    sent = []
+
+    failures = thoth.write_records(citations, batch_size=2,
+                                   callback=sent.append)
+
+    assert failures == {}
+    assert sent == [2, 2, 1]
+    assert len(thoth.session.queries) == 3
+    assert thoth.session.queries[1].count("createReference") == 2
+    assert 'ref3: createReference(data: {workId: "1234", ' \
+           'referenceOrdinal: 3, unstructuredCitation: "Citation 2"})' \
+        in thoth.session.queries[1]
+
+
+def test_write_records_partial_failure(thoth):
+    citations = [Citation(unstructured_citation=f"Citation {i}")
+                 for i in range(3)]
+    thoth.session = MockSession(
+        MockResponse({"data": {"ref1": {"referenceId": "a"},
+                               "ref2": None,
+                               "ref3": None},
+                      "errors": [{"message": "Duplicate ordinal",
+                                  "path": ["ref2"]}]}))
+
+    failures = thoth.write_records(citations)
+
+    assert failures == {2: "Duplicate ordinal", 3: "No data returned"}
+
+
+@pytest.mark.parametrize("responses",
+                         [[MockResponse({"errors": [{"message": "Invalid"}]})],
+                          [MockResponse({}, status_code=400)],
+                          [MockResponse({}, status_code=500)] * 5,
+                          [requests.exceptions.ConnectionError()] * 5])
+def test_write_records_request_failure(thoth, responses, mocker):
+    mocker.patch("time.sleep")
+    citations = [Citation(unstructured_citation=f"Citation {i}")
+                 for i in range(2)]
+    thoth.session = MockSession(*responses)
+
+    failures = thoth.write_records(citations)
+
+    assert list(failures) == [1, 2]
+
+
+def test_write_records_type_error(thoth):
+    with pytest.raises(TypeError):
+        thoth.write_records([{"citation": Citation()}])
+
+
+@pytest.mark.parametrize("error", [MockResponse({}, status_code=429),
+                                   MockResponse({}, status_code=502),
+                                   requests.exceptions.ConnectionError(),
+                                   requests.exceptions.Timeout()])
+def test_write_records_retries_transient_errors(thoth, error, mocker):
+    mocker.patch("time.sleep")
+    thoth.session = MockSession(
+        error, MockResponse({"data": {"ref1": {"referenceId": "a"}}}))
+
+    failures = thoth.write_records([Citation(unstructured_citation="Foo")])
+
+    assert failures == {}
+    assert len(thoth.session.queries) == 2
+    assert thoth.session.timeout == Thoth.TIMEOUT
+
+
+def test_write_records_concurrently(thoth):
+    class ConcurrentSession(MockSession):
+        def __init__(self):
+            super().__init__()
+            self.lock = threading.Lock()
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        def post(self, url, json, timeout=None):
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                self.queries.append(json["query"])
+            time.sleep(0.01)
+            ordinal = int(re.search(r"referenceOrdinal: (\d+)",
+                                    json["query"]).group(1))
+            with self.lock:
+                self.in_flight -= 1
+            if ordinal == 7:
+                return MockResponse({"errors": [{"message": "Conflict",
+                                                 "path": ["ref7"]}]})
+            return MockResponse({"data": {f"ref{ordinal}": {
+                                 "referenceId": str(ordinal)}}})
+
+    citations = [Citation(unstructured_citation=f"Citation {i}")
+                 for i in range(1, 13)]
+    thoth.session = ConcurrentSession()
+    sent = []
+
+    failures = thoth.write_records(citations, batch_size=1, max_in_flight=3,
+                                   callback=sent.append)
+
+    assert failures == {7: "Conflict"}
+    assert sent == [1] * 12
+    assert thoth.session.max_in_flight == 3
+    assert sorted(re.search(r'unstructuredCitation: "([^"]*)"', q).group(1)
+                  for q in thoth.session.queries) == \
+        sorted(f"Citation {i}" for i in range(1, 13))
+    for query in thoth.session.queries:
+        ordinal, text = re.search(r'referenceOrdinal: (\d+), '
+                                  r'unstructuredCitation: "([^"]*)"',
+                                  query).groups()
+        assert text == f"Citation {ordinal}"
+
+
+def existing_reference(ordinal, text, doi=None, **fields):
+    reference = {field: None for field in Thoth.REFERENCE_FIELDS}
+    reference.update(referenceId=f"id-{text}", referenceOrdinal=ordinal,
+                     unstructuredCitation=text, doi=doi, **fields)
+    return reference
+
+
+class InMemoryThoth(Thoth):
+    """Thoth with an in-memory reference table, enforcing unique ordinals"""
+    def __init__(self, references):
+        super().__init__("foo")
+        self.identifier = "1234"
+        self.table = {r["referenceId"]: dict(r) for r in references}
+        self.sent = []
+
+    def get_records(self):
+        return sorted((dict(r) for r in self.table.values()),
+                      key=lambda r: r["referenceOrdinal"])
+
+    def _run_mutations(self, operations):
+        errors = {}
+        for alias, (name, data) in operations.items():
+            self.sent.append((name, data.get("referenceOrdinal")))
+            ordinals = {r["referenceOrdinal"]: i
+                        for i, r in self.table.items()}
+            if name == "deleteReference":
+                del self.table[data["referenceId"]]
+                continue
+            ref_id = data.get("referenceId", f"id-new-{alias}")
+            if ordinals.get(data["referenceOrdinal"], ref_id) != ref_id:
+                errors[alias] = "Ordinal already in use"
+                continue
+            self.table[ref_id] = {field: data.get(field)
+                                  for field in Thoth.REFERENCE_FIELDS}
+            self.table[ref_id]["referenceId"] = ref_id
+        return errors
+
+
+def test_sync_records_w_unchanged_references():
+    existing = [existing_reference(i, f"Citation {i}") for i in range(1, 4)]
+    rep = InMemoryThoth(existing)
+    citations = [Citation(unstructured_citation=f"Citation {i}")
+                 for i in range(1, 4)]
+
+    failures, delete_failures, stats = rep.sync_records(citations)
+
+    assert failures == {}
+    assert delete_failures == {}
+    assert stats == {"created": 0, "updated": 0, "deleted": 0,
+                     "unchanged": 3}
+    assert rep.sent == []
+
+
+def test_sync_records_w_changes():
+    existing = [existing_reference(1, "A"),
+                existing_reference(2, "B"),
+                existing_reference(3, "C", doi="https://doi.org/10.1/c"),
+                existing_reference(4, "D")]
+    rep = InMemoryThoth(existing)
+    citations = [Citation(unstructured_citation="A"),
+                 Citation(unstructured_citation="X"),
+                 Citation(unstructured_citation="B"),
+                 Citation(unstructured_citation="C (corrected)",
+                          doi_url="https://doi.org/10.1/C")]
+
+    failures, delete_failures, stats = rep.sync_records(citations,
+                                                        batch_size=2)
+
+    assert failures == {}
+    assert delete_failures == {}
+    assert stats == {"created": 1, "updated": 2, "deleted": 1,
+                     "unchanged": 1}
+    assert rep.sent == [("deleteReference", None),
+                        ("updateReference", 4),
+                        ("updateReference", 3),
+                        ("createReference", 2)]
+    assert [(r["referenceOrdinal"], r["unstructuredCitation"])
+            for r in rep.get_records()] == \
+        [(1, "A"), (2, "X"), (3, "B"), (4, "C (corrected)")]
+    assert rep.table["id-B"]["referenceOrdinal"] == 3
+
+
+def test_sync_records_w_removed_reference():
+    existing = [existing_reference(i, f"Citation {i}") for i in range(1, 6)]
+    rep = InMemoryThoth(existing)
+    citations = [Citation(unstructured_citation=f"Citation {i}")
+                 for i in [1, 3, 4, 5]]
+
+    failures, delete_failures, stats = rep.sync_records(citations)
+
+    assert failures == {}
+    assert delete_failures == {}
+    assert stats == {"created": 0, "updated": 3, "deleted": 1,
+                     "unchanged": 1}
+    assert [(r["referenceOrdinal"], r["unstructuredCitation"])
+            for r in rep.get_records()] == \
+        [(1, "Citation 1"), (2, "Citation 3"), (3, "Citation 4"),
+         (4, "Citation 5")]
+
+
+def test_sync_records_failures():
+    class FailingThoth(InMemoryThoth):
+        def _run_mutations(self, operations):
+            return {alias: "Boom" for alias in operations}
+
+    rep = FailingThoth([existing_reference(1, "A"),
+                        existing_reference(2, "B")])
+    failures, delete_failures, _ = rep.sync_records(
+        [Citation(unstructured_citation="B")])
+
+    assert failures == {1: "Boom"}
+    assert delete_failures == {"id-A": "Boom"}
+
+
+@pytest.mark.parametrize("reference, expected_result",
+                         [[{"doi": "https://doi.org/10.1/ABC",
+                            "unstructuredCitation": "Foo"},
+                           "https://doi.org/10.1/abc"],
+                          [{"doi": None,
+                            "unstructuredCitation": " Foo  bar"},
+                           Thoth._reference_key(
+                               {"unstructuredCitation": "foo bar"})]])
+def test_reference_key(reference, expected_result):
+    assert Thoth._reference_key(reference) == expected_result
+
+
+def test_get_records_paginates(thoth):
+    thoth.PAGE_SIZE = 2
+    thoth.session = MockSession(
+        MockResponse({"data": {"work": {"references": [
+            existing_reference(2, "B"), existing_reference(1, "A")]}}}),
+        MockResponse({"data": {"work": {"references": [
+            existing_reference(3, "C")]}}}))
+
+    references = thoth.get_records()
+
+    assert [r["referenceOrdinal"] for r in references] == [1, 2, 3]
+    assert "offset: 2" in thoth.session.queries[1]
+    assert 'work(workId: "1234")' in thoth.session.queries[0]
+
+
+def test_get_records_w_errors(thoth):
+    thoth.session = MockSession(
+        MockResponse({"errors": [{"message": "Invalid workId"}]}))
+    with pytest.raises(ValueError):
+        thoth.get_records()
+
+
+def test_resolve_dois(thoth):
+    thoth.session = MockSession(
+        MockResponse({"data": {"w0": {"workId": "a"}, "w1": {"workId": "b"}}}),
+        MockResponse({"data": {"w0": {"workId": "c"}}}))
+    assert thoth.resolve_dois(["https://doi.org/10.11647/OBP.0288.01",
+                               "10.11647/obp.0288.02",
+                               "10.11647/obp.0288.01"], batch_size=2) == \
+        {"https://doi.org/10.11647/OBP.0288.01": "a",
+         "10.11647/obp.0288.02": "b", "10.11647/obp.0288.01": "a"}
+    assert len(thoth.session.queries) == 1
+    assert 'w0: workByDoi(doi: "https://doi.org/10.11647/obp.0288.01")' \
+        in thoth.session.queries[0]
+
+    # cached DOIs are not looked up again
+    assert thoth.resolve_dois(["10.11647/obp.0288.02",
+                               "10.11647/obp.0288.03"]) == \
+        {"10.11647/obp.0288.02": "b", "10.11647/obp.0288.03": "c"}
+    assert len(thoth.session.queries) == 2
+
+    thoth.resolve_identifier("10.11647/OBP.0288.03")
+    assert thoth.identifier == "c"
+
+
+def test_resolve_dois_w_unknown_doi(thoth):
+    thoth.session = MockSession(
+        MockResponse({"data": None,
+                      "errors": [{"message": "Not found", "path": ["w1"]}]}),
+        MockResponse({"data": {"w0": {"workId": "a"}}}),
+        MockResponse({"data": None,
+                      "errors": [{"message": "Not found", "path": ["w0"]}]}))
+    assert thoth.resolve_dois(["10.11647/obp.0288.01",
+                               "10.11647/obp.0288.99", "foo"]) == \
+        {"10.11647/obp.0288.01": "a"}
+    assert len(thoth.session.queries) == 3
+
+
+def test_write_batch(thoth):
+    thoth.session = MockSession(
+        MockResponse({"data": {"ref3": {"referenceId": "c"}},
+                      "errors": [{"message": "Conflict", "path": ["ref7"]}]}))
+    citations = {3: Citation(unstructured_citation="Citation 3"),
+                 7: Citation(unstructured_citation="Citation 7")}
+    assert thoth.write_batch(citations) == {7: "Conflict"}
+    assert "ref3: createReference" in thoth.session.queries[0]
+    assert "referenceOrdinal: 7" in thoth.session.queries[0]
+
+
+def test_iter_references_paginates(thoth):
+    thoth.PAGE_SIZE = 2
+    thoth.session = MockSession(
+        MockResponse({"data": {"references": [
+            existing_reference(1, "A"), existing_reference(2, "B")]}}),
+        MockResponse({"data": {"references": [existing_reference(1, "C")]}}))
+
+    references = list(thoth.iter_references())
+
+    assert [r["unstructuredCitation"] for r in references] == ["A", "B", "C"]
+    assert "references(limit: 2, offset: 2)" in thoth.session.queries[1]
+    assert "workId" not in thoth.session.queries[0]
+
+
+def test_thoth_init_connection_without_token():
+    rep = Thoth()
+    rep.init_connection()
+    assert "Authorization" not in rep.session.headers
+
+
+def test_thoth_clone(thoth):
+    thoth.work_ids["10.11647/obp.0288"] = "1234"
+    clone = thoth.clone()
+    clone.resolve_identifier("cedb58f1-b88f-476c-b7c8-bc5869a2a6ba")
+    assert clone.identifier == "cedb58f1-b88f-476c-b7c8-bc5869a2a6ba"
+    assert thoth.identifier == "1234"
+    assert (clone.token, clone.client, clone.session) == \
+        (thoth.token, thoth.client, thoth.session)
+    # DOIs resolved by either are not looked up again
+    clone.resolve_identifier("10.11647/OBP.0288")
+    assert clone.identifier == "1234"
+    assert clone.work_ids is thoth.work_ids
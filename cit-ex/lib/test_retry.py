@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import pytest
+import requests
+
+from retry import is_permanent_error
+
+
+class MockResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize("error, expected_result", [
+    (requests.exceptions.HTTPError(response=MockResponse(500)), False),
+    (requests.exceptions.HTTPError(response=MockResponse(503)), False),
+    (requests.exceptions.HTTPError(response=MockResponse(429)), False),
+    (requests.exceptions.HTTPError(response=MockResponse(404)), True),
+    (requests.exceptions.HTTPError(response=MockResponse(400)), True),
+    (requests.exceptions.HTTPError(), True),
+    (requests.exceptions.ConnectionError(), False),
+    (requests.exceptions.ConnectTimeout(), False),
+    (requests.exceptions.ReadTimeout(), False),
+    (requests.exceptions.TooManyRedirects(), True),
+])
+def test_is_permanent_error(error, expected_result):
+    assert is_permanent_error(error) == expected_result
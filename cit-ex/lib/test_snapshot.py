@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import gzip
+import io
+import json
+import tarfile
+
+import pytest
+
+from snapshot import CrossrefSnapshot, read_dump
+
+WORKS = [{"DOI": f"10.123/{i}", "title": [f"Title {i}"]} for i in range(5)]
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    snapshot = CrossrefSnapshot(str(tmp_path / "cache" / "snapshot.sqlite3"))
+    yield snapshot
+    snapshot.close()
+
+
+def test_read_dump_jsonl_gz(tmp_path):
+    dump_path = tmp_path / "works.jsonl.gz"
+    with gzip.open(dump_path, "wt") as dump:
+        dump.write(json.dumps(WORKS[0]) + "\n\n")
+        dump.write(json.dumps({"message": WORKS[1]}) + "\n")
+        dump.write(json.dumps({"items": WORKS[2:]}) + "\n")
+        dump.write(json.dumps({"status": "ok"}) + "\n")
+    assert list(read_dump(str(dump_path))) == WORKS
+
+
+def test_read_dump_directory(tmp_path):
+    (tmp_path / "a.json").write_text(json.dumps({"items": WORKS[:2]},
+                                                indent=2))
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "b.jsonl").write_text(
+        "\n".join(json.dumps(w) for w in WORKS[2:]))
+    (tmp_path / "README.txt").write_text("not a dump")
+    assert list(read_dump(str(tmp_path))) == WORKS
+
+
+def test_read_dump_tar(tmp_path):
+    # the Crossref public data file is a tar archive of gzipped JSON files
+    dump_path = tmp_path / "dump.tar"
+    with tarfile.open(dump_path, "w") as tar:
+        for i, items in enumerate([WORKS[:3], WORKS[3:]]):
+            data = gzip.compress(json.dumps({"items": items}).encode())
+            member = tarfile.TarInfo(f"dump/{i}.json.gz")
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    assert list(read_dump(str(dump_path))) == WORKS
+
+
+def test_snapshot_add_and_get(snapshot):
+    batches = []
+    assert snapshot.add_works(((w["DOI"], w) for w in WORKS), batch_size=2,
+                              callback=batches.append) == 5
+    assert batches == [2, 2, 1]
+    assert len(snapshot) == 5
+    assert snapshot.get("10.123/3") == WORKS[3]
+    assert snapshot.get("10.123/unknown") is None
+
+
+def test_snapshot_replaces_works(snapshot):
+    snapshot.add_works([("10.123/0", WORKS[0])])
+    snapshot.add_works([("10.123/0", WORKS[1])])
+    assert len(snapshot) == 1
+    assert snapshot.get("10.123/0") == WORKS[1]
+
+
+def test_snapshot_iter_works(snapshot):
+    snapshot.add_works((w["DOI"], w) for w in WORKS)
+    assert list(snapshot.iter_works()) == [(w["DOI"], w) for w in WORKS]
+
+
+def test_snapshot_is_persistent(tmp_path):
+    snapshot_path = str(tmp_path / "snapshot.sqlite3")
+    snapshot = CrossrefSnapshot(snapshot_path)
+    snapshot.add_works([("10.123/0", WORKS[0])])
+    snapshot.close()
+
+    snapshot = CrossrefSnapshot(snapshot_path)
+    assert snapshot.get("10.123/0") == WORKS[0]
+    snapshot.close()
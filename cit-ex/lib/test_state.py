@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+'''
+This file is part of cit-ex
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import pytest
+
+from state import StateStore
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = StateStore(str(tmp_path / "state" / "state.sqlite3"))
+    yield state
+    state.close()
+
+
+def test_digest():
+    assert StateStore.digest(b"foo") == StateStore.digest(b"foo")
+    assert StateStore.digest(b"foo") != StateStore.digest(b"bar")
+    assert StateStore.digest(b"foo", "a") != StateStore.digest(b"foo", "b")
+    assert StateStore.digest(b"foo", "ab") != \
+        StateStore.digest(b"foo", "a", "b")
+
+
+def test_state_unknown_key(state):
+    assert state.get("10.123/abc") is None
+    assert not state.is_unchanged("10.123/abc", "hash")
+
+
+def test_state_record(state):
+    state.record("10.123/abc", "hash", 12)
+    record = state.get("10.123/abc")
+    assert record["hash"] == "hash"
+    assert record["citations"] == 12
+    assert record["failures"] == 0
+    assert state.is_unchanged("10.123/abc", "hash")
+    assert not state.is_unchanged("10.123/abc", "other hash")
+
+
+def test_state_record_with_failures(state):
+    state.record("10.123/abc", "hash", 12, failures=1)
+    assert not state.is_unchanged("10.123/abc", "hash")
+
+    state.record("10.123/abc", "hash", 12)
+    assert state.is_unchanged("10.123/abc", "hash")
+
+
+def test_state_is_persistent(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    state = StateStore(path)
+    state.record("10.123/abc", "hash", 12)
+    state.close()
+
+    state = StateStore(path)
+    assert state.is_unchanged("10.123/abc", "hash")
+    state.close()
@@ -18,13 +18,23 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import argparse
-from os import getenv
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv, path
 
+from lib.cache import CrossrefCache
 from lib.extractor import Extractor
-from lib.refine import Refine
+from lib.index import BibliographicIndex, confidence, reference_text, \
+    work_text
+from lib.pipeline import StreamingPipeline
+from lib.refine import citation_from_reference, CrossrefClient, \
+    normalise_doi, project_work, RateLimiter, Refine
 from lib.repository import Thoth
+from lib.snapshot import CrossrefSnapshot, read_dump
+from lib.state import StateStore
 
 from progress.bar import Bar
+from progress.counter import Counter
+import requests
 
 
 def get_crossref_email() -> str:
@@ -32,7 +42,176 @@ def get_crossref_email() -> str:
     return getenv('CROSSREF_EMAIL') or "no-email@offered.org"
 
 
-def main():
+def get_cache_path() -> str:
+    """Return the default path of the Crossref cache database"""
+    cache_home = getenv('XDG_CACHE_HOME') or path.expanduser("~/.cache")
+    return path.join(cache_home, "cit-ex", "crossref.sqlite3")
+
+
+def get_index_path() -> str:
+    """Return the default path of the local bibliographic index"""
+    return path.join(path.dirname(get_cache_path()), "index.sqlite3")
+
+
+def get_snapshot_path() -> str:
+    """Return the default path of the local Crossref snapshot"""
+    return path.join(path.dirname(get_cache_path()),
+                     "crossref-snapshot.sqlite3")
+
+
+def get_state_path() -> str:
+    """Return the default path of the database of processed documents"""
+    state_home = getenv('XDG_STATE_HOME') or \
+        path.expanduser("~/.local/state")
+    return path.join(state_home, "cit-ex", "state.sqlite3")
+
+
+def refine_citation(unstructured_citation: str, work: dict = None) -> any:
+    """Return the Citation object of an unstructured citation, enriched
+       with the data of its Crossref work (if any)"""
+    ref_cit = Refine(unstructured_citation=unstructured_citation, work=work)
+
+    if ref_cit._is_valid_doi():
+        ref_cit.process_crossref_data()
+
+    return ref_cit.get_citation()
+
+
+def get_progress(progress_class: type, message: str, enabled: bool = True,
+                 **kwargs) -> any:
+    """Return a progress indicator (e.g. a progress.bar.Bar), writing
+       nothing unless enabled"""
+    if not enabled:
+        kwargs["file"] = None
+    return progress_class(message, **kwargs)
+
+
+def search_citation(unstructured_citation: str, client: CrossrefClient,
+                    threshold: float = 0.8) -> dict:
+    """Return the Crossref work found by a bibliographic search for the
+       unstructured citation, or None if it does not match the citation
+       with at least threshold confidence"""
+    work = client.search_work(unstructured_citation)
+    if work is None or \
+            confidence(unstructured_citation, work_text(work)) < threshold:
+        return None
+    return work
+
+
+def report_failures(failures: dict) -> None:
+    """Print the references that could not be written to the repository"""
+    if failures:
+        print(f"{len(failures)} references could not be written:")
+        for ordinal, error in sorted(failures.items()):
+            print(f"  #{ordinal}: {error}")
+
+
+def report_delete_failures(delete_failures: dict) -> None:
+    """Print the existing references that could not be deleted from the
+       repository"""
+    if delete_failures:
+        print(f"{len(delete_failures)} existing references could not be "
+              f"deleted:")
+        for reference_id, error in sorted(delete_failures.items()):
+            print(f"  {reference_id}: {error}")
+
+
+def add_pipeline_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options of the extraction, refinement and write steps to
+       parser. They are shared with the wrappers running the pipeline
+       (e.g. obp-loader.py)"""
+    parser.add_argument("-b", "--backend", type=str, default="lxml",
+                        choices=['lxml', 'bs4'],
+                        help="Extraction backend. 'bs4' is slower, but more "
+                             "forgiving with malformed markup. "
+                             "Default: %(default)s")
+    parser.add_argument("--stream", action='store_true',
+                        help="Read the EPUB lazily, one document at a time, "
+                             "without loading images and other media.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes used to parse the EPUB "
+                             "documents. Default: %(default)s")
+    parser.add_argument("--concurrency", type=int, default=5,
+                        help="Maximum number of concurrent Crossref "
+                             "lookups. Default: %(default)s")
+    parser.add_argument("--rate-limit", type=float, default=10,
+                        help="Maximum number of Crossref requests per "
+                             "second (0 for no limit). Default: %(default)s")
+    parser.add_argument("--crossref-batch-size", type=int, default=50,
+                        help="Number of DOIs looked up per Crossref request "
+                             "(1 to look them up one at a time). "
+                             "Default: %(default)s")
+    parser.add_argument("--cache", type=str, default=get_cache_path(),
+                        help="Path of the Crossref cache database. "
+                             "Default: %(default)s")
+    parser.add_argument("--cache-ttl", type=float, default=30,
+                        help="Days after which cached Crossref records "
+                             "expire. Default: %(default)s")
+    parser.add_argument("--cache-size", type=int, default=512,
+                        help="Maximum size of the Crossref cache, in MB. "
+                             "Default: %(default)s")
+    parser.add_argument("--no-cache", action='store_true',
+                        help="Do not use the Crossref cache.")
+    parser.add_argument("--offline", "--cache-only", action='store_true',
+                        help="Do not query Crossref: only use cached "
+                             "records.")
+    parser.add_argument("--snapshot", type=str, default=get_snapshot_path(),
+                        help="Path of the local Crossref snapshot, see "
+                             "import-snapshot.py. Its works are used "
+                             "before the cache and Crossref. "
+                             "Default: %(default)s")
+    parser.add_argument("--no-snapshot", action='store_true',
+                        help="Do not use the local Crossref snapshot.")
+    parser.add_argument("--match-index", type=str, default=get_index_path(),
+                        help="Path of the local bibliographic index used to "
+                             "match citations without a DOI, see "
+                             "build-index.py. Default: %(default)s")
+    parser.add_argument("--no-match-index", action='store_true',
+                        help="Do not use the local bibliographic index.")
+    parser.add_argument("--match-threshold", type=float, default=0.8,
+                        help="Minimum confidence (from 0 to 1) of the "
+                             "matches of citations without a DOI. "
+                             "Default: %(default)s")
+    parser.add_argument("--search", action='store_true',
+                        help="Search Crossref for the citations without a "
+                             "DOI that have no match in the local index.")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Number of references written to the "
+                             "repository per request. Default: %(default)s")
+    parser.add_argument("--write-concurrency", type=int, default=4,
+                        help="Maximum number of concurrent write requests "
+                             "to the repository. Default: %(default)s")
+    parser.add_argument("--incremental", action='store_true',
+                        help="Compare the citations with the references "
+                             "already in the repository and only write "
+                             "what changed.")
+    parser.add_argument("--deposited", action='store_true',
+                        help="Use the reference list deposited with "
+                             "Crossref for the work (if its identifier is a "
+                             "DOI), and only extract the citations when "
+                             "none is deposited.")
+    parser.add_argument("--streaming", action='store_true',
+                        help="Run extraction, Crossref lookups and "
+                             "repository writes concurrently, streaming "
+                             "the citations from one stage to the next. "
+                             "Not compatible with --incremental.")
+    parser.add_argument("--state", type=str, default=get_state_path(),
+                        help="Path of the database recording the documents "
+                             "already processed. Default: %(default)s")
+    parser.add_argument("--no-state", action='store_true',
+                        help="Do not record the processed documents.")
+    parser.add_argument("--force", action='store_true',
+                        help="Process the documents even if they have not "
+                             "changed since the last successful run.")
+    parser.add_argument("--dry-run", action='store_true',
+                        help="Perform a dry run: no data would be sent to "
+                             "metadata repositories.")
+    parser.add_argument("--no-progress", action='store_true',
+                        help="Do not show progress bars.")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Return the command line parser of cit-ex"""
     parser = argparse.ArgumentParser(
                  prog="cit-ex",
                  description="A tool to extract citation data from "
@@ -51,59 +230,409 @@ def main():
     parser.add_argument("-i", "--identifier", type=str, default=None,
                         help="Work identifier on the repository. Depending on "
                              "the repository, this could be a DOI or UUID.")
-    parser.add_argument("--dry-run", action='store_true',
-                        help="Perform a dry run: no data would be sent to "
-                             "metadata repositories.")
-    args = parser.parse_args()
+    add_pipeline_arguments(parser)
+    return parser
+
+
+def get_state(args: argparse.Namespace) -> StateStore:
+    """Return the database of processed documents, or None if it is not
+       used (dry runs and --no-state)"""
+    if args.dry_run or args.no_state:
+        return None
+    return StateStore(args.state)
+
+
+def get_crossref_cache(args: argparse.Namespace) -> CrossrefCache:
+    """Return the Crossref cache, or None if it is disabled"""
+    if args.no_cache:
+        return None
+    return CrossrefCache(args.cache, ttl=args.cache_ttl * CrossrefCache.DAY,
+                         max_size=args.cache_size * 1024 * 1024)
+
+
+def get_match_index(args: argparse.Namespace) -> BibliographicIndex:
+    """Return the local bibliographic index, or None if it is disabled or
+       was never built"""
+    if args.no_match_index or not path.exists(args.match_index):
+        return None
+    return BibliographicIndex(args.match_index)
+
+
+def build_match_index(index: BibliographicIndex, works: iter = (),
+                      references: iter = ()) -> tuple:
+    """Add the Crossref works (as (doi, work) tuples, e.g. from
+       CrossrefCache.iter_works) and the repository references that have a
+       DOI to index. Return the number of works and references added."""
+    counts = [0, 0]
+    for doi, work in works:
+        index.add(normalise_doi(doi), work_text(work))
+        counts[0] += 1
+    for reference in references:
+        if reference.get("doi"):
+            index.add(normalise_doi(reference["doi"]),
+                      reference_text(reference))
+            counts[1] += 1
+    index.commit()
+    return tuple(counts)
+
+
+def get_crossref_snapshot(args: argparse.Namespace) -> CrossrefSnapshot:
+    """Return the local Crossref snapshot, or None if it is disabled or was
+       never imported"""
+    if args.no_snapshot or not path.exists(args.snapshot):
+        return None
+    return CrossrefSnapshot(args.snapshot)
+
+
+def import_snapshot(snapshot: CrossrefSnapshot, dump_paths: list,
+                    callback: callable = None) -> int:
+    """Store the works of the Crossref metadata dumps in dump_paths (see
+       read_dump) in snapshot, projected to WORK_FIELDS. Return the number
+       of works stored."""
+    def works():
+        for dump_path in dump_paths:
+            for work in read_dump(dump_path):
+                yield normalise_doi(work["DOI"]), project_work(work)
+
+    return snapshot.add_works(works(), callback=callback)
+
 
-    # Extract unstructured citations from EPUB
-    ex = Extractor(args.epub.name)
-    unstr_citations = []
-    bar = Bar("Extract the citations", max=len(args.classes))
-    for class_ in args.classes:
-        unstr_citations.extend(ex.exctract_cit(class_))
-        bar.next()
+def get_crossref_client(args: argparse.Namespace,
+                        cache: CrossrefCache = None,
+                        snapshot: CrossrefSnapshot = None) -> CrossrefClient:
+    """Return a Crossref client, to be shared by all the lookups of a run"""
+    return CrossrefClient(email=get_crossref_email(),
+                          limiter=RateLimiter(args.rate_limit),
+                          cache=cache, offline=args.offline,
+                          pool_size=args.concurrency,
+                          batch_size=args.crossref_batch_size,
+                          snapshot=snapshot)
+
+
+def get_repository(args: argparse.Namespace) -> Thoth:
+    """Return a connected repository client, to be shared by all the
+       writes of a run"""
+    if args.repository == "thoth":
+        token = getenv('THOTH_PAT')
+        if not token:
+            raise KeyError(
+                "No Thoth personal access token provided "
+                "(THOTH_PAT environment variable not set)"
+            )
+        rep = Thoth(token)
+        rep.init_connection()
+        return rep
+
+
+def process_citations(unstr_citations: list, client: CrossrefClient,
+                      concurrency: int = 5, index: BibliographicIndex = None,
+                      search: bool = False, threshold: float = 0.8,
+                      progress: bool = True) -> tuple:
+    """Return a tuple of the Citation objects of the unstructured
+       citations, in the same order, and of the number of citations whose
+       DOI could not be resolved. Each unique DOI is looked up once, with
+       concurrent requests. Citations without a DOI are matched against
+       index, then (with search) searched on Crossref, see
+       match_citations. progress shows a progress bar."""
+    dois = [Refine.find_doi_match(c) for c in unstr_citations]
+    searched = {}
+    if index is not None or search:
+        searched = match_citations(unstr_citations, dois, client,
+                                   concurrency, index, search, threshold)
+    found_dois = [doi for doi in dois
+                  if doi and normalise_doi(doi) not in searched]
+    # the client may be shared by concurrent runs: count this run's DOIs
+    requested = len(found_dois)
+    resolved = len(set(normalise_doi(doi) for doi in found_dois))
+    bar = get_progress(Bar, "Process the citations", progress, max=resolved)
+    works = client.get_works(found_dois, max_workers=concurrency,
+                             callback=bar.next)
     bar.finish()
+    works.update(searched)
 
-    # Process the unstructured citations and return Citation objects
     citations = []
-    bar = Bar("Process the citations", max=len(unstr_citations))
-    for c in unstr_citations:
-        doi = Refine.find_doi_match(c)
-        ref_cit = Refine(unstructured_citation=c, doi=doi,
-                         email=get_crossref_email())
-
-        if doi and ref_cit._is_valid_doi():
-            ref_cit.process_crossref_data()
-        else:
-            pass  # TODO perform a bibliographic search
-
-        citations.append(ref_cit.get_citation())
-        bar.next()
-    bar.finish()
+    for c, doi in zip(unstr_citations, dois):
+        work = works.get(normalise_doi(doi)) if doi else None
+        citations.append(refine_citation(c, work))
+
+    print(f"{len(unstr_citations)} citations, {requested} with a "
+          f"DOI: {resolved} unique DOIs looked up "
+          f"({requested - resolved} requests saved)")
+    unresolved = sum(1 for doi in found_dois
+                     if works.get(normalise_doi(doi)) is None)
+    if unresolved:
+        print(f"{unresolved} citations with a DOI not found on Crossref")
+    return citations, unresolved
+
+
+def match_citations(unstr_citations: list, dois: list,
+                    client: CrossrefClient, concurrency: int = 5,
+                    index: BibliographicIndex = None, search: bool = False,
+                    threshold: float = 0.8) -> dict:
+    """Fill in dois (the DOIs found in the unstructured citations) with the
+       DOIs of the citations without one that match a record of index, or
+       (with search) a Crossref work, with at least threshold confidence.
+       Return the dictionary of normalised DOI -> work of the works found
+       by searching Crossref."""
+    missing = [i for i, doi in enumerate(dois) if not doi]
+    local = 0
+    if index is not None:
+        for i in missing:
+            match = index.match(unstr_citations[i], threshold)
+            if match is not None:
+                dois[i] = match[0]
+                local += 1
+
+    searched = {}
+    remaining = [i for i in missing if not dois[i]]
+    if search and remaining:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            works = pool.map(lambda i: search_citation(
+                unstr_citations[i], client, threshold), remaining)
+            for i, work in zip(remaining, works):
+                if work is not None:
+                    dois[i] = normalise_doi(work["DOI"])
+                    searched[dois[i]] = work
+
+    print(f"{len(missing)} citations without a DOI: {local} matched "
+          f"locally, {len(searched)} by searching Crossref")
+    return searched
+
+
+def write_citations(citations: list, rep: Thoth,
+                    args: argparse.Namespace) -> dict:
+    """Write the citations to the work rep.identifier of the repository.
+       Return the references that could not be written, by ordinal, and,
+       with --incremental, the existing references that could not be
+       deleted, by referenceId."""
+    if args.incremental:
+        bar = get_progress(Bar, "Sync with repository",
+                           not args.no_progress, max=len(citations))
+        failures, delete_failures, stats = rep.sync_records(
+            citations, batch_size=args.batch_size, callback=bar.next)
+        bar.finish()
+        print(", ".join(f"{n} {k}" for k, n in stats.items()))
+        report_failures(failures)
+        report_delete_failures(delete_failures)
+        # a reference left behind means the work is not in sync yet
+        return {**failures, **delete_failures}
+    else:
+        bar = get_progress(Bar, "Write to repository",
+                           not args.no_progress, max=len(citations))
+        failures = rep.write_records(
+            citations, batch_size=args.batch_size,
+            max_in_flight=args.write_concurrency, callback=bar.next)
+        bar.finish()
+    report_failures(failures)
+    return failures
+
+
+def run_streaming(args: argparse.Namespace, ex: Extractor, identifier: str,
+                  client: CrossrefClient, rep: Thoth = None,
+                  index: BibliographicIndex = None) -> tuple:
+    """Streaming version of run: citations are looked up and written (or
+       printed, on a dry run) while the EPUB is still being extracted, see
+       StreamingPipeline. Return a tuple of the number of citations, of
+       the references that could not be written, by ordinal, and of the
+       number of DOIs that could not be resolved."""
+    if args.dry_run:
+        def write(batch: dict) -> dict:
+            for ordinal in sorted(batch):
+                print(batch[ordinal])
+            return {}
+    else:
+        rep.resolve_identifier(identifier)
+        write = rep.write_batch
+
+    def find(unstructured_citation: str) -> any:
+        doi = Refine.find_doi_match(unstructured_citation)
+        if doi:
+            return normalise_doi(doi)
+        match = index.match(unstructured_citation, args.match_threshold) \
+            if index is not None else None
+        if match is not None:
+            return match[0]
+        # citations to search for are keyed by their text
+        return (unstructured_citation,) if args.search else None
+
+    # keys of the DOIs not found (appending to a list is thread-safe)
+    unresolved = []
+
+    def resolve(key: any) -> dict:
+        if isinstance(key, tuple):
+            return search_citation(key[0], client, args.match_threshold)
+        try:
+            work = client.get_work(key)
+        except requests.exceptions.RequestException:
+            work = None
+        if work is None:
+            unresolved.append(key)
+        return work
+
+    counter = get_progress(Counter, "Citations processed: ",
+                           not args.no_progress)
+    pipeline = StreamingPipeline(
+        find, resolve, refine_citation, write,
+        lookup_workers=args.concurrency,
+        write_workers=1 if args.dry_run else args.write_concurrency,
+        batch_size=args.batch_size, callback=counter.next)
+    failures = pipeline.run(ex.iter_citations(args.classes, jobs=args.jobs))
+    counter.finish()
+
+    print(f"{pipeline.extracted} citations, {pipeline.requested} with a "
+          f"DOI: {pipeline.resolved} unique DOIs looked up "
+          f"({pipeline.requested - pipeline.resolved} requests saved)")
+    report_failures(failures)
+    return pipeline.extracted, failures, len(unresolved)
+
+
+def get_state_key(identifier: str, epub_path: str = None) -> str:
+    """Return the key of a document in the database of processed
+       documents: its identifier (normalised, if it is a DOI) or the path
+       of the EPUB"""
+    if not identifier:
+        return path.abspath(epub_path)
+    doi = Refine.find_doi_match(identifier)
+    return normalise_doi(doi) if doi else identifier
 
+
+def get_digest(args: argparse.Namespace, content: bytes) -> str:
+    """Return the hash of the content of a document and of the options
+       affecting what is written for it"""
+    match_index = None
+    if not args.no_match_index and path.exists(args.match_index):
+        # a rebuilt index may match citations differently
+        match_index = (args.match_index, path.getmtime(args.match_index),
+                       args.match_threshold, args.search)
+    snapshot = None
+    if not args.no_snapshot and path.exists(args.snapshot):
+        # works imported since may resolve DOIs differently
+        snapshot = (args.snapshot, path.getmtime(args.snapshot))
+    return StateStore.digest(content, args.repository, args.backend,
+                             args.deposited, args.offline, snapshot,
+                             match_index, *args.classes)
+
+
+def get_epub_digest(args: argparse.Namespace, epub_path: str) -> str:
+    """Return the hash of the EPUB and of the options affecting its
+       processing, see get_digest"""
+    with open(epub_path, "rb") as epub_file:
+        return get_digest(args, epub_file.read())
+
+
+def run(args: argparse.Namespace, ex: Extractor, identifier: str,
+        client: CrossrefClient, rep: Thoth = None,
+        index: BibliographicIndex = None) -> tuple:
+    """Extract the citations of ex, refine them and write them to the work
+       identifier of the repository (or print them, on a dry run).
+
+       client, rep and index (the local bibliographic index) may be
+       shared by several runs. Return a tuple of the Citation objects, of
+       the references that could not be written, by ordinal, and of the
+       number of citations whose DOI could not be resolved."""
+    # Extract unstructured citations
+    unstr_citations = list(ex.iter_citations(args.classes, jobs=args.jobs))
+
+    # Process the unstructured citations and return Citation objects
+    citations, unresolved = process_citations(
+        unstr_citations, client, args.concurrency, index, args.search,
+        args.match_threshold, progress=not args.no_progress)
+
+    return citations, publish(args, citations, identifier, rep), unresolved
+
+
+def publish(args: argparse.Namespace, citations: list, identifier: str,
+            rep: Thoth = None) -> dict:
+    """Write the citations to the work identifier of the repository (or
+       print them, on a dry run). Return the references that could not be
+       written, by ordinal."""
     # If dry run, simply show citation data
     if args.dry_run:
         for c in citations:
             print(c)
+        return {}
+
     # If not dry run, write data to repository
-    else:
-        if args.repository == "thoth":
-            token = getenv('THOTH_PAT')
-            if not token:
-                raise KeyError(
-                    "No Thoth personal access token provided "
-                    "(THOTH_PAT environment variable not set)"
-                )
-            rep = Thoth(token)
-            rep.init_connection()
-            rep.resolve_identifier(args.identifier)
-
-            bar = Bar("Write to repository", max=len(citations))
-            for ordinal, citation in enumerate(citations, start=1):
-                rep.write_record(citation, ordinal)
-                bar.next()
-            bar.finish()
+    rep.resolve_identifier(identifier)
+    return write_citations(citations, rep, args)
+
+
+def get_deposited_citations(client: CrossrefClient, doi: str) -> list:
+    """Return the Citation objects of the reference list deposited with
+       Crossref for the work doi (empty if there is none)"""
+    doi = Refine.find_doi_match(doi or "")
+    references = client.get_references(doi) if doi else None
+    return [citation_from_reference(r) for r in references or []]
+
+
+def process(args: argparse.Namespace, get_extractor: callable,
+            identifier: str, client: CrossrefClient, rep: Thoth = None,
+            doi: str = None, index: BibliographicIndex = None) -> tuple:
+    """Process one document with the pipeline selected by args: with
+       --deposited, the reference list deposited with Crossref for the work
+       doi is used when there is one; otherwise the citations of the
+       Extractor returned by get_extractor are extracted and refined,
+       streaming them with --streaming. Return a tuple of the number of
+       citations, of the references that could not be written and of the
+       number of citations whose DOI could not be resolved."""
+    if args.deposited and doi:
+        citations = get_deposited_citations(client, doi)
+        if citations:
+            print(f"Using the {len(citations)} references deposited with "
+                  f"Crossref for {doi}")
+            return len(citations), \
+                publish(args, citations, identifier, rep), 0
+        print(f"No references deposited with Crossref for {doi}")
+
+    if args.streaming:
+        return run_streaming(args, get_extractor(), identifier, client, rep,
+                             index)
+    citations, failures, unresolved = run(args, get_extractor(), identifier,
+                                          client, rep, index)
+    return len(citations), failures, unresolved
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.streaming and args.incremental:
+        parser.error("--streaming cannot be used with --incremental")
+    epub_path = args.epub.name
+
+    # Skip EPUBs that have not changed since they were last written in full
+    state = get_state(args)
+    if state is not None:
+        digest = get_epub_digest(args, epub_path)
+        key = get_state_key(args.identifier, epub_path)
+        if not args.force and state.is_unchanged(key, digest):
+            print(f"{epub_path} has not changed since the last run: "
+                  f"skipping (use --force to process it anyway)")
+            state.close()
+            return
+
+    cache = get_crossref_cache(args)
+    snapshot = get_crossref_snapshot(args)
+    client = get_crossref_client(args, cache, snapshot)
+    index = get_match_index(args)
+    try:
+        rep = None if args.dry_run else get_repository(args)
+        count, failures, unresolved = process(
+            args, lambda: Extractor(epub_path, backend=args.backend,
+                                    stream=args.stream),
+            args.identifier, client, rep, doi=args.identifier, index=index)
+        if state is not None:
+            # unresolved DOIs are retried by the next run
+            state.record(key, digest, count, len(failures) + unresolved)
+    finally:
+        client.close()
+        if cache is not None:
+            cache.close()
+        if snapshot is not None:
+            snapshot.close()
+        if index is not None:
+            index.close()
+        if state is not None:
+            state.close()
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -16,77 +16,247 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import path
 import requests
 import json
-import subprocess
-import tempfile
 from urllib.parse import urljoin
 
-from ebooklib import epub
+from lib.extractor import Extractor
+from lib.fetch import HtmlFetcher, HtmlMirror
+from lib.state import StateStore
+from main import add_pipeline_arguments, get_cache_path, \
+    get_crossref_cache, get_crossref_client, get_crossref_snapshot, \
+    get_digest, get_match_index, get_repository, get_state, get_state_key, \
+    process
+
+CLASSES = ["bibliography-first-para", "bibliography-other-para"]
+THOTH_URL = 'https://api.thoth.pub/graphql'
+WORK_FIELDS = "workId \
+               relations (relationTypes: HAS_CHILD) { \
+                 relatedWork { \
+                   workId \
+                   doi \
+                   publications (publicationTypes: HTML) { \
+                     locations { \
+                       fullTextUrl \
+                     } \
+                   } \
+                 } \
+               }"
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("doi", type=str,
-                        help="Work DOI")
+    parser.add_argument("doi", type=str, nargs="*",
+                        help="Work DOI(s)")
+    parser.add_argument("--doi-file", type=argparse.FileType("r"),
+                        help="File listing the DOIs of the works to "
+                             "process, one per line ('-' for stdin).")
+    parser.add_argument("--book-concurrency", type=int, default=4,
+                        help="Maximum number of books processed at the "
+                             "same time. Default: %(default)s")
     parser.add_argument("--html-path", type=str, help="Path to folder containing HTML chapter files")
-    parser.add_argument("--dry-run", action='store_true',
-                        help="Perform a dry run: no data would be sent to "
-                             "metadata repositories.")
+    parser.add_argument("--download-concurrency", type=int, default=8,
+                        help="Maximum number of concurrent chapter "
+                             "downloads. Default: %(default)s")
+    parser.add_argument("--html-cache", type=str,
+                        default=path.join(path.dirname(get_cache_path()),
+                                          "html"),
+                        help="Folder where downloaded chapter files are "
+                             "kept, with the layout of --html-path. "
+                             "Default: %(default)s")
+    parser.add_argument("--html-cache-ttl", type=float, default=24,
+                        help="Hours during which downloaded chapter files "
+                             "are reused without checking for changes. "
+                             "Default: %(default)s")
+    parser.add_argument("--no-html-cache", action='store_true',
+                        help="Do not keep downloaded chapter files.")
+    parser.add_argument("--html-cache-only", action='store_true',
+                        help="Do not download chapter files: only use those "
+                             "in --html-cache. Implied by --offline.")
+    add_pipeline_arguments(parser)
+    parser.set_defaults(classes=CLASSES, repository="thoth")
     args = parser.parse_args()
-
-    # get chapter data
-    query = query_thoth(urljoin("https://doi.org/", args.doi))
-    chapters = get_chapters(query)
-
-    # add bibliography section (if any) to chapter list
+    if args.streaming and args.incremental:
+        parser.error("--streaming cannot be used with --incremental")
+
+    dois = get_dois(args.doi, args.doi_file)
+    if not dois:
+        parser.error("no work DOI given")
+    if min(args.book_concurrency, len(dois)) > 1:
+        # the progress bars of concurrent books would garble each other
+        args.no_progress = True
+
+    # get chapter data of all the books, in as few queries as possible
+    books = query_thoth_books(dois)
+
+    # the downloads, the Crossref client, cache and snapshot, the Thoth
+    # connection, the bibliographic index and the state database are shared
+    # by all the books
+    state = get_state(args)
+    cache = get_crossref_cache(args)
+    snapshot = get_crossref_snapshot(args)
+    client = get_crossref_client(args, cache, snapshot)
+    index = get_match_index(args)
+    fetcher = get_fetcher(args)
+    summaries = {}
     try:
-        bib_url = urljoin(chapters[0].get("html_page"), "bibliography.xhtml")
-    except IndexError:
-        pass
-    else:
-        r = requests.get(bib_url)
-        if r.status_code == 200:
-            chapters.append({"doi": args.doi, "html_page": bib_url})
-
+        rep = None if args.dry_run else get_repository(args)
+        with ThreadPoolExecutor(max_workers=args.book_concurrency) as pool:
+            futures = {pool.submit(process_book, doi, books[doi], args,
+                                   fetcher, client, rep, state, index): doi
+                       for doi in dois}
+            for future in as_completed(futures):
+                try:
+                    summaries[futures[future]] = future.result()
+                except Exception as e:
+                    summaries[futures[future]] = e
+    finally:
+        fetcher.close()
+        client.close()
+        if cache is not None:
+            cache.close()
+        if snapshot is not None:
+            snapshot.close()
+        if index is not None:
+            index.close()
+        if state is not None:
+            state.close()
+
+    errors = report_books(dois, summaries)
+    if errors:
+        raise SystemExit(f"{errors} of {len(dois)} books could not be "
+                         f"processed")
+
+
+def get_dois(dois: list, doi_file: any = None) -> list:
+    """This method returns the unique work DOIs given on the command line
+       and in doi_file (one per line, blank lines and # comments ignored),
+       in order"""
+    if doi_file is not None:
+        lines = (line.split("#")[0].strip() for line in doi_file)
+        dois = dois + [line for line in lines if line]
+    return list(dict.fromkeys(dois))
+
+
+def process_book(doi: str, thoth_data: dict, args: argparse.Namespace,
+                 fetcher: HtmlFetcher, client: any, rep: any,
+                 state: StateStore, index: any = None) -> dict:
+    """This method runs all the chapters of a book (and its bibliography,
+       if any) through cit-ex, and returns a summary of the run"""
+    chapters = get_chapters(thoth_data)
     if len(chapters) < 1:
-        raise KeyError(f"No chapters found in work metadata for {args.doi}")
-
-    # create an epub for each chapter and run it through cit-ex
-    for chapter in chapters:
-        with tempfile.NamedTemporaryFile() as epub_file:
-            create_epub(chapter.get("html_page"), epub_file.name, args.html_path)
+        raise KeyError(f"No chapters found in work metadata for {doi}")
 
-            cmd = f"python3 main.py {epub_file.name} " \
-                  f"-c bibliography-first-para bibliography-other-para " \
-                  f"-i {chapter.get('doi')}"
-            print(f"Executing: `{cmd}`")
-            if not args.dry_run:
-                subprocess.check_output(cmd.split())
+    # add bibliography section (if any) to chapter list
+    bib_url = urljoin(chapters[0].get("html_page"), "bibliography.xhtml")
+    chapters.append({"doi": doi, "html_page": bib_url,
+                     "work_id": thoth_data["data"]["workByDoi"].get("workId")})
+
+    # books are processed concurrently: each needs its own work identifier
+    rep = rep.clone() if rep is not None else None
+
+    # chapters are processed as soon as their HTML is available
+    summary = {"chapters": 0, "unchanged": 0, "citations": 0, "failures": 0}
+    by_url = {chapter.get("html_page"): chapter for chapter in chapters}
+    for url, html in get_chapter_pages(list(by_url), fetcher,
+                                       args.html_path, optional=[bib_url]):
+        if html is None:
+            continue
+        summary["chapters"] += 1
+        result = process_chapter(by_url[url], html, args, client, rep, state,
+                                 index)
+        if result is None:
+            summary["unchanged"] += 1
+        else:
+            count, failures = result
+            summary["citations"] += count
+            summary["failures"] += len(failures)
+    return summary
+
+
+def report_books(dois: list, summaries: dict) -> int:
+    """This method prints the summary of each book and returns the number
+       of books that could not be processed"""
+    errors = 0
+    print("Summary:")
+    for doi in dois:
+        summary = summaries.get(doi)
+        if isinstance(summary, dict):
+            print(f"  {doi}: {summary['chapters']} chapters "
+                  f"({summary['unchanged']} unchanged), "
+                  f"{summary['citations']} citations, "
+                  f"{summary['failures']} failures")
+        else:
+            errors += 1
+            print(f"  {doi}: error: {summary!r}")
+    return errors
+
+
+def process_chapter(chapter: dict, html: bytes, args: argparse.Namespace,
+                    client: any, rep: any, state: StateStore,
+                    index: any = None) -> tuple:
+    """This method runs the HTML of a chapter through cit-ex, unless it has
+       not changed since the last run. Returns the number of citations and
+       the write failures, or None if the chapter was skipped"""
+    doi = chapter.get("doi")
+    key = get_state_key(doi)
+    digest = get_digest(args, html)
+    if state is not None and not args.force \
+            and state.is_unchanged(key, digest):
+        print(f"Skipping {doi}: unchanged since the last run")
+        return None
+
+    print(f"Processing {doi}")
+    # the work UUID from the chapter query spares a DOI lookup
+    identifier = chapter.get("work_id") or doi
+    count, failures, unresolved = process(
+        args, lambda: Extractor.from_html(html, backend=args.backend),
+        identifier, client, rep, doi=doi, index=index)
+    if state is not None:
+        # unresolved DOIs are retried by the next run
+        state.record(key, digest, count, len(failures) + unresolved)
+    return count, failures
 
 
 def query_thoth(book_doi: str) -> str:
     """This method queries Thoth to get the Full Text URLs of the HTML
        edition of each chapter of the book"""
-    url = 'https://api.thoth.pub/graphql'
-    query = {"query": "{ workByDoi (doi: \"%s\") { \
-                           relations (relationTypes: HAS_CHILD) { \
-                              relatedWork { \
-                                doi \
-                                publications (publicationTypes: HTML) { \
-                                  locations { \
-                                    fullTextUrl \
-                                  } \
-                                } \
-                              } \
-                           } \
-                         } \
-                        }" % book_doi}
-
+    query = {"query": "{ workByDoi (doi: \"%s\") { %s } }"
+                      % (book_doi, WORK_FIELDS)}
+    return post_thoth_query(query)
+
+
+def query_thoth_books(book_dois: list, batch_size: int = 25) -> dict:
+    """This method queries Thoth for the chapters of several books, with
+       one aliased query per batch_size books. It returns a dictionary
+       of book DOI to query result, in the format returned by query_thoth.
+       A batch failing as a whole (e.g. due to an unknown DOI) is queried
+       again one book at a time."""
+    books = {}
+    for i in range(0, len(book_dois), batch_size):
+        batch = book_dois[i:i + batch_size]
+        fields = " ".join(
+            "b%d: workByDoi (doi: \"%s\") { %s }"
+            % (n, urljoin("https://doi.org/", doi), WORK_FIELDS)
+            for n, doi in enumerate(batch))
+        data = post_thoth_query({"query": "{ %s }" % fields}).get("data")
+
+        for n, doi in enumerate(batch):
+            if data and data.get(f"b{n}") is not None:
+                books[doi] = {"data": {"workByDoi": data[f"b{n}"]}}
+            else:
+                books[doi] = query_thoth(urljoin("https://doi.org/", doi))
+    return books
+
+
+def post_thoth_query(query: dict) -> dict:
+    """This method sends a GraphQL query to Thoth and returns the
+       decoded response"""
     # handle connection issues
     try:
-        r = requests.post(url, json=query)
+        r = requests.post(THOTH_URL, json=query)
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
         raise SystemExit(err)
@@ -96,8 +266,8 @@ def query_thoth(book_doi: str) -> str:
 
 def get_chapters(thoth_data: str) -> list:
     """This method extracts data from a Thoth query
-       and returns a list of dictionaries with fullTextUrl and DOI
-       of each chapter"""
+       and returns a list of dictionaries with fullTextUrl, DOI
+       and workId of each chapter"""
     try:
         relations = thoth_data["data"]["workByDoi"]["relations"]
     except TypeError:
@@ -108,6 +278,7 @@ def get_chapters(thoth_data: str) -> list:
     chapters = []
     for relation in relations:
         doi = relation.get("relatedWork", {}).get("doi", None)
+        work_id = relation.get("relatedWork", {}).get("workId", None)
 
         try:
             html = relation.get("relatedWork", {}).get("publications", {})[0] \
@@ -116,52 +287,44 @@ def get_chapters(thoth_data: str) -> list:
             raise IndexError(f"No html data for relation {relation}.")
 
         if (doi is not None) and (html is not None):
-            chapters.append({"doi": doi, "html_page": html})
+            chapters.append({"doi": doi, "html_page": html,
+                             "work_id": work_id})
 
     return chapters
 
 
-def create_epub(url: str, epub_file_path: str, html_path: str | None) -> None:
-    """This method creates an EPUB with the HTML page (URL) specified in the
-       argument"""
-    if html_path:
+def get_fetcher(args: argparse.Namespace) -> HtmlFetcher:
+    """This method returns the fetcher of the chapter files, which keeps
+       them in the local mirror (--html-cache) unless disabled"""
+    mirror = None if args.no_html_cache else HtmlMirror(args.html_cache)
+    return HtmlFetcher(max_workers=args.download_concurrency, mirror=mirror,
+                       max_age=args.html_cache_ttl * 60 * 60,
+                       offline=args.html_cache_only or args.offline)
+
+
+def get_chapter_pages(urls: list, fetcher: HtmlFetcher,
+                      html_path: str | None, optional: list = ()) -> tuple:
+    """This method yields a (URL, HTML) tuple for each chapter page, as soon
+       as it is available. Pages are downloaded concurrently by fetcher,
+       unless a local copy (html_path) is given. HTML is None for the
+       optional pages that do not exist."""
+    if not html_path:
+        # Retrieve HTML chapter file data directly from the URLs
+        yield from fetcher.fetch_all(urls, optional=optional)
+        return
+
+    for url in urls:
         # A local folder containing HTML chapter file data exists
         # Select the correct file by cross-referencing the name against the URL
         # URL is expected to be in the format `https://doi.org/[doiprefix]/[doi]/[filename.xhtml]`
         # and HTML path is expected to contain a folder [doi] containing the file [filename.xhtml]
         split_url = url.split('/')
         local_path = path.join(html_path, split_url[-2], split_url[-1])
+        if url in optional and not path.exists(local_path):
+            yield url, None
+            continue
         with open(local_path, 'rb') as chapter_file:
-            compile_epub(chapter_file.read(), epub_file_path)
-
-    else:
-        # Retrieve HTML chapter file data directly from the URL
-        r = requests.get(url)
-
-        if r.status_code != 200:
-            raise TypeError(f"HTML chapter URL {url} returned unexpected status code {r.status_code}.")
-
-        compile_epub(r.text.encode(), epub_file_path)
-
-
-def compile_epub(chapter_file: bytes, epub_file_path: str) -> None:
-    """This method compiles an EPUB from the bytes object supplied and writes it to file"""
-    book = epub.EpubBook()
-
-    chapter = epub.EpubHtml(title="Chapter", file_name="chapter.xhtml",
-                            lang="en-gb")
-    chapter.content = chapter_file
-    book.add_item(chapter)
-
-    book.toc = (epub.Link("chapter.xhtml", "Chapter", "ch"),
-                (epub.Section("Book"),
-                (chapter, ))
-                )
-
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-
-    epub.write_epub(epub_file_path, book, {})
+            yield url, chapter_file.read()
 
 
 if __name__ == "__main__":  # pragma: no cover